@@ -8,11 +8,8 @@ if __name__ == '__main__':
         exec(module)
     sys.exit()
 
-import neo4j
-
-from neo4j.util import Subreference
-
-from shop import model
+from shop import model, schema
+from shop.backend import GraphDatabase, Subreference, backend_of
 
 
 class _descriptor(type):
@@ -26,13 +23,104 @@ class _descriptor(type):
 
 class Store(object):
 
-    def __init__(self, storedir, storename="Products"):
-        self.__graphdb = neo4j.GraphDatabase(storedir)
+    def __init__(self, storedir, storename="Products", backend=None,
+                 cache_size=None, snapshot=None):
+        """Open the store named storename in the graph database in storedir.
+        With snapshot, the schema is loaded from a snapshot next to storedir
+        if it is up to date, and the snapshot is written at once if it is
+        missing or stale, and again when the store is closed if the schema
+        changed. By default snapshots are used if the backend keeps the graph
+        in storedir. See shop.schema."""
+        self.__graphdb = GraphDatabase(storedir, backend)
         self.__name = storename
+        if cache_size is not None:
+            self.categories.cache.resize(cache_size)
+            self.attribute.type.cache.resize(cache_size)
+        if snapshot is None:
+            snapshot = backend_of(self.__graphdb).PERSISTENT
+        self.__snapshot = snapshot and schema.snapshot_path(storedir) or None
+        if self.__snapshot:
+            version = schema.load_snapshot(self, self.__snapshot)
+            if version is None:
+                version = schema.write_snapshot(self, self.__snapshot)
+            self.__snapshot_version = version
+
+    __snapshot_version = None
+    def close(self):
+        """Write the schema snapshot if it is out of date, shut down the
+        graph database and drop the caches of the model."""
+        if self.__snapshot:
+            with self.graphdb.transaction:
+                version = model.schema_version(self.graphdb)
+            if version != self.__snapshot_version:
+                schema.write_snapshot(self, self.__snapshot)
+        model.forget(self.__graphdb)
+        self.__graphdb.shutdown()
 
     name = property(lambda self: self.__name)
     graphdb = property(lambda self: self.__graphdb)
 
+    def scan(self, func, workers=4, key=None, errors=None, category=None):
+        """Call func(product) for all products in the store, or in category
+        and its subcategories, from a pool of workers threads, and yield the
+        results in catalogue order, or grouped by key. See shop.scan.scan."""
+        from shop.scan import scan
+        if category is None:
+            category = self.root
+        return scan(category, func, workers, key, errors)
+
+    def dump(self, fileobj, compress=False, chunk_size=1000):
+        """Write the whole store to fileobj as JSON lines, gzip compressed
+        if compress is true. Returns the number of products written. See
+        shop.dump.dump."""
+        from shop.dump import dump
+        return dump(self, fileobj, compress, chunk_size)
+
+    def restore(self, fileobj, compressed=None, batch_size=1000, errors=None):
+        """Add the contents of a dump in fileobj to the store. Returns the
+        number of created and of rejected products. See
+        shop.dump.restore."""
+        from shop.dump import restore
+        return restore(self, fileobj, compressed, batch_size, errors)
+
+    def search(self, text, category=None, limit=20):
+        """Find the categories and products with names or text values that
+        have words starting with the words of text, in the store or in
+        category and its subcategories. Returns the best limit matches, best
+        first, see shop.search.TextIndex.search. The index is loaded on the
+        first search and kept up to date by the model after that."""
+        graphdb = self.graphdb
+        index = model.text_index(graphdb, self.__texts)
+        if category is None:
+            categories = None
+        else:
+            with graphdb.transaction:
+                categories = set(node.id for node in model._preorder(
+                        model.category_node(category)))
+        found = []
+        with graphdb.transaction:
+            for id, category_id in index.search(text, categories, limit):
+                try:
+                    node = graphdb.node[id]
+                    category = model.Category(graphdb,
+                                              graphdb.node[category_id])
+                except KeyError: # deleted, and not yet committed
+                    continue
+                if id == category_id:
+                    found.append(category)
+                else:
+                    found.append(category(graphdb, node))
+        return found
+
+    def __texts(self):
+        with self.graphdb.transaction:
+            nodes = model._preorder(model.category_node(self.root))
+            nodes.next() # not the root
+            for node in nodes:
+                yield node.id, node.id, dict(Name=node['Name'])
+                for rel in node.PRODUCT.outgoing:
+                    yield rel.end.id, node.id, dict(rel.end.items())
+
     __root = None
     @property
     def root(self):
@@ -41,10 +129,10 @@ class Store(object):
         if root is None:
 
             with self.graphdb.transaction:
-                root = model.Category(
-                    self.graphdb,
-                    Subreference.Node.CATEGORY_ROOT(self.graphdb,
-                                                    Name=self.__name))
+                node = Subreference.Node.CATEGORY_ROOT(self.graphdb,
+                                                       Name=self.__name)
+                model.init_product_counts(node)
+                root = model.Category(self.graphdb, node)
 
             self.__root = root
 
@@ -56,20 +144,24 @@ class Store(object):
             self.store = store
 
         @property
-        def __categories(self):
-            try:
-                categories = self.store.__categories
-            except:
-                categories = None
-            if categories is None:
-                self.store.__categories = categories = {}
-            return categories
+        def index(self):
+            """The index of all categories by name."""
+            return model.name_index(self.store.graphdb, 'categories',
+                                    self.__names)
+
+        @property
+        def cache(self):
+            """The identity map of the categories."""
+            return model.identity_map(self.store.graphdb, 'categories')
+
+        def __names(self):
+            with self.store.graphdb.transaction:
+                for node in model.SubCategories(self.__root):
+                    yield node['Name'], node
 
         def __iter__(self):
             for node in model.SubCategories(self.__root):
-                category = model.Category(self.store.graphdb, node)
-                self.__categories[category.name] = category
-                yield category
+                yield model.Category(self.store.graphdb, node)
 
         @property
         def __root(self):
@@ -77,14 +169,11 @@ class Store(object):
                                                    Name=self.store.name)
 
         def __getitem__(self, key):
-            category = self.__categories.get(key)
-            if category is None:
-                with self.store.graphdb.transaction:
-                    for category in self:
-                        if category.name == key: break
-                    else:
-                        raise KeyError("No such category '%s'." % (key,))
-            return category
+            try:
+                node = self.index[key]
+            except KeyError:
+                raise KeyError("No such category '%s'." % (key,))
+            return model.Category(self.store.graphdb, node)
 
         def __call__(self, *args, **kwargs):
             return self.store.root.new_subcategory(*args, **kwargs)
@@ -101,14 +190,11 @@ class Store(object):
             store = property(lambda self: self.attr.store)
 
             def __getitem__(self, key):
-                type = self.__types.get(key)
-                if type is None:
-                    with self.attr.store.graphdb.transaction:
-                        for type in self:
-                            if type.name == key: break
-                        else:
-                            raise KeyError("No such attribute type: %r"%(key,))
-                return type
+                try:
+                    node = self.index[key]
+                except KeyError:
+                    raise KeyError("No such attribute type: %r"%(key,))
+                return model.AttributeType(self.store.graphdb, node)
 
             def __call__(self, *args, **kwargs):
                 return model.AttributeType.create(self.store.graphdb,
@@ -129,21 +215,27 @@ class Store(object):
                         return self[name]
 
             @property
-            def __types(self):
-                try:
-                    types = self.store.__types
-                except:
-                    types = None
-                if types is None:
-                    self.store.__types = types = {}
-                return types
+            def index(self):
+                """The index of all attribute types by name."""
+                return model.AttributeType.by_name(self.store.graphdb,
+                                                   self.__node)
+
+            @property
+            def cache(self):
+                """The identity map of the attribute types."""
+                return model.identity_map(self.store.graphdb,
+                                          'attribute types')
+
+            def define_types(self, types):
+                """Create many attribute types in one transaction, from
+                (name, attributes) pairs or a dict of them."""
+                return model.AttributeType.define_types(self.store.graphdb,
+                                                        self.__node, types)
 
             def __iter__(self):
                 graphdb = self.store.graphdb
                 for rel in self.__node.ATTRIBUTE_TYPE:
-                    type = model.AttributeType(graphdb, rel.end)
-                    self.__types[type.name] = type
-                    yield type
+                    yield model.AttributeType(graphdb, rel.end)
 
         def __call__(self, *args, **kwargs):
             return model.Attribute(*args, **kwargs)
@@ -3,7 +3,7 @@
 if __name__ != '__main__': raise ImportError
 
 import sys, os, copy
-from optparse import OptionParser, Option
+from optparse import OptionParser, OptionGroup, Option
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 path_dir = os.path.dirname(this_dir)
@@ -17,9 +17,11 @@ else:
     else:
         sys.path.append(os.path.dirname(this_dir))
 
+from shop.backend import BACKENDS, DEFAULT_BACKEND
+
 class ShopOption(Option):
     these_actions = ('import','dir')
-    ACTIONS = Option.ACTIONS + these_actions + ('runtest',)
+    ACTIONS = Option.ACTIONS + these_actions + ('runtest','runbench')
     STORE_ACTIONS = Option.STORE_ACTIONS + these_actions
     TYPED_ACTIONS = Option.TYPED_ACTIONS + these_actions
     ALWAYS_TYPED_ACTIONS = Option.ALWAYS_TYPED_ACTIONS + these_actions
@@ -27,9 +29,9 @@ class ShopOption(Option):
 
     def take_action(self, action, dest, opt, value, values, parser):
         ui = 'ui'
-        if action == 'runtest':
+        if action in ('runtest','runbench'):
+            value = action[3:]
             action = 'import'
-            value = 'test'
             dest = 'ui'
             ui = ''
         if action == 'import':
@@ -55,11 +57,62 @@ parser.add_option('--ui', dest="ui", action="import", default=DummyUI("cmd"),
 parser.add_option('--store', dest="store", action="dir",
                   default=os.path.abspath('storedb'), metavar="DIR",
                   help="the store directory")
+parser.add_option('--backend', dest="backend", type="choice",
+                  choices=sorted(BACKENDS), default=DEFAULT_BACKEND,
+                  metavar="NAME", help="the graph backend to store data in, "
+                  "one of: %s" % (", ".join(sorted(BACKENDS)),))
 parser.add_option('--test', action="runtest", help="run tests")
+parser.add_option('--bench', action="runbench", help="run benchmarks")
+parser.add_option('--profile', dest="profile", action="store_true",
+                  default=False, help="count the graph operations of the "
+                  "model calls and print them at exit")
+
+script = OptionGroup(parser, "Script options", "For the command line UI.")
+script.add_option('--script', dest="script", metavar="FILE",
+                  help="run the commands in FILE, or in the standard input "
+                  "for -, instead of prompting for them")
+script.add_option('--group-size', dest="group_size", type="int",
+                  default=1000, metavar="N",
+                  help="commit the script every N lines [default: %default]")
+parser.add_option_group(script)
+
+test = OptionGroup(parser, "Test options")
+test.add_option('--jobs', dest="jobs", type="int", metavar="N",
+                help="run the tests in N processes [default: one per CPU]")
+parser.add_option_group(test)
+
+bench = OptionGroup(parser, "Benchmark options")
+bench.add_option('--results', dest="results", metavar="FILE",
+                 help="write the benchmark results as JSON to FILE")
+bench.add_option('--baseline', dest="baseline", metavar="FILE",
+                 help="compare the benchmark results to those saved in FILE")
+bench.add_option('--scale', dest="scale", type="float", default=1.0,
+                 metavar="FACTOR", help="scale the benchmark data sizes")
+bench.add_option('--repeat', dest="repeat", type="int", default=3,
+                 metavar="N", help="run each benchmark N times, keep the best")
+parser.add_option_group(bench)
+
+http = OptionGroup(parser, "HTTP options", "For --ui http.")
+http.add_option('--host', dest="host", default="127.0.0.1", metavar="HOST",
+                help="the address to serve on [default: %default]")
+http.add_option('--port', dest="port", type="int", default=8000,
+                metavar="PORT", help="the port to serve on [default: %default]")
+parser.add_option_group(http)
 
 options, args = parser.parse_args()
 
 params = copy.copy(options.__dict__)
 del params['ui']
 
-options.ui.start(*args, **params)
+if options.profile:
+    from shop.backend import load
+    from shop.instrument import Profile
+    load(options.backend) # to hook the graph operations of the backend
+    profile = Profile().start()
+    try:
+        options.ui.start(*args, **params)
+    finally:
+        profile.stop()
+        sys.stderr.write("\nProfile:\n%s\n" % (profile.stats.report(),))
+else:
+    options.ui.start(*args, **params)
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking access to a Store, for services built on an event loop.
+
+Every call into the graph database blocks, so AsyncStore runs them on a
+fixed pool of worker threads and returns a Future for each call. Listings
+are read one chunk per task, and each chunk is queued behind the calls that
+came in meanwhile, so a long listing takes turns with other requests instead
+of holding a worker until it is done. The products of a listing are
+prefetched (see shop.model.prefetch), reading their attributes does not
+touch the graph again.
+
+Wait for a Future with result(), or have it call add_done_callback(fn)
+when it is done; an event loop can complete its own futures from such a
+callback. A Transaction runs its calls on one worker between begin() and
+commit() or rollback(), a Listing gives the next chunk or item with
+next_chunk() or next_item().
+"""
+
+from __future__ import with_statement
+
+import sys
+import Queue
+import threading
+import traceback
+
+from shop import model
+
+__all__ = 'AsyncStore', 'Future', 'Transaction', 'Listing',
+
+DEFAULT_WORKERS = 4
+DEFAULT_CHUNK_SIZE = 100
+
+
+class Future(object):
+    """The result of a call that runs on a worker thread."""
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+        self.__result = self.__exception = None
+
+    def done(self):
+        return self.__done.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish, return its result or raise its
+        exception."""
+        self.__done.wait(timeout)
+        if not self.done():
+            raise RuntimeError("The call did not finish in time")
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+    def exception(self, timeout=None):
+        self.__done.wait(timeout)
+        return self.__exception
+
+    def add_done_callback(self, callback):
+        """Call callback(future) when the call has finished, from the thread
+        that finished it, or right away if it has finished already."""
+        with self.__lock:
+            if not self.done():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self.__finish(result, None)
+
+    def set_exception(self, exception):
+        self.__finish(None, exception)
+
+    def __finish(self, result, exception):
+        with self.__lock:
+            self.__result, self.__exception = result, exception
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception: # do not let a callback stop the worker
+                traceback.print_exc()
+
+
+def _run(future, func, args, kwargs):
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        future.set_exception(sys.exc_info()[1])
+    else:
+        future.set_result(result)
+
+
+class AsyncStore(object):
+    """Runs the calls into a Store on workers threads.
+
+    The calls of one AsyncStore are queued and served in order; the number
+    of workers bounds the number of graph operations that run at once."""
+
+    def __init__(self, store, workers=DEFAULT_WORKERS,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.__calls = Queue.Queue()
+        self.__workers = [threading.Thread(target=self.__work)
+                          for i in range(workers)]
+        for worker in self.__workers:
+            worker.setDaemon(True)
+            worker.start()
+
+    def __work(self):
+        while True:
+            call = self.__calls.get()
+            if call is None: return
+            _run(*call)
+
+    def close(self):
+        """Stop the workers once the queued calls are done."""
+        for worker in self.__workers:
+            self.__calls.put(None)
+        for worker in self.__workers:
+            worker.join()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) for a worker, return its Future."""
+        future = Future()
+        self.__calls.put((future, func, args, kwargs))
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in a transaction of its own."""
+        return self.submit(self.__transactional, func, args, kwargs)
+
+    def __transactional(self, func, args, kwargs):
+        with self.store.graphdb.transaction:
+            return func(*args, **kwargs)
+
+    def transaction(self):
+        """A Transaction that runs calls on one worker, see Transaction."""
+        return Transaction(self)
+
+    def category(self, name):
+        """Look up a category by name."""
+        return self.submit(self.store.categories.__getitem__, name)
+
+    def subcategory(self, category, name):
+        """Look up a subcategory of category by name."""
+        return self.call(category.__getitem__, name)
+
+    def new_category(self, name, **attributes):
+        """Create a top level category."""
+        return self.submit(self.store.categories, name, **attributes)
+
+    def new_subcategory(self, category, name, **attributes):
+        return self.submit(category.new_subcategory, name, **attributes)
+
+    def new_product(self, category, **values):
+        return self.submit(category.new_product, **values)
+
+    def categories(self, category=None):
+        """List the subcategories of category, of the root by default."""
+        if category is None:
+            category = self.store.root
+        def fetch(cursor):
+            return list(category.categories), None
+        return Listing(self, fetch)
+
+    def products(self, category, chunk_size=None):
+        """List the products in category and its subcategories, reading and
+        prefetching chunk_size products per task."""
+        limit = chunk_size or self.chunk_size
+        def fetch(cursor):
+            page, cursor = category.products(limit, after=cursor)
+            return model.prefetch(page), cursor
+        return Listing(self, fetch)
+
+
+class Transaction(object):
+    """Runs calls in one transaction, which needs one thread: a worker
+    serves the calls of the transaction from begin() until commit() or
+    rollback().
+
+        transaction = aio.transaction()
+        transaction.begin()
+        transaction.run(category.new_product, Name="...")
+        transaction.commit().add_done_callback(committed)
+
+    begin() and the end of the transaction return futures too. A call that
+    fails does not end the transaction, check its Future and rollback() to
+    undo the transaction. While a transaction is open it holds its worker,
+    calls that wait for other calls of the AsyncStore can starve the
+    pool."""
+
+    def __init__(self, aio):
+        self.__aio = aio
+        self.__calls = Queue.Queue()
+        self.__started = None
+
+    def begin(self):
+        """Start the transaction on a worker, the Future gives self."""
+        if self.__started is None:
+            self.__started = Future()
+            self.__ended = self.__aio.submit(self.__serve)
+        return self.__started
+
+    def __serve(self):
+        try:
+            with self.__aio.store.graphdb.transaction:
+                self.__started.set_result(self)
+                while True:
+                    call = self.__calls.get()
+                    if call is None: break
+                    if call is _ROLLBACK: raise _Rollback()
+                    _run(*call)
+        except _Rollback:
+            pass
+
+    def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the transaction."""
+        if self.__started is None:
+            raise ValueError("The transaction has not begun")
+        future = Future()
+        self.__calls.put((future, func, args, kwargs))
+        return future
+
+    def commit(self):
+        """End the transaction, keeping its changes."""
+        self.begin()
+        self.__calls.put(None)
+        return self.__ended
+
+    def rollback(self):
+        """End the transaction, undoing its changes."""
+        self.begin()
+        self.__calls.put(_ROLLBACK)
+        return self.__ended
+
+_ROLLBACK = object()
+
+class _Rollback(Exception):
+    pass
+
+
+class Listing(object):
+    """Items read in chunks by fetch(cursor), which returns a list of items
+    and the cursor of the next chunk, or None after the last chunk.
+    next_chunk() gives a Future of the next list of items, an empty list at
+    the end, and next_item() one of the next item. Read the next chunk or
+    item only after the previous one has arrived."""
+
+    def __init__(self, aio, fetch):
+        self.__aio = aio
+        self.__fetch = fetch
+        self.__cursor = None
+        self.__more = True
+        self.__buffer = []
+
+    def next_chunk(self):
+        if not self.__more:
+            future = Future()
+            future.set_result([])
+            return future
+        return self.__aio.call(self.__next_chunk)
+
+    def __next_chunk(self):
+        items, self.__cursor = self.__fetch(self.__cursor)
+        self.__more = self.__cursor is not None
+        return items
+
+    def next_item(self):
+        """A Future of the next item, or of StopIteration at the end."""
+        future = Future()
+        if self.__buffer:
+            future.set_result(self.__buffer.pop(0))
+            return future
+        def chunk_read(chunk):
+            if chunk.exception() is not None:
+                future.set_exception(chunk.exception())
+                return
+            items = chunk.result()
+            if not items:
+                future.set_exception(StopIteration())
+                return
+            self.__buffer = items[1:]
+            future.set_result(items[0])
+        self.next_chunk().add_done_callback(chunk_read)
+        return future
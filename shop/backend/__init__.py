@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+The graph backend layer of the shop.
+
+The domain model only uses a small part of the Neo4j Python bindings: node
+and relationship creation, typed relationship access, transactions,
+traversals and subreference nodes. This module defines that subset in a
+backend neutral way, so that the model can run either on the Neo4j engine
+or on the pure Python in-memory graph in shop.backend.memory.
+
+Backends are modules that define:
+    GraphDatabase(storedir) -- open a graph database.
+    PERSISTENT              -- whether the graph is kept in storedir.
+    owns(entity)            -- tell if a graphdb/node belongs to the backend.
+    traverse(traversal)     -- iterate the nodes of a Traversal instance.
+    subreference(graphdb, type, properties)
+                            -- get or create a subreference node.
+    increment(node, key, delta, default)
+                            -- add to a number property, see increment.
+
+The GraphDatabase objects of a backend keep a TransactionEvents per thread,
+returned by graphdb._events(), and their transactions report to it when they
+begin and end, so that the model can act on commits and rollbacks with
+after_commit and after_rollback, and can tell with rollback_only that the
+open transaction cannot commit any more.
+"""
+
+from __future__ import with_statement
+
+import sys
+
+__all__ = ('GraphDatabase', 'Traversal', 'Outgoing', 'Incoming',
+           'DEPTH_FIRST', 'BREADTH_FIRST', 'Subreference', 'transactional',
+           'after_commit', 'after_rollback', 'rollback_only', 'increment',
+           'BACKENDS', 'DEFAULT_BACKEND')
+
+BACKENDS = {
+    'neo4j': 'shop.backend.neo',
+    'memory': 'shop.backend.memory',
+}
+DEFAULT_BACKEND = 'neo4j'
+
+DEPTH_FIRST = 'depth first'
+BREADTH_FIRST = 'breadth first'
+
+
+def load(name):
+    """Import and return the backend module with the given name."""
+    try:
+        module = BACKENDS[name]
+    except KeyError:
+        raise ValueError("No such graph backend: %r" % (name,))
+    __import__(module)
+    return sys.modules[module]
+
+
+def GraphDatabase(storedir, backend=None):
+    """Open the graph database in storedir using the named backend."""
+    return load(backend or DEFAULT_BACKEND).GraphDatabase(storedir)
+
+
+def backend_of(entity):
+    """Get the backend module that a graphdb, node or relationship uses."""
+    for module in BACKENDS.values():
+        module = sys.modules.get(module)
+        if module is not None and module.owns(entity):
+            return module
+    raise TypeError("%r does not belong to any loaded graph backend" %
+                    (entity,))
+
+
+class TransactionEvents(object):
+    """The actions to run when the transactions of one thread in a graph
+    database end. A transaction calls begin() when it starts and end() when
+    it is committed or rolled back, and runs the actions that end() returns.
+
+    With savepoints, a nested transaction that rolls back only undoes its
+    own writes, like in the in-memory backend. Without, it makes the
+    enclosing transactions roll back as well, like in Neo4j."""
+
+    def __init__(self, savepoints):
+        self.savepoints = savepoints
+        self.__marks = [] # per open transaction, where its actions start
+        self.__commit = []
+        self.__rollback = []
+        self.__failed = False
+
+    active = property(lambda self: bool(self.__marks))
+    failed = property(lambda self: self.__failed)
+
+    def begin(self):
+        self.__marks.append((len(self.__commit), len(self.__rollback)))
+
+    def end(self, committed):
+        """End the innermost transaction. Returns the actions to run: those
+        registered for the commit when the outermost transaction commits,
+        those registered for the rollback, newest first, of each transaction
+        that rolls back."""
+        commit, rollback = self.__marks.pop()
+        if self.__marks:
+            if committed: return []
+            if not self.savepoints:
+                self.__failed = True
+                return []
+        else:
+            committed = committed and not self.__failed
+            self.__failed = False
+        if committed:
+            actions = self.__commit[commit:]
+        else:
+            actions = self.__rollback[rollback:]
+            actions.reverse()
+        del self.__commit[commit:]
+        del self.__rollback[rollback:]
+        return actions
+
+    def on_commit(self, action):
+        self.__commit.append(action)
+
+    def on_rollback(self, action):
+        self.__rollback.append(action)
+
+
+def after_commit(graphdb, action):
+    """Call action() when the outermost transaction of this thread in graphdb
+    commits, or now if no transaction is open. It is not called if the
+    transaction it was registered in rolls back."""
+    events = graphdb._events()
+    if events.active:
+        events.on_commit(action)
+    else:
+        action()
+
+
+def after_rollback(graphdb, action):
+    """Call action() if the transaction of this thread in graphdb that is
+    open now rolls back. Nothing is called outside of a transaction."""
+    events = graphdb._events()
+    if events.active:
+        events.on_rollback(action)
+
+
+def rollback_only(graphdb):
+    """Tell if the transaction of this thread in graphdb that is open now
+    will roll back when it ends, because a transaction nested in it rolled
+    back on a backend without savepoints."""
+    return graphdb._events().failed
+
+
+def increment(node, key, delta, default=None):
+    """Add delta to the number property key of node, in the transaction of
+    this thread, and return the new value. A missing property starts from
+    default, or is left missing and None is returned if default is None.
+
+    The node is locked for writing before the value is read, until the
+    transaction ends, so that concurrent increments are not lost."""
+    return backend_of(node).increment(node, key, delta, default)
+
+
+class Direction(object):
+    """Outgoing.TYPE and Incoming.TYPE describe typed, directed relationships
+    for use in the types list of a Traversal."""
+    def __init__(self, name):
+        self.name = name
+    def __getattr__(self, type):
+        if type.startswith('_'): raise AttributeError(type)
+        return (type, self)
+    def __repr__(self):
+        return self.name
+
+Outgoing = Direction('Outgoing')
+Incoming = Direction('Incoming')
+
+
+class Traversal(object):
+    """Base class for traversals. Instantiate with a start node and iterate
+    to get the traversed nodes. Subclasses define the relationship types to
+    follow and may override isReturnable and isStopNode."""
+    types = []
+    order = DEPTH_FIRST
+
+    def __init__(self, start):
+        self.start = start
+
+    def __iter__(self):
+        return iter(backend_of(self.start).traverse(self))
+
+    def isReturnable(self, pos):
+        return not pos.is_start
+
+    def isStopNode(self, pos):
+        return False
+
+
+class _subreference(object):
+    def __init__(self, type):
+        self.type = type
+    def __call__(self, graphdb, **properties):
+        return backend_of(graphdb).subreference(graphdb, self.type, properties)
+
+class Subreference(object):
+    """Subreference.Node.TYPE(graphdb, **properties) gets the node related
+    to the reference node with a TYPE relationship, creating it with the
+    given properties if it does not exist."""
+    class Node(object):
+        class __metaclass__(type):
+            def __getattr__(cls, type):
+                if type.startswith('_'): raise AttributeError(type)
+                return _subreference(type)
+
+
+def transactional(accessor):
+    """Decorate a method or property to run in a transaction of the graphdb
+    returned by the accessor descriptor."""
+    def decorator(target):
+        if isinstance(target, property):
+            return property(decorator(target.fget), target.fset, target.fdel,
+                            target.__doc__)
+        def transactional(self, *args, **kwargs):
+            with accessor.__get__(self, type(self)).transaction:
+                return target(self, *args, **kwargs)
+        transactional.__name__ = target.__name__
+        transactional.__doc__ = target.__doc__
+        return transactional
+    return decorator
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+A pure Python, in-memory graph engine.
+
+This implements the subset of the Neo4j Python bindings that the shop model
+uses, with dict and list adjacency on each node. Nothing is written to disk,
+so a store using this backend is empty every time it is opened.
+
+Transactions are thread bound and may be nested. Writes outside of a
+transaction raise NotInTransaction. When an exception propagates out of a
+transaction the writes made in that transaction are undone, nested
+transactions behave as savepoints of the enclosing transaction. There is no
+isolation between concurrent transactions.
+"""
+
+from __future__ import with_statement
+
+import threading
+import itertools
+
+from collections import deque
+
+from shop import backend
+
+__all__ = 'GraphDatabase', 'NotInTransaction',
+
+PERSISTENT = False
+
+
+class NotInTransaction(RuntimeError):
+    pass
+
+
+def owns(entity):
+    return isinstance(entity, (GraphDatabase, Entity))
+
+
+class GraphDatabase(object):
+
+    def __init__(self, storedir=None):
+        self.storedir = storedir
+        self._nodes = {}
+        self._node_ids = itertools.count()
+        self._relationship_ids = itertools.count()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self.node = NodeFactory(self)
+        with self.transaction:
+            self.reference_node = self.node()
+
+    @property
+    def transaction(self):
+        return Transaction(self)
+
+    def shutdown(self):
+        pass
+
+    def _undo_log(self):
+        state = self._local
+        try:
+            return state.undo, state.marks
+        except AttributeError:
+            state.undo, state.marks = [], []
+            return state.undo, state.marks
+
+    def _events(self):
+        state = self._local
+        try:
+            return state.events
+        except AttributeError:
+            state.events = backend.TransactionEvents(savepoints=True)
+            return state.events
+
+    def _log(self, undo):
+        log, marks = self._undo_log()
+        if not marks:
+            raise NotInTransaction("Write operation outside of a transaction")
+        log.append(undo)
+
+    def _next_id(self, ids):
+        with self._lock:
+            return ids.next()
+
+
+class Transaction(object):
+
+    def __init__(self, graphdb):
+        self.__graphdb = graphdb
+
+    def __enter__(self):
+        log, marks = self.__graphdb._undo_log()
+        marks.append(len(log))
+        self.__graphdb._events().begin()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        log, marks = self.__graphdb._undo_log()
+        mark = marks.pop()
+        if type is not None:
+            while len(log) > mark:
+                log.pop()()
+        if not marks:
+            del log[:]
+        for action in self.__graphdb._events().end(type is None):
+            action()
+        return False
+
+
+class NodeFactory(object):
+    """graphdb.node(**properties) creates a node, graphdb.node[id] gets one."""
+
+    def __init__(self, graphdb):
+        self.__graphdb = graphdb
+
+    def __call__(self, **properties):
+        graphdb = self.__graphdb
+        node = Node(graphdb, graphdb._next_id(graphdb._node_ids))
+        graphdb._log(lambda: graphdb._nodes.pop(node._id, None))
+        graphdb._nodes[node._id] = node
+        for key, value in properties.items():
+            node[key] = value
+        return node
+
+    def __getitem__(self, id):
+        try:
+            return self.__graphdb._nodes[id]
+        except KeyError:
+            raise KeyError("No node with id %r" % (id,))
+
+
+class Entity(object):
+
+    def __init__(self, graphdb, id):
+        self._graphdb = graphdb
+        self._id = id
+        self._properties = {}
+
+    id = property(lambda self: self._id)
+
+    def __getitem__(self, key):
+        return self._properties[key]
+
+    def get(self, key, default=None):
+        return self._properties.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._properties
+
+    def __setitem__(self, key, value):
+        if value is None:
+            raise ValueError("Property values may not be None")
+        properties = self._properties
+        if key in properties:
+            old = properties[key]
+            undo = lambda: properties.__setitem__(key, old)
+        else:
+            undo = lambda: properties.pop(key, None)
+        self._graphdb._log(undo)
+        properties[key] = value
+
+    def __delitem__(self, key):
+        properties = self._properties
+        old = properties[key]
+        self._graphdb._log(lambda: properties.__setitem__(key, old))
+        del properties[key]
+
+    def keys(self):
+        return self._properties.keys()
+
+    def values(self):
+        return self._properties.values()
+
+    def items(self):
+        return self._properties.items()
+
+
+class Node(Entity):
+
+    def __init__(self, graphdb, id):
+        Entity.__init__(self, graphdb, id)
+        self._outgoing = {}
+        self._incoming = {}
+
+    def __getattr__(self, type):
+        if type.startswith('_'): raise AttributeError(type)
+        return Relationships(self, type)
+
+    def __repr__(self):
+        return '<Node %d>' % (self._id,)
+
+    def delete(self):
+        if [rels for rels in self._outgoing.values() if rels] or \
+                [rels for rels in self._incoming.values() if rels]:
+            raise ValueError("Cannot delete %r, it still has relationships"
+                             % (self,))
+        nodes = self._graphdb._nodes
+        self._graphdb._log(lambda: nodes.__setitem__(self._id, self))
+        del nodes[self._id]
+
+    def _relate(self, type, other, properties):
+        graphdb = self._graphdb
+        if not (isinstance(other, Node) and other._graphdb is graphdb):
+            raise TypeError("Cannot relate %r to %r" % (self, other))
+        id = graphdb._next_id(graphdb._relationship_ids)
+        rel = Relationship(graphdb, id, type, self, other)
+        rel._attach()
+        graphdb._log(rel._detach)
+        for key, value in properties.items():
+            rel[key] = value
+        return rel
+
+
+class Relationship(Entity):
+
+    def __init__(self, graphdb, id, type, start, end):
+        Entity.__init__(self, graphdb, id)
+        self.type = type
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return '<Relationship %d %r->%r>' % (self._id, self.start, self.end)
+
+    def delete(self):
+        self._detach()
+        self._graphdb._log(self._attach)
+
+    def _attach(self):
+        self.start._outgoing.setdefault(self.type, []).append(self)
+        self.end._incoming.setdefault(self.type, []).append(self)
+
+    def _detach(self):
+        self.start._outgoing[self.type].remove(self)
+        self.end._incoming[self.type].remove(self)
+
+
+class Relationships(object):
+    """The relationships of one type of a node, node.TYPE.
+    Calling it creates a new relationship from the node to another node."""
+
+    def __init__(self, node, type, outgoing=True, incoming=True):
+        self.__node = node
+        self.__type = type
+        self.__outgoing = outgoing
+        self.__incoming = incoming
+
+    def __call__(self, other, **properties):
+        return self.__node._relate(self.__type, other, properties)
+
+    @property
+    def outgoing(self):
+        return Relationships(self.__node, self.__type, incoming=False)
+
+    @property
+    def incoming(self):
+        return Relationships(self.__node, self.__type, outgoing=False)
+
+    def __iter__(self):
+        node, type = self.__node, self.__type
+        rels = []
+        if self.__outgoing:
+            rels.extend(node._outgoing.get(type, ()))
+        if self.__incoming:
+            rels.extend(rel for rel in node._incoming.get(type, ())
+                        if not (self.__outgoing and rel.start is node))
+        return iter(rels)
+
+    @property
+    def single(self):
+        rels = list(self)
+        if not rels:
+            return None
+        if len(rels) > 1:
+            raise ValueError("More than one %s relationship on %r" %
+                             (self.__type, self.__node))
+        return rels[0]
+
+
+class Position(object):
+    __slots__ = 'node', 'last_relationship', 'depth', 'previous_node'
+
+    def __init__(self, node, last_relationship, depth, previous_node):
+        self.node = node
+        self.last_relationship = last_relationship
+        self.depth = depth
+        self.previous_node = previous_node
+
+    is_start = property(lambda self: self.last_relationship is None)
+
+
+def traverse(traversal):
+    """Iterate over the nodes of a shop.backend.Traversal, visiting each node
+    once, in the order given by the traversal."""
+    expand = [(type, direction is backend.Outgoing)
+              for type, direction in traversal.types]
+    breadth_first = traversal.order == backend.BREADTH_FIRST
+    pending = deque([Position(traversal.start, None, 0, None)])
+    visited = set()
+    while pending:
+        if breadth_first:
+            pos = pending.popleft()
+        else:
+            pos = pending.pop()
+        node = pos.node
+        if node._id in visited: continue
+        visited.add(node._id)
+        if traversal.isReturnable(pos):
+            yield node
+        if traversal.isStopNode(pos): continue
+        depth = pos.depth + 1
+        children = []
+        for type, outgoing in expand:
+            if outgoing:
+                for rel in node._outgoing.get(type, ()):
+                    children.append(Position(rel.end, rel, depth, node))
+            else:
+                for rel in node._incoming.get(type, ()):
+                    children.append(Position(rel.start, rel, depth, node))
+        if not breadth_first:
+            children.reverse()
+        pending.extend(children)
+
+
+def subreference(graphdb, type, properties):
+    rel = getattr(graphdb.reference_node, type).outgoing.single
+    if rel is None:
+        with graphdb._lock: # Unless it was created concurrently
+            rel = getattr(graphdb.reference_node, type).outgoing.single
+            if rel is None:
+                with graphdb.transaction:
+                    node = graphdb.node(**properties)
+                    getattr(graphdb.reference_node, type)(node)
+                    return node
+    return rel.end
+
+
+def increment(node, key, delta, default):
+    graphdb, properties = node._graphdb, node._properties
+    def undo():
+        # Take delta off again rather than restore the value read here, the
+        # increments committed meanwhile by other threads are kept
+        with graphdb._lock:
+            properties[key] -= delta
+    with graphdb._lock: # the graph has no write locks of its own
+        value = node.get(key, default)
+        if value is None:
+            return None
+        node[key] = value = value + delta
+        log, marks = graphdb._undo_log()
+        log[-1] = undo # in place of the undo that restores the value read
+        return value
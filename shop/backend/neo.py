@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Graph backend that runs on the Neo4j engine through the Neo4j Python bindings.
+
+The graph database, its transactions, nodes and relationships are wrapped in
+thin proxies with the same classes as those of shop.backend.memory, so that
+the transactions can be followed for shop.backend.after_commit and
+after_rollback, and so that shop.instrument can count the graph operations
+on both backends the same way. A nested transaction that rolls back makes
+the enclosing transactions roll back too.
+"""
+
+import sys
+import threading
+
+import neo4j
+
+from neo4j.util import Subreference
+
+from shop import backend
+
+__all__ = 'GraphDatabase',
+
+PERSISTENT = True
+LOCK = '_Lock' # property written to lock a node
+
+__traversals = {}
+
+
+def owns(entity):
+    return isinstance(entity, (GraphDatabase, Entity))
+
+
+class GraphDatabase(object):
+    """The Neo4j graph database in storedir."""
+
+    def __init__(self, storedir):
+        self._graphdb = neo4j.GraphDatabase(storedir)
+        self._local = threading.local()
+        self.node = NodeFactory(self)
+
+    @property
+    def reference_node(self):
+        return Node(self, self._graphdb.reference_node)
+
+    @property
+    def transaction(self):
+        return Transaction(self)
+
+    def shutdown(self):
+        self._graphdb.shutdown()
+
+    def _events(self):
+        state = self._local
+        try:
+            return state.events
+        except AttributeError:
+            state.events = backend.TransactionEvents(savepoints=False)
+            return state.events
+
+
+class Transaction(object):
+
+    def __init__(self, graphdb):
+        self.__graphdb = graphdb
+
+    def __enter__(self):
+        self.__native = self.__graphdb._graphdb.transaction
+        self.__native.__enter__()
+        self.__graphdb._events().begin()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        events = self.__graphdb._events()
+        try:
+            self.__native.__exit__(type, value, traceback)
+        except:
+            error = sys.exc_info()
+            for action in events.end(False):
+                action()
+            raise error[0], error[1], error[2]
+        for action in events.end(type is None):
+            action()
+        return False
+
+
+class NodeFactory(object):
+    """graphdb.node(**properties) creates a node, graphdb.node[id] gets one."""
+
+    def __init__(self, graphdb):
+        self.__graphdb = graphdb
+
+    def __call__(self, **properties):
+        graphdb = self.__graphdb
+        return Node(graphdb, graphdb._graphdb.node(**properties))
+
+    def __getitem__(self, id):
+        graphdb = self.__graphdb
+        return Node(graphdb, graphdb._graphdb.node[id])
+
+
+class Entity(object):
+
+    def __init__(self, graphdb, entity):
+        self._graphdb = graphdb
+        self._entity = entity
+
+    id = property(lambda self: self._entity.id)
+
+    def __eq__(self, other):
+        return isinstance(other, Entity) and self._entity == other._entity
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._entity)
+
+    def __getitem__(self, key):
+        return self._entity[key]
+
+    def get(self, key, default=None):
+        return self._entity.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._entity
+
+    def __setitem__(self, key, value):
+        self._entity[key] = value
+
+    def __delitem__(self, key):
+        del self._entity[key]
+
+    def keys(self):
+        return self._entity.keys()
+
+    def values(self):
+        return self._entity.values()
+
+    def items(self):
+        return self._entity.items()
+
+
+class Node(Entity):
+
+    def __getattr__(self, type):
+        if type.startswith('_'): raise AttributeError(type)
+        return Relationships(self, type)
+
+    def __repr__(self):
+        return '<Node %d>' % (self.id,)
+
+    def delete(self):
+        self._entity.delete()
+
+
+class Relationship(Entity):
+
+    type = property(lambda self: self._entity.type)
+    start = property(lambda self: Node(self._graphdb, self._entity.start))
+    end = property(lambda self: Node(self._graphdb, self._entity.end))
+
+    def __repr__(self):
+        return '<Relationship %d %r->%r>' % (self.id, self.start, self.end)
+
+    def delete(self):
+        self._entity.delete()
+
+
+class Relationships(object):
+    """The relationships of one type of a node, node.TYPE.
+    Calling it creates a new relationship from the node to another node."""
+
+    def __init__(self, node, type, outgoing=True, incoming=True):
+        self.__node = node
+        self.__type = type
+        self.__outgoing = outgoing
+        self.__incoming = incoming
+
+    def __native(self):
+        rels = getattr(self.__node._entity, self.__type)
+        if not self.__incoming:
+            return rels.outgoing
+        if not self.__outgoing:
+            return rels.incoming
+        return rels
+
+    def __call__(self, other, **properties):
+        node = self.__node
+        return Relationship(node._graphdb, getattr(node._entity, self.__type)(
+                other._entity, **properties))
+
+    @property
+    def outgoing(self):
+        return Relationships(self.__node, self.__type, incoming=False)
+
+    @property
+    def incoming(self):
+        return Relationships(self.__node, self.__type, outgoing=False)
+
+    def __iter__(self):
+        graphdb = self.__node._graphdb
+        for rel in self.__native():
+            yield Relationship(graphdb, rel)
+
+    @property
+    def single(self):
+        rels = list(self)
+        if not rels:
+            return None
+        if len(rels) > 1:
+            raise ValueError("More than one %s relationship on %r" %
+                             (self.__type, self.__node))
+        return rels[0]
+
+
+def traverse(traversal):
+    """Run a shop.backend.Traversal as a native Neo4j traversal."""
+    cls = type(traversal)
+    native = __traversals.get(cls)
+    if native is None:
+        def __init__(self, traversal):
+            self.traversal = traversal
+            neo4j.Traversal.__init__(self, traversal.start._entity)
+        def isReturnable(self, pos):
+            return self.traversal.isReturnable(pos)
+        def isStopNode(self, pos):
+            return self.traversal.isStopNode(pos)
+        directions = {backend.Outgoing: neo4j.Outgoing,
+                      backend.Incoming: neo4j.Incoming}
+        if cls.order == backend.BREADTH_FIRST:
+            order = neo4j.BREADTH_FIRST
+        else:
+            order = neo4j.DEPTH_FIRST
+        native = type(neo4j.Traversal)(cls.__name__, (neo4j.Traversal,), dict(
+                types=[getattr(directions[direction], type)
+                       for type, direction in cls.types],
+                order=order,
+                __init__=__init__,
+                isReturnable=isReturnable,
+                isStopNode=isStopNode))
+        __traversals[cls] = native
+    graphdb = traversal.start._graphdb
+    for node in native(traversal):
+        yield Node(graphdb, node)
+
+
+def subreference(graphdb, type, properties):
+    return Node(graphdb, getattr(Subreference.Node, type)(graphdb._graphdb,
+                                                          **properties))
+
+
+def increment(node, key, delta, default):
+    # Writing a property takes the write lock of the node, the value read
+    # after it is the latest one and no other transaction changes it until
+    # this one ends
+    node[LOCK] = True
+    del node[LOCK]
+    value = node.get(key, default)
+    if value is None:
+        return None
+    node[key] = value = value + delta
+    return value
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the shop domain model.
+
+Each module in this package defines benchmark functions, decorated with
+benchmark(*sizes). A benchmark function is called with a fresh store, the
+data size and a timer, it prepares its data, runs the measured operations in
+a "with timer:" block and returns the number of operations it timed.
+
+Run the benchmarks with ``python shop --bench [NAME ...]``, where NAME is a
+benchmark module or module.function. The results can be written to a JSON
+file and compared against a baseline written by an earlier run.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import shutil
+import platform
+
+from timeit import default_timer
+
+try:
+    import json
+except ImportError: # Python < 2.6
+    import simplejson as json
+
+from shop import Store
+
+__all__ = 'benchmark', 'Timer', 'run', 'compare',
+
+TOLERANCE = 0.2 # slowdown ratio that counts as a regression
+
+
+def benchmark(*sizes):
+    """Mark a function as a benchmark, to be run for each of the sizes."""
+    def decorator(function):
+        function.sizes = sizes
+        return function
+    return decorator
+
+
+class Timer(object):
+    """Accumulates the time spent in its with-blocks."""
+    def __init__(self):
+        self.elapsed = 0.0
+    def __enter__(self):
+        self.__start = default_timer()
+        return self
+    def __exit__(self, *exc_info):
+        self.elapsed += default_timer() - self.__start
+        return False
+
+
+def start(*args, **params):
+    results = run(params['store'], params['backend'], args,
+                  scale=params['scale'], repeat=params['repeat'])
+    document = dict(
+        timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        backend=params['backend'],
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        scale=params['scale'],
+        repeat=params['repeat'],
+        results=results)
+    if params['results']:
+        out = open(params['results'], 'w')
+        try:
+            json.dump(document, out, indent=2, sort_keys=True)
+        finally:
+            out.close()
+    if params['baseline']:
+        saved = open(params['baseline'])
+        try:
+            baseline = json.load(saved)
+        finally:
+            saved.close()
+        print("\nCompared to %s:" % (params['baseline'],))
+        try:
+            regressions = compare(baseline, document)
+        except ValueError:
+            print(sys.exc_info()[1])
+            sys.exit(1)
+        if regressions:
+            sys.exit(1)
+
+
+def benchmarks(names=()):
+    """Yield (name, function) for the selected benchmarks, all by default."""
+    if not names:
+        names = sorted(filename[:-3] for filename in
+                       os.listdir(os.path.dirname(__file__))
+                       if filename.endswith('.py')
+                       and not filename.startswith('_'))
+    for name in names:
+        module, _, function = name.partition('.')
+        environ = {}
+        exec("from shop.bench import %s as module" % (module,), environ)
+        module = environ['module']
+        if function:
+            yield name, getattr(module, function)
+        else:
+            for function in sorted(dir(module)):
+                value = getattr(module, function)
+                if hasattr(value, 'sizes') and not function.startswith('_'):
+                    yield '%s.%s' % (name, function), value
+
+
+def run(storedir, backend, names=(), scale=1.0, repeat=3):
+    """Run the benchmarks, print and return their results."""
+    storedir = os.path.join(storedir, 'bench')
+    results = []
+    for name, function in benchmarks(names):
+        for size in function.sizes:
+            size = max(1, int(size * scale))
+            times = []
+            for i in range(repeat):
+                if os.path.exists(storedir):
+                    shutil.rmtree(storedir)
+                store = Store(storedir, backend=backend)
+                try:
+                    timer = Timer()
+                    operations = function(store, size, timer)
+                finally:
+                    store.close()
+                times.append(timer.elapsed)
+            best = min(times)
+            result = dict(name=name, size=size, operations=operations,
+                          best=best, mean=sum(times) / len(times),
+                          ops_per_sec=best and operations / best)
+            print('%-45s %9d  best %9.4fs  %12.1f ops/s' % (
+                    name, size, best, result['ops_per_sec']))
+            results.append(result)
+    return results
+
+
+def compare(baseline, current, tolerance=TOLERANCE):
+    """Print a comparison of two benchmark documents, by best time, and the
+    results of the baseline that the current document does not have.
+    Return the list of (name, size) that regressed by more than tolerance.
+    Raises ValueError if the documents were run at different scales, since
+    the sizes of their results do not match then."""
+    scales = baseline.get('scale', 1.0), current.get('scale', 1.0)
+    if scales[0] != scales[1]:
+        raise ValueError("The baseline was run at scale %s, not at %s, "
+                         "the results cannot be compared" % scales)
+    before = dict(((result['name'], result['size']), result)
+                  for result in baseline['results'])
+    regressions = []
+    for result in current['results']:
+        key = result['name'], result['size']
+        old = before.pop(key, None)
+        if old is None:
+            status, ratio = 'new', ''
+        else:
+            ratio = old['best'] and result['best'] / old['best']
+            if ratio > 1 + tolerance:
+                status = 'REGRESSION'
+                regressions.append(key)
+            elif ratio < 1 - tolerance:
+                status = 'faster'
+            else:
+                status = 'ok'
+            ratio = '%6.2fx' % (ratio,)
+        print('%-45s %9d  %7s  %s' % (key + (ratio, status)))
+    for key in sorted(before):
+        print('%-45s %9d  %7s  %s' % (key + ('', 'missing')))
+    return regressions
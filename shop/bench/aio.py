@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of shop.aio under concurrent load.
+"""
+
+from __future__ import with_statement
+
+import threading
+
+from shop.aio import AsyncStore
+from shop.bench import benchmark
+from shop.bench.model import _tree
+
+LISTINGS = 4 # concurrent listings of the whole tree
+LOOKUPS = 200 # timed lookups while the listings run
+
+
+def _latency(chunk_size):
+    """Make a benchmark that times category lookups, one at a time, while
+    LISTINGS listings of all products run on the same AsyncStore, reading
+    chunk_size products per task. The operations per second are the inverse
+    of the mean lookup latency."""
+    @benchmark(10000, 50000)
+    def latency(store, size, timer):
+        goods = _tree(store, size)
+        aio = AsyncStore(store, chunk_size=chunk_size or size)
+        done = threading.Event()
+        def drain(listing):
+            listing.next_chunk().add_done_callback(
+                lambda chunk: chunk.result() and not done.isSet()
+                and drain(listing))
+        try:
+            for i in range(LISTINGS):
+                drain(aio.products(goods))
+            for i in xrange(LOOKUPS):
+                with timer:
+                    aio.category("Leaf %d.%d" % (i % 10, i // 10 % 10)).result()
+        finally:
+            done.set()
+            aio.close()
+        return LOOKUPS
+    latency.__doc__ = "Time lookups during listings of %s products per " \
+        "task." % (chunk_size or "all",)
+    return latency
+
+lookup_latency_chunked = _latency(100)
+lookup_latency_unchunked = _latency(None)
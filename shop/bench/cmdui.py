@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the script mode of the command line UI in shop.cmdui.
+"""
+
+from __future__ import with_statement
+
+from shop.bench import benchmark
+from shop.cmdui import CommandLineUi
+
+
+def _script(group_size):
+    @benchmark(1000, 10000)
+    def bench(store, size, timer):
+        ui = CommandLineUi(store)
+        with store.graphdb.transaction:
+            name = store.attribute.type("Name")
+            weight = store.attribute.type("Weight")
+            ui.category = store.categories(
+                "Scripted", Name=store.attribute(name),
+                Weight=store.attribute(weight))
+        script = ['make product Name:"Product %d" Weight:%d' % (i, i % 50)
+                  for i in xrange(size)]
+        with timer:
+            ui.run_script(script, group_size)
+        return size
+    return bench
+
+script_group_1 = _script(1)
+script_group_1000 = _script(1000)
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the operations of the domain model in shop.model.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import threading
+
+from shop import model, schema
+from shop.bench import benchmark
+
+
+def _schema(store):
+    """Define a small product schema and return a category using it."""
+    with store.graphdb.transaction:
+        name = store.attribute.type("Name")
+        currency = store.attribute.type("Currency", Unit="USD")
+        weight = store.attribute.type("Weight", Unit="Kg")
+        return store.categories("Goods", Name=store.attribute(name),
+                                Price=store.attribute(currency),
+                                Weight=store.attribute(weight, default=1.0))
+
+
+def _products(category, count, rand):
+    with category.graphdb.transaction:
+        for i in xrange(count):
+            category.new_product(Name="Product %d" % (i,),
+                                 Price=round(rand.uniform(1, 5000), 2),
+                                 Weight=round(rand.uniform(0.1, 50), 1))
+
+
+def _tree(store, size, fanout=10):
+    """Create a category tree with size products spread over its leaves."""
+    goods = _schema(store)
+    rand = random.Random(size)
+    with store.graphdb.transaction:
+        leaves = []
+        for i in range(fanout):
+            group = goods.new_subcategory("Group %d" % (i,))
+            for j in range(fanout):
+                leaves.append(group.new_subcategory("Leaf %d.%d" % (i, j)))
+    for i, leaf in enumerate(leaves):
+        _products(leaf, size // len(leaves) + (i < size % len(leaves)), rand)
+    return goods
+
+
+@benchmark(100, 1000)
+def new_subcategory_wide(store, size, timer):
+    goods = _schema(store)
+    with timer:
+        for i in xrange(size):
+            goods.new_subcategory("Sub %d" % (i,))
+    return size
+
+
+@benchmark(50, 200)
+def new_subcategory_deep(store, size, timer):
+    category = _schema(store)
+    with timer:
+        for i in xrange(size):
+            category = category.new_subcategory("Level %d" % (i,))
+    return size
+
+
+@benchmark(1000, 10000)
+def new_product(store, size, timer):
+    goods = _schema(store)
+    with timer:
+        _products(goods, size, random.Random(size))
+    return size
+
+
+@benchmark(1000, 10000)
+def bulk_new_products(store, size, timer):
+    goods = _schema(store)
+    rand = random.Random(size)
+    products = (dict(Name="Product %d" % (i,),
+                     Price=round(rand.uniform(1, 5000), 2),
+                     Weight=round(rand.uniform(0.1, 50), 1))
+                for i in xrange(size))
+    with timer:
+        created, rejected = goods.bulk_new_products(products)
+    assert created == size, (created, rejected)
+    return size
+
+
+@benchmark(1000, 10000)
+def iterate_subtree(store, size, timer):
+    goods = _tree(store, size)
+    with timer:
+        with store.graphdb.transaction:
+            count = len(list(goods))
+    assert count == size, (count, size)
+    return size
+
+
+@benchmark(1000, 10000, 100000)
+def filter_selective(store, size, timer):
+    """Run 20 queries that each match about 1% of the products, the first
+    one builds the value indexes."""
+    goods = _tree(store, size)
+    with timer:
+        with store.graphdb.transaction:
+            for i in range(20):
+                low = 50 * i
+                list(goods.filter(Price__between=(low, low + 50)))
+    return 20
+
+
+@benchmark(1000, 10000)
+def paginate_subtree(store, size, timer):
+    """Page through a subtree, 50 products per page."""
+    goods = _tree(store, size)
+    count, cursor = 0, None
+    with timer:
+        while True:
+            page, cursor = goods.products(50, after=cursor)
+            count += len(page)
+            if cursor is None: break
+    assert count == size, (count, size)
+    return size
+
+
+@benchmark(100, 1000)
+def categories_lookup(store, size, timer):
+    goods = _schema(store)
+    with store.graphdb.transaction:
+        names = ["Sub %d" % (i,) for i in xrange(size)]
+        for name in names:
+            goods.new_subcategory(name)
+    random.Random(size).shuffle(names)
+    with timer:
+        for name in names:
+            store.categories[name]
+    return size
+
+
+@benchmark(100, 1000, 5000)
+def category_getitem(store, size, timer):
+    goods = _schema(store)
+    with store.graphdb.transaction:
+        names = ["Sub %d" % (i,) for i in xrange(size)]
+        for name in names:
+            goods.new_subcategory(name)
+    random.Random(size).shuffle(names)
+    with timer:
+        with store.graphdb.transaction:
+            for name in names:
+                goods[name]
+    return size
+
+
+@benchmark(1000, 10000)
+def product_str(store, size, timer):
+    goods = _tree(store, size)
+    with store.graphdb.transaction:
+        products = list(goods)
+    with timer:
+        with store.graphdb.transaction:
+            for product in products:
+                str(product)
+    return size
+
+
+@benchmark(10000, 100000)
+def list_category(store, size, timer):
+    """Render every product of one category, like the list command."""
+    goods = _schema(store)
+    _products(goods, size, random.Random(size))
+    with timer:
+        with store.graphdb.transaction:
+            for product in goods:
+                str(product)
+    return size
+
+
+@benchmark(100, 500)
+def attribute_type_create(store, size, timer):
+    with timer:
+        for i in xrange(size):
+            store.attribute.type("Type %d" % (i,))
+    return size
+
+
+@benchmark(100, 500, 5000)
+def define_types(store, size, timer):
+    with timer:
+        store.attribute.type.define_types(
+            [("Type %d" % (i,), {'Unit': 'u'}) for i in xrange(size)])
+    return size
+
+
+@benchmark(10000, 100000)
+def to_columns(store, size, timer):
+    """Take a column snapshot of a subtree and sum a column of it."""
+    goods = _tree(store, size)
+    with timer:
+        columns = goods.to_columns(['Price', 'Weight'])
+        sum(columns['Price'])
+    assert len(columns) == size, (len(columns), size)
+    return size
+
+
+@benchmark(1000, 10000)
+def count_products(store, size, timer):
+    """Count the products of every category of a tree."""
+    goods = _tree(store, size)
+    with store.graphdb.transaction:
+        categories = [goods] + list(store.categories)
+    with timer:
+        for category in categories:
+            category.count_products()
+    assert goods.count_products() == size
+    return len(categories)
+
+
+@benchmark(10000, 100000)
+def list_category_prefetched(store, size, timer):
+    """Render every product of one category, prefetched in batches."""
+    goods = _schema(store)
+    _products(goods, size, random.Random(size))
+    with timer:
+        with store.graphdb.transaction:
+            for product in goods.prefetched():
+                str(product)
+    return size
+
+
+def _ingest(workers):
+    """Make a benchmark of workers threads that each create a subcategory
+    and their share of the products in it, 100 products per transaction."""
+    @benchmark(2000, 20000)
+    def ingest(store, size, timer):
+        goods = _schema(store)
+        failures = []
+        def work(number, count):
+            try:
+                category = goods.new_subcategory("Worker %d" % (number,))
+                rand = random.Random(number)
+                while count > 0:
+                    _products(category, min(count, 100), rand)
+                    count -= 100
+            except Exception:
+                failures.append(sys.exc_info())
+        threads = [threading.Thread(target=work, args=(
+                    i, size // workers + (i < size % workers)))
+                   for i in range(workers)]
+        with timer:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert not failures, failures[0]
+        assert goods.count_products() == size, goods.count_products()
+        return size
+    ingest.__doc__ = "Create products from %d threads." % (workers,)
+    return ingest
+
+ingest_threads_1 = _ingest(1)
+ingest_threads_2 = _ingest(2)
+ingest_threads_4 = _ingest(4)
+ingest_threads_8 = _ingest(8)
+
+
+def _scan(workers):
+    """Make a benchmark that renders every product of a tree from workers
+    threads with Store.scan."""
+    @benchmark(10000, 100000)
+    def scan(store, size, timer):
+        goods = _tree(store, size)
+        with timer:
+            count = len(list(store.scan(str, workers, category=goods)))
+        assert count == size, (count, size)
+        return size
+    scan.__doc__ = "Render the products of a tree from %d threads." % (
+        workers,)
+    return scan
+
+scan_workers_1 = _scan(1)
+scan_workers_4 = _scan(4)
+
+
+def _start(snapshot):
+    """Make a benchmark that looks up every category of a store with size
+    categories, after the model forgot them, with or without loading a
+    schema snapshot first."""
+    @benchmark(1000, 10000)
+    def start(store, size, timer):
+        goods = _schema(store)
+        names = []
+        with store.graphdb.transaction:
+            parents = [goods]
+            while len(names) < size:
+                parent = parents.pop(0)
+                for i in range(10):
+                    names.append("%s/%d" % (parent.name, i))
+                    parents.append(parent.new_subcategory(names[-1]))
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'schema.json')
+            schema.write_snapshot(store, path)
+            del parents, goods
+            model.forget(store.graphdb)
+            with timer:
+                if snapshot:
+                    schema.load_snapshot(store, path)
+                for name in names:
+                    store.categories[name].get_all_attributes()
+        finally:
+            shutil.rmtree(directory)
+        return len(names)
+    start.__doc__ = "Look up all categories after a start %s a snapshot." % (
+        snapshot and "with" or "without",)
+    return start
+
+cold_start = _start(False)
+warm_start = _start(True)
+
+
+def _profiled(profiled):
+    @benchmark(1000)
+    def bench(store, size, timer):
+        from shop.instrument import Profile
+        category = _schema(store)
+        rand = random.Random(42)
+        products = [dict(Name="Product %d" % (i,),
+                         Price=round(rand.uniform(1, 5000), 2))
+                    for i in xrange(size)]
+        profile = Profile()
+        if profiled:
+            profile.start()
+        try:
+            with timer:
+                for values in products:
+                    category.new_product(**values)
+        finally:
+            profile.stop()
+        return size
+    return bench
+
+new_product_unprofiled = _profiled(False)
+new_product_profiled = _profiled(True)
+
+
+@benchmark(10000, 100000)
+def search_prefix(store, size, timer):
+    category = _schema(store)
+    rand = random.Random(size)
+    colors = 'red green blue black white silver golden'.split()
+    things = 'chair table lamp desk shelf sofa bed cabinet mirror rug'.split()
+    category.bulk_new_products(
+        dict(Name="%s %s %d" % (rand.choice(colors), rand.choice(things), i),
+             Price=1.0)
+        for i in xrange(size))
+    store.search("load the index")
+    queries = ['r', 'gre', 'silver', 'blu lam', 'black sofa',
+               'white mirror 1', 'golden rug 99', 'cab', 'desk 123', 'sh']
+    with timer:
+        for query in queries:
+            store.search(query, limit=10)
+    return len(queries)
+
+
+def _dump_restore(compress):
+    @benchmark(10000)
+    def bench(store, size, timer):
+        from StringIO import StringIO
+        from shop import Store
+        category = _schema(store)
+        _products(category, size, random.Random(size))
+        dumped = StringIO()
+        target = Store(None, backend='memory')
+        try:
+            with timer:
+                store.dump(dumped, compress)
+                dumped.seek(0)
+                target.restore(dumped)
+        finally:
+            target.close()
+        return size
+    return bench
+
+dump_restore_plain = _dump_restore(False)
+dump_restore_gzip = _dump_restore(True)
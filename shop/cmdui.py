@@ -7,10 +7,22 @@ from __future__ import with_statement
 
 import cmd
 import sys
+import os
 import re
+import time
 
-from shop import Store
-from shop.model import Attribute
+from itertools import islice
+from StringIO import StringIO
+
+from shop import Store, model, backend
+from shop.model import Attribute, Category
+from shop.instrument import Profile, current
+from shop.importer import import_products, READERS
+
+DEFAULT_GROUP_SIZE = 1000 # script commands per transaction
+
+class _CommandFailed(Exception):
+    """Rolls back the group of script commands of a failed command."""
 
 class CommandLineUi(cmd.Cmd):
     def __init__(self, store):
@@ -18,6 +30,7 @@ class CommandLineUi(cmd.Cmd):
         self.store = store
         self.prompt = "%s> " % (store.name,)
         self.category = store.root
+        self.profile = None
 
     def help_help(self):
         print("""With no arguments help lists all available commands,
@@ -36,15 +49,189 @@ If a command is given as an argument the help for that command is displayed.""")
     def emptyline(self):
         pass
 
+    def run_script(self, lines, group_size=DEFAULT_GROUP_SIZE, progress=None):
+        """Run the commands in lines, without prompts, group_size commands
+        per transaction. A command that fails is reported with its line
+        number and the script goes on: its group is rolled back, the commands
+        of the group before it are run again and committed, and a new group
+        starts after it. If progress is given, a file, the number of lines
+        run so far is written to it about once a second. exit ends the
+        script. Returns the number of lines read."""
+        lines = enumerate(lines)
+        done = 0
+        start = shown = time.time()
+        while True:
+            state = self.category, self.page
+            succeeded = []
+            group, stopped, failed = 0, False, False
+            try:
+                with self.store.graphdb.transaction:
+                    for number, line in islice(lines, group_size):
+                        group += 1
+                        line = line.strip()
+                        if not line or line.startswith('#'): continue
+                        if line in ('exit', 'EOF'):
+                            stopped = True
+                            break
+                        if not self.__run_line(number + 1, line):
+                            raise _CommandFailed
+                        succeeded.append((number + 1, line))
+            except _CommandFailed:
+                failed = True
+                self.category, self.page = state
+                self.__replay(succeeded)
+            done += group
+            finished = stopped or (group < group_size and not failed)
+            if progress is not None and (finished or
+                                         time.time() - shown >= 1.0):
+                shown = time.time()
+                elapsed = shown - start
+                progress.write("%d lines, %.1f s, %.0f lines/s\n" % (
+                        done, elapsed, elapsed and done / elapsed))
+                progress.flush()
+            if finished:
+                return done
+
+    __line = None # the number of the script line that runs
+    __failed = False
+    def __run_line(self, number, line):
+        """Run the command of a script line, tell if it succeeded and left
+        the transaction of its group open for more commands."""
+        self.__line, self.__failed = number, False
+        try:
+            try:
+                self.onecmd(line)
+            except Exception:
+                self._report(sys.exc_info()[1])
+        finally:
+            self.__line = None
+        return not (self.__failed or
+                    backend.rollback_only(self.store.graphdb))
+
+    def __replay(self, commands):
+        """Run the (line number, command) pairs of a rolled back group again,
+        without output, and commit them."""
+        if not commands: return
+        output = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            with self.store.graphdb.transaction:
+                for number, line in commands:
+                    if not self.__run_line(number, line):
+                        raise RuntimeError("line %d failed when it was run "
+                                           "again" % (number,))
+        finally:
+            sys.stdout = output
+
+    def _report(self, error):
+        """Print the error of a command, and mark the command as failed."""
+        self.__failed = True
+        if self.__line is None:
+            print("ERROR: %s: %s" % (type(error).__name__, error))
+        else:
+            print("line %d: %s: %s" % (self.__line, type(error).__name__,
+                                       error))
+
     def default(self, line):
         command, args, line = self.parseline(line)
         print("unknown command: %s" % command)
 
     def do_list(self, line):
-        "list all available products in the current category"
-        with self.store.graphdb.transaction:
-            for product in self.category:
-                print(product)
+        """List all available products in the current category.
+        With a number as parameter list only that many products, and
+        continue with the next page of products with the 'more' command.
+        """
+        self.page = None
+        if line.strip():
+            try:
+                size = int(line)
+                if size < 1: raise ValueError
+            except ValueError:
+                print("USAGE: list [<page size>]")
+            else:
+                self.page = self.category, size, None
+                self.do_more()
+        else:
+            with self.store.graphdb.transaction:
+                for product in self.category.prefetched():
+                    print(product)
+
+    def do_find(self, line):
+        """Find the products in the current category with matching attributes.
+        The parameters are <key>[__<op>]:<value> conditions, where op is one
+        of eq, lt, lte, gt, gte, between or in. The values of between and in
+        are separated by commas, in quotes. Values that look like numbers are
+        compared as numbers.
+        """
+        try:
+            conditions = self._make_attributes(line)
+        except ValueError:
+            print("USAGE: find <key>[__<op>]:<value> ...")
+            return
+        for key, value in conditions.items():
+            if key.endswith('__between') or key.endswith('__in'):
+                conditions[key] = tuple(map(self._find_value, value.split(',')))
+            else:
+                conditions[key] = self._find_value(value)
+        try:
+            with self.store.graphdb.transaction:
+                found = self.category.filter(**conditions)
+                for product in model.prefetch(found):
+                    print(product)
+        except ValueError:
+            _,val,_ = sys.exc_info()
+            print(val)
+
+    def do_search(self, line):
+        """Search the current category and its subcategories for categories
+        and products with names or text values that have words starting with
+        the given words. The best matches are listed first. Give a number
+        before the words to list that many matches, 20 by default.
+        """
+        words = line.split()
+        limit = 20
+        if words and words[0].isdigit():
+            limit = int(words.pop(0))
+        if not words:
+            print("USAGE: search [<limit>] <words>")
+            return
+        category = self.category
+        if category is self.store.root:
+            category = None
+        found = self.store.search(" ".join(words), category, limit)
+        model.prefetch([result for result in found
+                  if not isinstance(result, Category)])
+        for result in found:
+            if isinstance(result, Category):
+                print("category %s" % (result,))
+            else:
+                print("product  %s" % (result,))
+        if not found:
+            print("Nothing found.")
+
+    def _find_value(self, value):
+        for number in (int, float):
+            try:
+                return number(value)
+            except ValueError:
+                pass
+        return value
+
+    page = None # (category, page size, cursor) of the paged listing
+    def do_more(self, line=None):
+        "List the next page of products after 'list <page size>'."
+        if self.page is None:
+            print("No more products.")
+            return
+        category, size, cursor = self.page
+        products, cursor = category.products(size, after=cursor)
+        for product in model.prefetch(products):
+            print(product)
+        if cursor is None:
+            self.page = None
+        else:
+            self.page = category, size, cursor
+            print("-- more --")
 
     def do_cat(self, line=None):
         """Change the current category and list all subcategories.
@@ -62,9 +249,59 @@ If a command is given as an argument the help for that command is displayed.""")
                 except:
                     print("No such category %r" % (line,))
         else:
-            print("Current category: %s" % (self.category,))
+            print("Current category: %s (%d products, %d with subcategories)"
+                  % (self.category, self.category.count_products(False),
+                     self.category.count_products()))
             with self.store.graphdb.transaction:
-                self.columnize(map(str, self.category.categories))
+                self.columnize(["%s (%d)" % (category,
+                                             category.count_products())
+                                for category in self.category.categories])
+
+    def do_recount(self, line):
+        """Verify the product counts of all categories.
+        With the parameter 'repair' the wrong counts are corrected.
+        """
+        repair = line.strip() == 'repair'
+        if line.strip() and not repair:
+            print("USAGE: recount [repair]")
+            return
+        with self.store.graphdb.transaction:
+            wrong = self.store.root.verify_product_counts(repair)
+            for node, key, stored, actual in wrong:
+                print("%s: %s is %s, counted %d" % (node['Name'], key, stored,
+                                                    actual))
+        if wrong and repair:
+            print("Repaired %d counts." % (len(wrong),))
+        elif not wrong:
+            print("All counts are correct.")
+
+    def do_stats(self, line):
+        """Show the graph operations of the model calls profiled so far.
+        'stats on' starts profiling, 'stats off' stops it and 'stats reset'
+        clears the numbers. Profiling also runs with the --profile option.
+        """
+        command = line.strip()
+        profile = current()
+        if command == 'on':
+            if profile is None:
+                profile = self.profile = Profile().start()
+            print("Profiling the model calls.")
+        elif command == 'off':
+            if self.profile is not None:
+                self.profile.stop()
+                self.profile = None
+                print("Stopped profiling.")
+            elif profile is not None:
+                print("Profiling runs until the end for --profile.")
+        elif command == 'reset':
+            if profile is not None:
+                profile.stats.reset()
+        elif command:
+            print("USAGE: stats [on|off|reset]")
+        elif profile is None:
+            print("Not profiling, start with 'stats on'.")
+        else:
+            print(profile.stats.report())
 
     def do_sample(self, line):
         """Create an example set of data."""
@@ -126,20 +363,22 @@ If a command is given as an argument the help for that command is displayed.""")
             print("make %s:" % (maker,))
             print("    " + getattr(self, 'make_'+maker).__doc__)
 
-    _make_pattern = re.compile(r'^\s*(\w+):((?:"(?:[^"]*(?:\\")?)*")|(?:\w+))')
+    _make_pattern = re.compile(r'\s*(\w+):((?:"(?:[^"]*(?:\\")?)*")|(?:\w+))')
     def _make_attributes(self, line):
         attributes = {}
+        match = self._make_pattern.match
+        pos, end = 0, len(line.rstrip())
 
-        while line:
+        while pos < end:
             # There is a bug in Jython's re module that prevents the use of '"'
-            match = self._make_pattern.match(line)
-            if match is None: raise ValueError
+            found = match(line, pos)
+            if found is None: raise ValueError
 
-            key, value = match.groups()
+            key, value = found.groups()
             if value.startswith('"'): value = value[1:-1]
             attributes[key] = value
 
-            line = line[len(match.group()):].strip()
+            pos = found.end()
 
         return attributes
 
@@ -176,8 +415,8 @@ If a command is given as an argument the help for that command is displayed.""")
         """
         try:
             self.category.new_product(**attributes)
-        except:
-            import traceback; traceback.print_exc()
+        except Exception:
+            self._report(sys.exc_info()[1])
 
     def make_type(self, attributes):
         """Creates a new attribute type.
@@ -190,17 +429,58 @@ If a command is given as an argument the help for that command is displayed.""")
         try:
             self.store.attribute.type(name, **attributes)
         except TypeError:
-            _,val,_ = sys.exc_info()
-            print(val)
+            self._report(sys.exc_info()[1])
 
     _makers = tuple(name[5:] for name in dir() if name.startswith('make_'))
 
+    def do_import(self, line):
+        """Import products into the current category from a feed file.
+        The file extension gives the format of the feed: %s.
+        """
+        filename = line.strip()
+        format = os.path.splitext(filename)[1][1:].lower()
+        if format not in READERS:
+            print("USAGE: import <file>.(%s)" % ("|".join(sorted(READERS)),))
+            return
+        try:
+            feed = open(filename)
+        except IOError:
+            _,val,_ = sys.exc_info()
+            print(val)
+            return
+        def error(line, values, exception):
+            print("line %s: %s: %s" % (line, type(exception).__name__,
+                                       exception))
+        try:
+            created, rejected = import_products(self.store, feed, format,
+                                                self.category, errors=error)
+        finally:
+            feed.close()
+        print("Imported %d products, rejected %d." % (created, rejected))
+    do_import.__doc__ %= ", ".join(sorted(READERS))
+
     def do_types(self, line):
         "List all available attribute types."
         with self.store.graphdb.transaction:
             self.columnize(map(str, self.store.attribute.type))
 
 def start(*args, **params):
-    ui = CommandLineUi( Store(params['store']) )
-    ui.cmdloop()
-    
+    ui = CommandLineUi( Store(params['store'], backend=params['backend']) )
+    script = params.get('script')
+    try:
+        if script is None:
+            ui.cmdloop()
+        elif script == '-':
+            ui.run_script(sys.stdin,
+                          params.get('group_size') or DEFAULT_GROUP_SIZE,
+                          progress=sys.stderr)
+        else:
+            lines = open(script)
+            try:
+                ui.run_script(lines,
+                              params.get('group_size') or DEFAULT_GROUP_SIZE,
+                              progress=sys.stderr)
+            finally:
+                lines.close()
+    finally: # also on exit, which raises SystemExit
+        ui.store.close()
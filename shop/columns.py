@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Column oriented snapshots of the products in a category subtree.
+
+A snapshot reads the attribute values of all products in one walk over the
+category tree, straight from the product nodes, and stores them in compact
+columns, one per attribute, for aggregates over many products. The columns
+are NumPy arrays when NumPy is installed and array.array or list objects
+otherwise.
+"""
+
+from __future__ import with_statement
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from shop import model
+
+__all__ = 'Columns', 'to_columns',
+
+NAN = float('nan')
+
+
+class Columns(object):
+    """The products of a category subtree, column by column.
+
+    products   -- the node ids of the products.
+    categories -- the node ids of the category of each product.
+    values     -- the column of values of each attribute, by key. Numeric
+                  columns hold floats, with NaN where a value is missing,
+                  other columns hold the values themselves, or None.
+    missing    -- a column of flags for each attribute, by key, set where a
+                  product has neither a value nor a default for it.
+    """
+
+    def __init__(self, products, categories, values, missing):
+        self.products = products
+        self.categories = categories
+        self.values = values
+        self.missing = missing
+
+    def __len__(self):
+        return len(self.products)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def keys(self):
+        return self.values.keys()
+
+
+def to_columns(category, attrs=None, use_numpy=None):
+    """Take a Columns snapshot of the products in category and its
+    subcategories. attrs are the keys of the attributes to read, by default
+    those of the category. A product without a value gets the default of the
+    attribute in its own category. The columns are NumPy arrays if use_numpy
+    is true, or by default if NumPy is installed."""
+    graphdb = category.graphdb
+    if attrs is None:
+        attrs = [attr.key for attr in category.get_all_attributes()]
+    attrs = list(attrs)
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    products, categories = array('l'), array('l')
+    values = dict((key, array('d')) for key in attrs)
+    missing = dict((key, array('b')) for key in attrs)
+    with graphdb.transaction:
+        current = None
+        for cat, prod in category.product_nodes():
+            if cat is not current:
+                current = cat
+                defaults = dict((attr.key, attr.default)
+                                for attr in cat.get_all_attributes())
+                columns = [(key, missing[key], defaults.get(key))
+                           for key in attrs]
+                node_id = model.category_node(cat).id
+            products.append(prod.id)
+            categories.append(node_id)
+            for key, mask, default in columns:
+                column = values[key]
+                value = prod.get(key, default)
+                if value is None:
+                    mask.append(1)
+                    if isinstance(column, array):
+                        column.append(NAN)
+                    else:
+                        column.append(None)
+                    continue
+                mask.append(0)
+                if isinstance(column, array):
+                    if isinstance(value, (int, long, float)):
+                        column.append(value)
+                        continue
+                    # Not a number, keep the values of this column in a list
+                    column = values[key] = [None if flag else number
+                                            for number, flag
+                                            in zip(column, mask)]
+                column.append(value)
+    if use_numpy:
+        return Columns(_numpy(products, numpy.int_),
+                       _numpy(categories, numpy.int_),
+                       dict((key, _numpy(column, numpy.float64))
+                            for key, column in values.items()),
+                       dict((key, _numpy(mask, numpy.int8).astype(bool))
+                            for key, mask in missing.items()))
+    return Columns(products, categories, values, missing)
+
+
+def _numpy(column, dtype):
+    """Wrap an array.array column in a NumPy array without copying it, or
+    copy a list column into a NumPy array of objects."""
+    if not isinstance(column, array):
+        return numpy.array(column, dtype=object)
+    if not column:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.frombuffer(column, dtype=dtype)
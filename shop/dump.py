@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Dump a whole store to a stream of JSON lines and restore it from one.
+
+A dump holds, one JSON object per line, in this order:
+
+    {"format": 1, "store": NAME}
+    {"type": {"id": ID, "name": NAME, "unit": UNIT}}
+    {"category": {"id": ID, "name": NAME, "parent": ID or null,
+                  "attributes": [{"name": KEY, "type": ID,
+                                  "default": VALUE, "required": BOOL}, ...]}}
+    {"products": {"category": ID, "items": [{KEY: VALUE, ...}, ...]}}
+
+The ids are those of the nodes in the dumped store, they only tie the lines
+together. Categories come in pre-order, each after its parent, the root has
+no parent, and the products of a category come in chunks of up to
+chunk_size products per line, after their category. The lines are read and
+written one at a time, so memory use does not depend on the size of the
+catalogue, only on the size of the schema and of a chunk.
+"""
+
+from __future__ import with_statement
+
+import gzip
+
+try:
+    import json
+except ImportError: # Python < 2.6
+    import simplejson as json
+
+from shop import model
+
+__all__ = 'dump', 'restore',
+
+FORMAT = 1 # version of the layout of the dump
+DEFAULT_CHUNK_SIZE = 1000 # products per line
+GZIP_MAGIC = '\x1f\x8b'
+
+
+def dump(store, fileobj, compress=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write the attribute types, the categories and the products of store
+    to fileobj, gzip compressed if compress is true. The dump is read in one
+    transaction. Returns the number of products written."""
+    if compress:
+        out = gzip.GzipFile(fileobj=fileobj, mode='wb')
+    else:
+        out = fileobj
+    count = 0
+    try:
+        for record in records(store, chunk_size):
+            out.write(json.dumps(record, separators=(',', ':')))
+            out.write('\n')
+            if 'products' in record:
+                count += len(record['products']['items'])
+    finally:
+        if compress:
+            out.close() # ends the gzip stream, leaves fileobj open
+    return count
+
+
+def records(store, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the records of a dump of store, see dump."""
+    graphdb = store.graphdb
+    with graphdb.transaction:
+        yield dict(format=FORMAT, store=store.name)
+        for type in store.attribute.type:
+            node = model.type_node(type)
+            yield dict(type=dict(id=node.id, name=node['Name'],
+                                 unit=node.get('Unit', '')))
+        for node in model._preorder(model.category_node(store.root)):
+            parent = node.SUBCATEGORY.incoming.single
+            if parent is not None:
+                parent = parent.start.id
+            yield dict(category=dict(
+                    id=node.id, name=node['Name'], parent=parent,
+                    attributes=[dict(name=attr['Name'], type=attr.end.id,
+                                     default=attr.get('DefaultValue'),
+                                     required=attr.get('Required'))
+                                for attr in node.ATTRIBUTE]))
+            items = []
+            for rel in node.PRODUCT.outgoing:
+                items.append(dict(rel.end.items()))
+                if len(items) == chunk_size:
+                    yield dict(products=dict(category=node.id, items=items))
+                    items = []
+            if items:
+                yield dict(products=dict(category=node.id, items=items))
+
+
+def restore(store, fileobj, compressed=None, batch_size=1000, errors=None):
+    """Add the attribute types, categories and products of a dump in
+    fileobj to store. A gzip compressed dump is recognized if fileobj can
+    seek, otherwise pass compressed=True for one.
+
+    Attribute types and categories that the store has already, by name and
+    place in the tree, are used instead of creating them again, and their
+    attributes are left as they are. The products are created with
+    shop.model.bulk_new_products, in one transaction per batch_size
+    products; errors(index, values, exception) is called for each rejected
+    one. Returns the number of created and of rejected products."""
+    if compressed is None and hasattr(fileobj, 'seek'):
+        compressed = fileobj.read(2) == GZIP_MAGIC
+        fileobj.seek(0)
+    if compressed:
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    lines = (json.loads(line) for line in fileobj if line.strip())
+    try:
+        header = lines.next()
+    except StopIteration:
+        raise ValueError("The dump is empty")
+    if header.get('format') != FORMAT:
+        raise ValueError("Unsupported dump format: %r" %
+                         (header.get('format'),))
+    return model.bulk_new_products(store.graphdb,
+                                   _products(store, lines), batch_size,
+                                   errors)
+
+
+def _products(store, lines):
+    """Create the types and categories of the dump lines, in the order they
+    come in, and yield (category, values) for the products."""
+    types, categories = {}, {}
+    for line in lines:
+        if 'products' in line:
+            chunk = line['products']
+            category = categories[chunk['category']]
+            for values in chunk['items']:
+                yield category, dict((str(key), value)
+                                     for key, value in values.items())
+        elif 'category' in line:
+            category = line['category']
+            categories[category['id']] = _category(store, category, types,
+                                                   categories)
+        elif 'type' in line:
+            type = line['type']
+            types[type['id']] = store.attribute.type.get_or_create(
+                str(type['name']), Unit=type['unit'])
+        else:
+            raise ValueError("Unknown line in dump: %r" % (line,))
+
+
+def _category(store, category, types, categories):
+    """Get or create the Category of a category line of a dump."""
+    if category['parent'] is None:
+        return store.root
+    parent = categories[category['parent']]
+    name = str(category['name'])
+    try:
+        return parent[name]
+    except KeyError:
+        pass
+    attributes = {}
+    for attr in category['attributes']:
+        type = types[attr['type']]
+        options = dict(required=bool(attr['required']))
+        if attr['default'] is not None:
+            options['default'] = type.from_primitive_neo_value(
+                attr['default'])
+        attributes[str(attr['name'])] = store.attribute(type, **options)
+    return parent.new_subcategory(name, **attributes)
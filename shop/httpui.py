@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+This module serves the catalogue of a store as JSON over HTTP.
+
+    GET /categories                       the category tree
+    GET /categories/NAME                  a category and its attributes
+    GET /categories/NAME/products         a page of the products in a
+        ?limit=N&after=CURSOR             category and its subcategories
+
+Responses are cached in memory for the current generation of the store,
+which the end of every write transaction through the model changes (see
+shop.model.generation), so repeated reads do not touch the graph. The ETag
+of a response names the generation, a request of an existing path with a
+matching If-None-Match gets 304 Not Modified.
+"""
+
+from __future__ import with_statement
+
+import sys
+import time
+import urllib
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+try:
+    import json
+except ImportError: # Python < 2.6
+    import simplejson as json
+
+from shop import Store, model
+
+__all__ = 'Catalogue', 'ResponseCache', 'start',
+
+DEFAULT_CACHE_SIZE = 1000 # responses
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+
+class NotFound(KeyError):
+    pass
+
+
+class ResponseCache(object):
+    """Responses by request path, for one generation of the store. Getting
+    or putting a response of a new generation drops the cached ones."""
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self.__generation = None
+        self.__responses = {}
+        self.__lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.__responses)
+
+    def __use(self, generation):
+        if generation != self.__generation:
+            self.__generation = generation
+            self.__responses = {}
+
+    def get(self, path, generation):
+        with self.__lock:
+            self.__use(generation)
+            response = self.__responses.get(path)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    def put(self, path, generation, response):
+        with self.__lock:
+            self.__use(generation)
+            if len(self.__responses) >= self.size:
+                self.__responses = {}
+            self.__responses[path] = response
+
+
+class Catalogue(object):
+    """Builds the JSON responses for the requests of the HTTP UI."""
+
+    def __init__(self, store, cache_size=DEFAULT_CACHE_SIZE):
+        self.store = store
+        self.cache = ResponseCache(cache_size)
+        # Tell the responses of this process apart from those of earlier
+        # runs, the generations start over with each run
+        self.__epoch = '%x' % (int(time.time() * 1000),)
+
+    def etag(self, generation):
+        return '"%s-%d"' % (self.__epoch, generation)
+
+    def respond(self, path, etag=None):
+        """Get (status, headers, body) for a GET request of path."""
+        graphdb = self.store.graphdb
+        generation = model.generation(graphdb)
+        headers = {'ETag': self.etag(generation)}
+        # The path is only known to exist once it is cached or read
+        body = self.cache.get(path, generation)
+        if body is None:
+            try:
+                with graphdb.transaction:
+                    body = json.dumps(self.read(path), sort_keys=True)
+            except NotFound:
+                return self.error(404, sys.exc_info()[1].args[0])
+            except ValueError:
+                return self.error(400, str(sys.exc_info()[1]))
+            # Unless the store was written meanwhile
+            if model.generation(graphdb) == generation:
+                self.cache.put(path, generation, body)
+        if etag and headers['ETag'] in [tag.strip()
+                                        for tag in etag.split(',')]:
+            return 304, headers, ''
+        headers['Content-Type'] = 'application/json'
+        return 200, headers, body
+
+    def error(self, status, message):
+        return status, {'Content-Type': 'application/json'}, json.dumps(
+            dict(error=message))
+
+    def read(self, path):
+        """The object to send for a request of path."""
+        url = urlparse.urlsplit(path)
+        parts = [urllib.unquote(part) for part in url.path.split('/') if part]
+        query = dict(urlparse.parse_qsl(url.query))
+        if parts == ['categories']:
+            return self.tree(self.store.root)
+        if len(parts) == 2 and parts[0] == 'categories':
+            return self.category(self.lookup(parts[1]))
+        if len(parts) == 3 and parts[0] == 'categories' and \
+                parts[2] == 'products':
+            return self.products(self.lookup(parts[1]), query)
+        raise NotFound("No such resource: %s" % (url.path,))
+
+    def lookup(self, name):
+        if name == self.store.name:
+            return self.store.root
+        try:
+            return self.store.categories[name]
+        except KeyError:
+            raise NotFound("No such category: %s" % (name,))
+
+    def tree(self, category):
+        return dict(name=category.name,
+                    products=category.count_products(False),
+                    total=category.count_products(),
+                    subcategories=[self.tree(sub)
+                                   for sub in category.categories])
+
+    def category(self, category):
+        parent = category.parent
+        return dict(name=category.name,
+                    parent=parent is not category and parent.name or None,
+                    products=category.count_products(False),
+                    total=category.count_products(),
+                    subcategories=[sub.name for sub in category.categories],
+                    attributes=[dict(key=attr.key, type=type(attr).__name__,
+                                     unit=attr.get_unit(),
+                                     default=attr.default,
+                                     required=bool(attr.required))
+                                for attr in category.get_all_attributes()])
+
+    def products(self, category, query):
+        try:
+            limit = int(query.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            raise ValueError("limit must be a number")
+        limit = min(limit, MAX_PAGE_SIZE)
+        page, cursor = category.products(limit, after=query.get('after'))
+        products = []
+        for product in model.prefetch(page):
+            values = dict((attr.key, attr.__get__(product))
+                          for attr in product.all_attributes())
+            values['id'] = model.product_node(product).id
+            values['category'] = type(product).name
+            products.append(values)
+        return dict(products=products, next=cursor)
+
+
+class CatalogueRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        status, headers, body = self.server.catalogue.respond(
+            self.path, self.headers.get('If-None-Match'))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CatalogueServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, catalogue):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           CatalogueRequestHandler)
+        self.catalogue = catalogue
+
+
+def start(*args, **params):
+    store = Store(params['store'], backend=params['backend'])
+    server = CatalogueServer((params['host'], params['port']),
+                             Catalogue(store))
+    print("Serving %s on http://%s:%d/categories" % (
+            store.name, params['host'], params['port']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("bye.")
+    finally:
+        server.server_close()
+        store.close()
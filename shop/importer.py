@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Import products from catalogue feeds in CSV or JSON lines format.
+
+The feed is read as a stream and the products are created with
+shop.model.bulk_new_products, so memory use does not depend on the size of
+the feed. In CSV feeds the header row names the attributes, empty cells are
+left out of the product.
+"""
+
+import sys
+import csv
+
+try:
+    import json
+except ImportError: # Python < 2.6
+    import simplejson as json
+
+from shop import model
+
+__all__ = 'import_products', 'read_csv', 'read_jsonl',
+
+
+def read_csv(fileobj):
+    """Yield (line number, values) for each row of a CSV feed."""
+    reader = csv.DictReader(fileobj)
+    for row in reader:
+        yield reader.line_num, dict((key, value) for key, value in row.items()
+                                    if key is not None and value != '')
+
+
+def read_jsonl(fileobj):
+    """Yield (line number, values) for each line of a JSON lines feed.
+    A line that is not valid JSON gives its ValueError as values."""
+    for number, line in enumerate(fileobj):
+        line = line.strip()
+        if not line: continue
+        try:
+            values = json.loads(line)
+        except ValueError:
+            values = sys.exc_info()[1]
+        yield number + 1, values
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl, 'json': read_jsonl}
+
+
+def import_products(store, fileobj, format='csv', category=None,
+                    category_key=None, batch_size=1000, errors=None):
+    """Create the products of a feed.
+
+    The products are created in category, or, if category_key is given, in
+    the category named by that value of each product, which falls back to
+    category when a product has no such value.
+    errors(line, values, exception) is called for each rejected product.
+    Returns the number of created and of rejected products."""
+    read = READERS[format]
+    categories = {}
+    position = [None]
+    skipped = [0]
+
+    def skip(line, values, error):
+        skipped[0] += 1
+        if errors is not None:
+            errors(line, values, error)
+
+    def report(index, values, error):
+        if errors is not None:
+            errors(position[0], values, error)
+
+    def products():
+        for line, values in read(fileobj):
+            position[0] = line
+            if isinstance(values, Exception):
+                skip(line, None, values)
+                continue
+            target = category
+            if category_key is not None and category_key in values:
+                values = dict(values)
+                name = values.pop(category_key)
+                target = categories.get(name)
+                if target is None:
+                    try:
+                        target = categories[name] = store.categories[name]
+                    except KeyError:
+                        skip(line, values, sys.exc_info()[1])
+                        continue
+            if target is None:
+                skip(line, values, KeyError("No category for the product"))
+                continue
+            yield target, values
+
+    created, rejected = model.bulk_new_products(store.graphdb, products(),
+                                                batch_size, report)
+    return created, rejected + skipped[0]
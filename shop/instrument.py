@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Count the graph operations behind the calls into the model.
+
+A Profile records, for each high level operation of the model, such as
+Category.new_product or Category.products, how often it was called, the wall
+time spent in it and the graph operations it performed: transactions, node
+reads, relationship hops, property reads and writes and so on.
+
+    with Profile() as stats:
+        category.new_product(Name="...")
+    print(stats.report())
+
+The counts of a call include those of the calls it makes, the graph
+operations outside of any profiled call are counted for "(other)". Profiles
+record the calls from all threads.
+
+Nothing is hooked while no profile runs. Starting the first profile replaces
+the profiled methods of the model and of the graph classes of the loaded
+backends with counting wrappers, stopping the last one puts the originals
+back. Both backends have the same graph classes, the Neo4j backend wraps the
+native entities of the bindings in them.
+"""
+
+from __future__ import with_statement
+
+import sys
+import threading
+
+from types import GeneratorType
+from timeit import default_timer
+
+from shop import Store, model, backend
+
+__all__ = 'Profile', 'Stats', 'current',
+
+OTHER = '(other)' # graph operations outside of the profiled calls
+
+COUNTERS = ('transactions', 'node reads', 'nodes created',
+            'relationship hops', 'relationships created', 'traversal steps',
+            'property reads', 'property writes', 'deletes')
+
+
+class Operation(object):
+    """The calls of one operation: calls, time (in seconds, including the
+    time of iterating a returned generator) and counts, by counter."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.time = 0.0
+        self.counts = {}
+
+    def __repr__(self):
+        return '<Operation %s calls=%d time=%.6f>' % (self.name, self.calls,
+                                                      self.time)
+
+
+class Stats(object):
+    """The operations recorded by a Profile, by name."""
+
+    def __init__(self):
+        self.operations = {}
+
+    def __getitem__(self, name):
+        return self.operations[name]
+
+    def __contains__(self, name):
+        return name in self.operations
+
+    def __operation(self, name):
+        operation = self.operations.get(name)
+        if operation is None:
+            operation = self.operations[name] = Operation(name)
+        return operation
+
+    def _call(self, name, elapsed, calls):
+        operation = self.__operation(name)
+        operation.calls += calls
+        operation.time += elapsed
+
+    def _count(self, name, counter, n):
+        counts = self.__operation(name).counts
+        counts[counter] = counts.get(counter, 0) + n
+
+    def reset(self):
+        self.operations = {}
+
+    def report(self):
+        """The recorded operations as text, the slowest first."""
+        lines = []
+        operations = sorted(self.operations.values(),
+                            key=lambda operation: -operation.time)
+        for operation in operations:
+            if operation.calls:
+                lines.append("%s: %d calls, %.4f s (%.3f ms per call)" % (
+                        operation.name, operation.calls, operation.time,
+                        operation.time * 1000 / operation.calls))
+            else:
+                lines.append("%s:" % (operation.name,))
+            counts = ["%s %d" % (counter, operation.counts[counter])
+                      for counter in COUNTERS if counter in operation.counts]
+            if counts:
+                lines.append("    " + ", ".join(counts))
+        if not lines:
+            return "No operations recorded."
+        return "\n".join(lines)
+
+
+class Profile(object):
+    """Records the model calls while it runs, between start() and stop() or
+    in a with statement, which gives the Stats."""
+
+    def __init__(self):
+        self.stats = Stats()
+
+    running = property(lambda self: self in _profiles)
+
+    def start(self):
+        with _lock:
+            if self not in _profiles:
+                if not _profiles:
+                    _install()
+                _profiles.append(self)
+        return self
+
+    def stop(self):
+        with _lock:
+            if self in _profiles:
+                _profiles.remove(self)
+                if not _profiles:
+                    _uninstall()
+        return self
+
+    def __enter__(self):
+        return self.start().stats
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+        return False
+
+
+def current():
+    """The most recently started Profile that still runs, or None."""
+    with _lock:
+        if _profiles:
+            return _profiles[-1]
+
+
+_lock = threading.RLock()
+_profiles = []
+_installed = []
+_local = threading.local()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def _record(name, elapsed, calls=1):
+    stack = _stack()
+    if name in stack: # time the outermost of recursive calls only
+        elapsed = 0.0
+    with _lock:
+        for profile in _profiles:
+            profile.stats._call(name, elapsed, calls)
+
+
+def _count(counter, n=1):
+    names = set(_stack()) or (OTHER,)
+    with _lock:
+        for profile in _profiles:
+            for name in names:
+                profile.stats._count(name, counter, n)
+
+
+def _operations():
+    """(name, owner, attribute) of the profiled calls of the model."""
+    categories = Store.__dict__['categories']
+    types = Store.__dict__['attribute'].__dict__['type']
+    operations = [('Category', model.Category, '__new__'),
+                  ('AttributeType', model.AttributeType, '__new__'),
+                  ('prefetch', model, 'prefetch'),
+                  ('Store.scan', Store, 'scan'),
+                  ('Store.categories[]', categories, '__getitem__'),
+                  ('Store.categories()', categories, '__call__'),
+                  ('Store.categories', categories, '__iter__'),
+                  ('Store.attribute.type[]', types, '__getitem__'),
+                  ('Store.attribute.type()', types, '__call__'),
+                  ('Store.attribute.type', types, '__iter__'),
+                  ('Store.attribute.type.define_types', types,
+                   'define_types')]
+    for name in ('__getitem__', 'new_subcategory', 'new_attribute',
+                 'new_product', 'delete_product', 'bulk_new_products',
+                 'count_products', 'verify_product_counts', '__iter__',
+                 'prefetched', 'product_nodes', 'products', 'filter',
+                 'to_columns'):
+        operations.append(('Category.%s' % (name,), model.Category, name))
+    return operations
+
+
+def _graph_operations():
+    """(counter, owner, attribute, wrap) of the hooked graph operations of
+    the loaded backends."""
+    operations = []
+    for name in sorted(backend.BACKENDS):
+        module = sys.modules.get(backend.BACKENDS[name])
+        if module is None: continue
+        operations.extend([
+            ('transactions', module.Transaction, '__enter__', _counted),
+            ('node reads', module.NodeFactory, '__getitem__', _counted),
+            ('nodes created', module.NodeFactory, '__call__', _counted),
+            ('relationship hops', module.Relationships, '__iter__',
+             _counted_items),
+            ('relationships created', module.Relationships, '__call__',
+             _counted),
+            ('traversal steps', module, 'traverse', _counted_items),
+            ('deletes', module.Node, 'delete', _counted),
+            ('deletes', module.Relationship, 'delete', _counted)])
+        for name in ('__getitem__', 'get', '__contains__', 'keys', 'values',
+                     'items'):
+            operations.append(('property reads', module.Entity, name,
+                               _counted))
+        for name in ('__setitem__', '__delitem__'):
+            operations.append(('property writes', module.Entity, name,
+                               _counted))
+    return operations
+
+
+def _install():
+    for name, owner, attribute in _operations():
+        _replace(owner, attribute, lambda function: _timed(name, function))
+    for counter, owner, attribute, wrap in _graph_operations():
+        _replace(owner, attribute, lambda function: wrap(counter, function))
+
+
+def _uninstall():
+    while _installed:
+        owner, attribute, original = _installed.pop()
+        setattr(owner, attribute, original)
+
+
+def _replace(owner, attribute, wrap):
+    original = vars(owner)[attribute]
+    if isinstance(original, staticmethod):
+        wrapper = staticmethod(wrap(original.__get__(None, owner)))
+    else:
+        wrapper = wrap(original)
+    _installed.append((owner, attribute, original))
+    setattr(owner, attribute, wrapper)
+
+
+def _wraps(wrapper, function):
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+def _timed(name, function):
+    def timed(*args, **kwargs):
+        stack = _stack()
+        start = default_timer()
+        stack.append(name)
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            stack.pop()
+            _record(name, default_timer() - start)
+        if isinstance(result, GeneratorType):
+            return _iterate(name, result)
+        return result
+    return _wraps(timed, function)
+
+
+def _iterate(name, generator):
+    """Count the time of producing the items of generator for name."""
+    stack = _stack()
+    while True:
+        start = default_timer()
+        stack.append(name)
+        try:
+            try:
+                item = generator.next()
+            except StopIteration:
+                return
+        finally:
+            stack.pop()
+            _record(name, default_timer() - start, calls=0)
+        yield item
+
+
+def _counted(counter, function):
+    def counted(*args, **kwargs):
+        _count(counter)
+        return function(*args, **kwargs)
+    return _wraps(counted, function)
+
+
+def _counted_items(counter, function):
+    """Count each item of the iterable returned by function."""
+    def counted(*args, **kwargs):
+        for item in function(*args, **kwargs):
+            _count(counter)
+            yield item
+    return _wraps(counted, function)
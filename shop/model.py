@@ -16,10 +16,24 @@ categories carry, and the data being the actual products in the categories.
 
 from __future__ import with_statement
 
+import sys
+import bisect
+import weakref
 import threading
-import neo4j
 
-__all__ = 'Product', 'Category', 'SubCategories', 'Attribute', #'AttributeType',
+from itertools import islice, chain
+
+from shop import backend
+
+__all__ = 'Product', 'Category', 'SubCategories', 'Attribute', 'prefetch', #'AttributeType',
+
+DEFAULT_CACHE_SIZE = 1000 # recently used categories kept in memory
+
+# Properties of category nodes that count their products
+PRODUCT_COUNT = 'ProductCount' # products directly in the category
+SUBTREE_PRODUCT_COUNT = 'SubtreeProductCount' # including subcategories
+# Property of the reference node that counts the changes of the schema
+SCHEMA_VERSION = 'SchemaVersion'
 
 
 class Product(object): # instance of Category
@@ -49,25 +63,52 @@ class Product(object): # instance of Category
     def product_node(self):
         return self.__node
 
+    __values = None # the properties of the node, if prefetched
+    global product_values # define here to get the name mangling right
+    def product_values(self):
+        """The prefetched properties of a product, or None."""
+        return self.__values
+
+    global prefetch # define here to get the name mangling right
+    def prefetch(products):
+        """Read all properties of each of the products, in one transaction,
+        and serve their attribute values from this snapshot instead of
+        reading the node for each attribute. Writes through the attributes
+        update the snapshot, other changes to the nodes are not seen until
+        the products are prefetched again. Returns the products as a list."""
+        products = list(products)
+        if products:
+            with type(products[0]).graphdb.transaction:
+                for product in products:
+                    product.__values = dict(product.__node.items())
+        return products
 
-class Category(type): # type of Product
-    __categories = {}
-    __create_lock = threading.RLock() # reentrant lock
 
+class Category(type): # type of Product
     graphdb = property(lambda self: self.__graphdb)
 
     def __init__(self, *args): pass # do nothing
 
     def __new__(Category, graphdb, node):
         """Lookup or create a Category representation for a Node."""
+        categories = identity_map(graphdb, 'categories')
         # If the Category instance already exists
-        self = Category.__categories.get(node.id)
+        self = categories.get(node.id)
         if self is None: # Otherwise create it
-            with Category.__create_lock: # Unless it was created concurrently
-                self = Category.__categories.get(node.id)
-                if self is not None: return self
+            with graphdb.transaction:
 
-                with graphdb.transaction:
+                # Get the parent category (the superclass of this category),
+                # before locking the node, so that no locks are nested
+                parent = node.SUBCATEGORY.incoming.single
+                if parent is None:
+                    parent = Product # The base Category type
+                else:
+                    parent = Category(graphdb, parent.start)
+
+                # Unless it was created concurrently
+                with node_lock(graphdb, node.id):
+                    self = categories.peek(node.id)
+                    if self is not None: return self
 
                     # Get the name of the category
                     name = node['Name']
@@ -75,46 +116,69 @@ class Category(type): # type of Product
                         name = name.encode('ascii')
 
                     # Get the attributes for products in the category
-                    attributes = dict(__new__=object.__new__)
+                    attributes = {}
                     for attr in node.ATTRIBUTE:
-                        # Get the Attribute type (instance of AttributeType)
-                        Attribute = AttributeType( graphdb, attr.end )
-                        # Instantiate the attribute
-                        attribute = Attribute( graphdb, attr['Name'],
-                                               attr.get('DefaultValue'),
-                                               attr.get('Required') )
                         # Add the attribute to the category instance dict
-                        attributes[ attr['Name'] ] = attribute
+                        attributes[ attr['Name'] ] = _attribute(graphdb, attr)
 
-                    # Get the parent category (the superclass of this category)
-                    parent = node.SUBCATEGORY.incoming.single
-                    if parent is None:
-                        parent = Product # The base Category type
-                    else:
-                        parent = Category(graphdb, parent.start)
-                    
-                    # Create a new type instance representing the Category
-                    self = type.__new__(Category, name, (parent,), attributes)
-                    self.__graphdb = graphdb
-                    self.__node = node
-                    Category.__categories[node.id] = self
+                    self = _define_category(graphdb, node, name, parent,
+                                            attributes)
 
         return self
 
+    global _define_category # define here to get the name mangling right
+    def _define_category(graphdb, node, name, parent, attributes):
+        """Create a new type instance representing the Category of node,
+        with the given name, parent Category and attributes, and add it to
+        the identity map. Also used to build categories from a schema
+        snapshot, without reading the graph."""
+        attributes = dict(attributes, __new__=object.__new__)
+        self = type.__new__(Category, name, (parent,), attributes)
+        self.__graphdb = graphdb
+        self.__node = node
+        identity_map(graphdb, 'categories').add(node.id, self)
+        return self
+
     global category_node # define here to get the name mangling right
     def category_node(self):
         return self.__node
 
     def get_all_attributes(self):
-        for name in dir(self):
-            value = getattr(self, name)
-            if isinstance(value, Attribute):
-                yield value
+        """The attributes of products in this category, including inherited
+        attributes, ordered by name. Computed once and cached, new_attribute
+        invalidates the cache."""
+        schema = self.__dict__.get('_Category__schema')
+        if schema is None:
+            attributes = {}
+            for cls in reversed(self.__mro__):
+                for name, value in vars(cls).items():
+                    if isinstance(value, Attribute):
+                        attributes[name] = value
+            schema = tuple(attributes[name] for name in sorted(attributes))
+            self.__schema = schema
+        return schema
+
+    global product_constructor # define here to get the name mangling right
+    def product_constructor(self):
+        """The function that converts and verifies the values of a new
+        product in this category, and returns its node properties, see
+        _constructor. Built on first use, new_attribute invalidates it."""
+        construct = self.__dict__.get('_Category__constructor')
+        if construct is None:
+            construct = _constructor(self.get_all_attributes())
+            self.__constructor = construct
+        return construct
+
+    def __invalidate_schema(self):
+        self.__schema = None
+        self.__constructor = None
+        for subcategory in self.__subclasses__():
+            subcategory.__invalidate_schema()
 
     def __str__(self):
         return self.name
 
-    @neo4j.transactional(graphdb)
+    @backend.transactional(graphdb)
     @property
     def name(self):
         return self.__node['Name']
@@ -128,41 +192,332 @@ class Category(type): # type of Product
             return self
 
     def __getitem__(self, name):
-        for rel in self.__node.SUBCATEGORY.outgoing:
-            node = rel.end
-            if node['Name'] == name:
-                break
-        else:
+        try:
+            node = self.__child_index()[name]
+        except KeyError:
             raise KeyError(name)
         return Category(self.graphdb, node)
 
+    def __child_index(self):
+        """Map the names of the subcategories to their nodes. The index is
+        built on first use and kept up to date by new_subcategory, also when
+        its transaction rolls back."""
+        children = self.__dict__.get('_Category__children')
+        if children is None:
+            with node_lock(self.graphdb, self.__node.id):
+                children = self.__dict__.get('_Category__children')
+                if children is None:
+                    children = {}
+                    with self.graphdb.transaction:
+                        for rel in self.__node.SUBCATEGORY.outgoing:
+                            node = rel.end
+                            children.setdefault(node['Name'], node)
+                    self.__children = children
+        return children
+
     def new_subcategory(self, name, **attributes):
         """Create a new sub category"""
-        with self.__create_lock:
-            with self.graphdb.transaction:
-                node = self.graphdb.node(Name=name)
-                self.__node.SUBCATEGORY(node)
-                for key, factory in attributes.items():
-                    factory(node, key)
-                return Category(self.graphdb, node)
+        with self.graphdb.transaction:
+            node = self.graphdb.node(Name=name)
+            node[PRODUCT_COUNT] = node[SUBTREE_PRODUCT_COUNT] = 0
+            self.__node.SUBCATEGORY(node)
+            for key, factory in attributes.items():
+                factory(node, key)
+            _schema_changed(self.graphdb)
+            category = Category(self.graphdb, node)
+            with node_lock(self.graphdb, self.__node.id):
+                children = self.__dict__.get('_Category__children')
+                if children is not None:
+                    children.setdefault(name, node)
+            names = name_index(self.graphdb, 'categories')
+            if names is not None:
+                names.add(name, node)
+            backend.after_rollback(self.graphdb,
+                                   lambda: self.__rolled_back(name, node))
+            index = text_index(self.graphdb)
+            if index is not None:
+                _after_commit(self.graphdb, [
+                        (index.add, node.id, node.id, dict(Name=name))])
+            changed(self.graphdb)
+        return category
+
+    def __rolled_back(self, name, node):
+        """Forget a new subcategory whose transaction rolled back."""
+        with node_lock(self.graphdb, self.__node.id):
+            children = self.__dict__.get('_Category__children')
+            if children is not None and children.get(name) is node:
+                del children[name]
+        names = name_index(self.graphdb, 'categories')
+        if names is not None:
+            names.discard([(name, node)])
+        identity_map(self.graphdb, 'categories').discard(node.id)
+        _graph_state(self.graphdb).value_indexes.pop(node.id, None)
+
+    def new_attribute(self, key, attribute):
+        """Add an attribute, created with Attribute(type, ...), to the
+        products in this category and its subcategories."""
+        with self.graphdb.transaction:
+            attr = attribute(self.__node, key)
+            _schema_changed(self.graphdb)
+            old = self.__dict__.get(key)
+            descriptor = _attribute(self.graphdb, attr)
+            setattr(self, key, descriptor)
+            self.__invalidate_schema()
+            backend.after_rollback(self.graphdb, lambda:
+                self.__attribute_rolled_back(key, descriptor, old))
+            changed(self.graphdb)
+
+    def __attribute_rolled_back(self, key, descriptor, old):
+        """Take back a new attribute whose transaction rolled back, and the
+        value indexes that may have been built for it."""
+        if self.__dict__.get(key) is descriptor:
+            if old is None:
+                delattr(self, key)
+            else:
+                setattr(self, key, old)
+        self.__invalidate_schema()
+        for indexes in _graph_state(self.graphdb).value_indexes.values():
+            indexes.pop(key, None)
 
     def new_product(self, **values):
         """Create a new product in this category"""
+        properties = product_constructor(self)(values)
         with self.graphdb.transaction:
             node = self.graphdb.node()
             self.__node.PRODUCT(node)
+            for key, value in properties.items():
+                node[key] = value
             product = self(self.graphdb, node)
-            for key, value in values.items():
-                getattr(self, key).__set__(product, value)
-            for attr in self.get_all_attributes():
-                attr.verify(product)
-            return product
+            _index_product(self, node, properties)
+            _count_products(self.graphdb, self.__node, 1)
+            changed(self.graphdb)
+        return product
+
+    def delete_product(self, product):
+        """Delete a product in this category or one of its subcategories."""
+        if not isinstance(product, self):
+            raise ValueError("%r is not a product in %s" % (product, self))
+        with self.graphdb.transaction:
+            node = product_node(product)
+            indexes = value_indexes(type(product))
+            if indexes:
+                _after_commit(self.graphdb, [
+                        (index.remove, node, node.get(key, index.default))
+                        for key, index in indexes.items()])
+            index = text_index(self.graphdb)
+            if index is not None:
+                _after_commit(self.graphdb, [(index.remove, node.id)])
+            rel = node.PRODUCT.single
+            category = rel.start
+            _drop_value_indexes_on_rollback(self.graphdb, category.id)
+            rel.delete()
+            node.delete()
+            _count_products(self.graphdb, category, -1)
+            changed(self.graphdb)
+
+    def count_products(self, subtree=True):
+        """The number of products in this category, including the products
+        in its subcategories if subtree is true. The counts are kept on the
+        category nodes, stores created without them count the products until
+        verify_product_counts(repair=True) has stored the counts."""
+        key = subtree and SUBTREE_PRODUCT_COUNT or PRODUCT_COUNT
+        with self.graphdb.transaction:
+            count = self.__node.get(key)
+            if subtree and count is not None:
+                count += _pending_counts(self.graphdb).get(
+                    self.__node.id, (None, 0))[1]
+            if count is None:
+                if subtree:
+                    nodes = _preorder(self.__node)
+                else:
+                    nodes = [self.__node]
+                count = 0
+                for node in nodes:
+                    count += len(list(node.PRODUCT.outgoing))
+            return count
+
+    def verify_product_counts(self, repair=False):
+        """Verify the product counts of this category and its subcategories,
+        see verify_product_counts in this module."""
+        return verify_product_counts(self.graphdb, self.__node, repair)
+
+    def bulk_new_products(self, products, batch_size=1000, errors=None):
+        """Create products in this category from an iterable of dicts of
+        attribute values, see bulk_new_products in this module."""
+        return bulk_new_products(self.graphdb,
+                                 ((self, values) for values in products),
+                                 batch_size, errors)
 
     def __iter__(self):
         """Iterating over a category yields all its products.
         This includes products in subcategories of this category."""
-        for prod in SubCategoryProducts(self.__node):
-            yield Product(self.graphdb, prod)
+        graphdb = self.graphdb
+        for category, prod in self.product_nodes():
+            yield category(graphdb, prod)
+
+    def prefetched(self, batch_size=100):
+        """Iterate over the products like iterating over the category, and
+        prefetch them in batches of batch_size products."""
+        products = iter(self)
+        while True:
+            batch = prefetch(islice(products, batch_size))
+            if not batch: break
+            for product in batch:
+                yield product
+
+    def product_nodes(self):
+        """Yield (category, product node) for all products in this category
+        and its subcategories. The products are read from the PRODUCT
+        relationships of each category, so the category of a product is known
+        without looking it up from the product node."""
+        graphdb = self.graphdb
+        for node in chain([self.__node], SubCategories(self.__node)):
+            category = Category(graphdb, node)
+            for rel in node.PRODUCT.outgoing:
+                yield category, rel.end
+
+    def products(self, limit=100, after=None):
+        """Get a page of at most limit products in this category and its
+        subcategories, as a list, and the cursor of the next page, or None if
+        there are no more products.
+
+        Pass the cursor as after to get the next page. A cursor names the last
+        product of a page, its category and its position in the category, and
+        the next page continues from there without reading the categories of
+        earlier pages or their products. The products of the category of the
+        cursor that come before it are still passed over one relationship at
+        a time, since the backends can only iterate the relationships of a
+        node from the start: a deep page of one large category costs reads
+        in proportion to its position in the category. Each page is read in a
+        transaction of its own."""
+        if limit < 1: raise ValueError("limit must be positive")
+        graphdb = self.graphdb
+        with graphdb.transaction:
+            pairs = self.__products_after(after)
+            categories = {}
+            page = []
+            for node, position, prod in islice(pairs, limit):
+                category = categories.get(node.id)
+                if category is None:
+                    category = categories[node.id] = Category(graphdb, node)
+                page.append(category(graphdb, prod))
+            if list(islice(pairs, 1)):
+                cursor = '%d:%d:%d' % (node.id, position, prod.id)
+            else:
+                cursor = None
+        return page, cursor
+
+    def __products_after(self, cursor):
+        """Yield (category node, position, product node) in page order,
+        starting after the product named by the cursor."""
+        if cursor is None:
+            categories = _preorder(self.__node)
+        else:
+            try:
+                category, position, product = [int(id)
+                                               for id in cursor.split(':')]
+                node = self.graphdb.node[category]
+            except (ValueError, KeyError):
+                raise ValueError("Invalid cursor %r" % (cursor,))
+            path = [node]
+            while path[-1] != self.__node:
+                parent = path[-1].SUBCATEGORY.incoming.single
+                if parent is None:
+                    raise ValueError("The cursor %r is not in %s" %
+                                     (cursor, self))
+                path.append(parent.start)
+            path.reverse()
+            # Skip to the position, unless products were added or removed.
+            # islice passes over the relationships before it, without
+            # reading their products
+            rels = islice(node.PRODUCT.outgoing, position, None)
+            for rel in rels:
+                if rel.end.id == product: break
+                position += 1
+            else:
+                position = -1
+                for rel in node.PRODUCT.outgoing:
+                    position += 1
+                    if rel.end.id == product: break
+                else:
+                    raise ValueError("Invalid cursor %r" % (cursor,))
+                rels = islice(node.PRODUCT.outgoing, position + 1, None)
+            for position, rel in enumerate(rels, position + 1):
+                yield node, position, rel.end
+            categories = _preorder_after(path)
+        for node in categories:
+            for position, rel in enumerate(node.PRODUCT.outgoing):
+                yield node, position, rel.end
+
+    def filter(self, **conditions):
+        """Yield the products in this category and its subcategories whose
+        attribute values match all the conditions.
+
+        A condition is given as KEY=value or KEY__op=operand, where op is one
+        of eq, lt, lte, gt, gte, between (a pair of inclusive bounds) or in (a
+        sequence of values). Values are compared as stored, so a number never
+        matches a string. A product without a value matches by its default.
+        The conditions are answered by the value indexes of each category,
+        which are built on first use, so only matching products are read."""
+        parsed = []
+        for name, operand in conditions.items():
+            key, _, op = name.partition('__')
+            if op not in ValueIndex.operators:
+                raise ValueError("Unknown operator %r in %r" % (op, name))
+            parsed.append((key, op, operand))
+        graphdb = self.graphdb
+        with graphdb.transaction:
+            for node in _preorder(self.__node):
+                category = Category(graphdb, node)
+                matches = None
+                for key, op, operand in parsed:
+                    index = category.__value_index(key)
+                    if index is None:
+                        matches = {}
+                    else:
+                        found = index.find(op, operand)
+                        if matches is None:
+                            matches = found
+                        else:
+                            matches = dict((id, found[id]) for id in matches
+                                           if id in found)
+                    if not matches: break
+                if matches is None: # no conditions
+                    matches = dict((rel.end.id, rel.end)
+                                   for rel in node.PRODUCT.outgoing)
+                for prod in matches.values():
+                    yield category(graphdb, prod)
+
+    def __value_index(self, key):
+        """Get the ValueIndex of the products directly in this category for
+        an attribute, building it on first use. None if there is no such
+        attribute. The indexes are kept with the graph database, not on the
+        category, so they stay when the category is evicted from the
+        identity map."""
+        graphdb, id = self.graphdb, self.__node.id
+        indexes = _graph_state(graphdb).value_indexes
+        index = indexes.get(id, {}).get(key)
+        if index is None:
+            for attr in self.get_all_attributes():
+                if attr.key == key: break
+            else:
+                return None
+            with node_lock(graphdb, id):
+                keys = indexes.setdefault(id, {})
+                index = keys.get(key)
+                if index is None:
+                    index = ValueIndex(attr.default)
+                    index.extend((rel.end, rel.end.get(key, attr.default))
+                                 for rel in self.__node.PRODUCT.outgoing)
+                    keys[key] = index
+        return index
+
+    def to_columns(self, attrs=None, use_numpy=None):
+        """Take a column oriented snapshot of the attribute values of the
+        products in this category and its subcategories, see
+        shop.columns.to_columns."""
+        from shop.columns import to_columns
+        return to_columns(self, attrs, use_numpy)
 
     @property
     def categories(self):
@@ -170,41 +525,326 @@ class Category(type): # type of Product
             yield Category(self.graphdb, rel.end)
 
 
-class SubCategoryProducts(neo4j.Traversal):
-    "Traverser that yields all products in a category and its sub categories."
-    types = [neo4j.Outgoing.SUBCATEGORY, neo4j.Outgoing.PRODUCT]
-    def isReturnable(self, pos):
-        if pos.is_start: return False
-        return pos.last_relationship.type == 'PRODUCT'
-
-
-class SubCategories(neo4j.Traversal):
+def bulk_new_products(graphdb, products, batch_size=1000, errors=None):
+    """Create products from an iterable of (category, values) pairs.
+
+    The products are created in one transaction per batch_size products.
+    The values of each product are converted and validated by the
+    product_constructor of its category before anything is written, so
+    a rejected product does not abort the rest of its batch. For each
+    rejected product errors(index, values, exception) is called, if given.
+    The products are consumed lazily, one batch at a time.
+    Returns the number of created and of rejected products."""
+    if batch_size < 1: raise ValueError("batch_size must be positive")
+    created = rejected = 0
+    products = enumerate(products)
+    while True:
+        with graphdb.transaction:
+            count, counts = 0, {}
+            for index, (category, values) in islice(products, batch_size):
+                count += 1
+                try:
+                    properties = product_constructor(category)(values)
+                except Exception:
+                    rejected += 1
+                    if errors is not None:
+                        errors(index, values, sys.exc_info()[1])
+                    continue
+                node = graphdb.node()
+                category_node(category).PRODUCT(node)
+                for key, value in properties.items():
+                    node[key] = value
+                _index_product(category, node, properties)
+                counts[category] = counts.get(category, 0) + 1
+                created += 1
+            for category, added in counts.items():
+                _count_products(graphdb, category_node(category), added)
+            changed(graphdb)
+        if count < batch_size:
+            return created, rejected
+
+
+def schema_version(graphdb):
+    """The version of the schema in graphdb: the categories, their attributes
+    and the attribute types. Every change of the schema increments it, in
+    the transaction of the change."""
+    return graphdb.reference_node.get(SCHEMA_VERSION, 0)
+
+
+def _schema_changed(graphdb):
+    backend.increment(graphdb.reference_node, SCHEMA_VERSION, 1, 0)
+
+
+def _constructor(attributes):
+    """Build the function that converts the values of a new product with the
+    attributes to node properties and verifies the required values. It
+    raises the errors that setting and verifying each attribute raises:
+    AttributeError for an unknown key, KeyError for a missing required value
+    and the errors of verify_constraints. The conversions and checks that do
+    nothing for an attribute type are left out."""
+    convert, present, verify = {}, [], []
+    for attr in attributes:
+        Attribute = type(attr)
+        to_neo = Attribute.to_neo
+        if _is_default(Attribute, 'to_primitive_neo_value'):
+            to_neo = None
+        convert[attr.key] = to_neo
+        if attr.required:
+            if _is_default(Attribute, 'verify_constraints') and \
+                    _is_default(Attribute, 'from_primitive_neo_value'):
+                present.append(attr.key)
+            else:
+                verify.append((attr.key, Attribute.verify_value))
+
+    def construct(values):
+        properties = {}
+        for key, value in values.items():
+            try:
+                to_neo = convert[key]
+            except KeyError:
+                raise AttributeError("No attribute %r in this category" %
+                                     (key,))
+            if to_neo is not None:
+                value = to_neo(value)
+            properties[key] = value
+        for key in present:
+            if key not in properties:
+                raise KeyError(key)
+        for key, verify_value in verify:
+            verify_value(properties[key])
+        return properties
+    return construct
+
+
+def _is_default(Attribute, name):
+    """Whether an attribute type uses the AttributeType method of name,
+    that passes the value through unchanged."""
+    method = getattr(Attribute, name)
+    return getattr(method, 'im_func', None) is \
+        getattr(AttributeType, name).im_func
+
+
+def value_indexes(category):
+    """The value indexes built for a category, by key, or None."""
+    return _graph_state(category.graphdb).value_indexes.get(
+        category_node(category).id)
+
+
+def _drop_value_indexes_on_rollback(graphdb, id):
+    """Drop the value indexes of the category node with the given id if the
+    transaction of this thread rolls back. They may have been built since
+    the transaction wrote the products of the category, from the values
+    that the rollback undoes."""
+    indexes = _graph_state(graphdb).value_indexes
+    def rolled_back():
+        with node_lock(graphdb, id):
+            indexes.pop(id, None)
+    backend.after_rollback(graphdb, rolled_back)
+
+
+def _index_product(category, node, properties):
+    """Add a new product to the value indexes of its category and to the
+    text index."""
+    _drop_value_indexes_on_rollback(category.graphdb,
+                                    category_node(category).id)
+    indexes = value_indexes(category)
+    if indexes:
+        _after_commit(category.graphdb, [
+                (index.add, node, node.get(key, index.default))
+                for key, index in indexes.items()])
+    index = text_index(category.graphdb)
+    if index is not None:
+        _after_commit(category.graphdb, [
+                (index.add, node.id, category_node(category).id, properties)])
+
+
+def _after_commit(graphdb, calls):
+    """Make the (function, arguments...) calls when the transaction of this
+    thread in graphdb commits."""
+    def committed():
+        for call in calls:
+            call[0](*call[1:])
+    backend.after_commit(graphdb, committed)
+
+
+def _index_text(product, node):
+    """Index the changed values of a product in the text index."""
+    graphdb = type(product).graphdb
+    index = text_index(graphdb)
+    if index is not None:
+        _after_commit(graphdb, [(index.add, node.id,
+                                 category_node(type(product)).id,
+                                 dict(node.items()))])
+
+
+def _count_products(graphdb, node, delta):
+    """Add delta to the product count of a category node and to the subtree
+    product counts of the node and its ancestors. Missing counts are left
+    missing, they are counted by verify_product_counts.
+
+    The product count is updated in the transaction, with backend.increment.
+    The subtree counts, which every product written anywhere below the root
+    changes, are summed up per node until the outermost transaction of the
+    thread commits, and then added in a short transaction of their own, so
+    that concurrent writers hold the write locks of the ancestors only
+    briefly rather than for their whole transactions. If that transaction
+    fails, the subtree counts stay behind until verify_product_counts
+    repairs them."""
+    backend.increment(node, PRODUCT_COUNT, delta)
+    pending = _pending_counts(graphdb, create=True)
+    ids = []
+    while node is not None:
+        entry = pending.setdefault(node.id, [node, 0])
+        entry[1] += delta
+        ids.append(node.id)
+        parent = node.SUBCATEGORY.incoming.single
+        node = parent is not None and parent.start or None
+    def rolled_back():
+        for id in ids:
+            if id in pending:
+                pending[id][1] -= delta
+    backend.after_rollback(graphdb, rolled_back)
+
+
+def _pending_counts(graphdb, create=False):
+    """The subtree count deltas, {node id: [node, delta]}, of the open
+    transaction of this thread in graphdb, see _count_products."""
+    local = _graph_state(graphdb).local
+    pending = getattr(local, 'pending_counts', None)
+    if pending is None:
+        pending = {}
+        if create:
+            def committed():
+                del local.pending_counts
+                _add_subtree_counts(graphdb, pending)
+            def rolled_back():
+                del local.pending_counts
+            local.pending_counts = pending
+            backend.after_commit(graphdb, committed)
+            backend.after_rollback(graphdb, rolled_back)
+    return pending
+
+
+def _add_subtree_counts(graphdb, pending):
+    """Add the subtree count deltas of a committed transaction, locking the
+    nodes in the order of their ids, the same in all threads."""
+    with graphdb.transaction:
+        for id in sorted(pending):
+            node, delta = pending[id]
+            if delta:
+                backend.increment(node, SUBTREE_PRODUCT_COUNT, delta)
+        changed(graphdb)
+
+
+def verify_product_counts(graphdb, node, repair=False):
+    """Count the products of a category node and its subcategories and
+    compare the counts to the counts stored on the nodes. With repair, store
+    the actual counts. Returns a list of (node, key, stored, actual) for the
+    counts that were wrong or missing."""
+    wrong = []
+    with graphdb.transaction:
+        nodes = list(_preorder(node))
+        direct, subtree, parents = {}, {}, {}
+        for node in nodes:
+            direct[node.id] = subtree[node.id] = len(list(
+                    node.PRODUCT.outgoing))
+            for rel in node.SUBCATEGORY.outgoing:
+                parents[rel.end.id] = node.id
+        for node in reversed(nodes[1:]):
+            subtree[parents[node.id]] += subtree[node.id]
+        pending = _pending_counts(graphdb)
+        for node in nodes:
+            for key, counts in ((PRODUCT_COUNT, direct),
+                                (SUBTREE_PRODUCT_COUNT, subtree)):
+                stored, actual = node.get(key), counts[node.id]
+                added = 0
+                if key == SUBTREE_PRODUCT_COUNT and node.id in pending:
+                    added = pending[node.id][1] # not written until commit
+                    if stored is not None:
+                        stored += added
+                if stored != actual:
+                    wrong.append((node, key, stored, actual))
+                    if repair:
+                        node[key] = actual - added
+        if wrong and repair:
+            changed(graphdb)
+    return wrong
+
+
+def init_product_counts(node):
+    """Start the product counts of a category node without products or
+    subcategories, like the root of a new store."""
+    if node.get(SUBTREE_PRODUCT_COUNT) is None and \
+            not list(islice(node.SUBCATEGORY.outgoing, 1)) and \
+            not list(islice(node.PRODUCT.outgoing, 1)):
+        node[PRODUCT_COUNT] = node[SUBTREE_PRODUCT_COUNT] = 0
+
+
+def _preorder(node):
+    """Yield a category node and all its subcategory nodes, in pre-order."""
+    yield node
+    for rel in node.SUBCATEGORY.outgoing:
+        for sub in _preorder(rel.end):
+            yield sub
+
+
+def _preorder_after(path):
+    """Continue a pre-order walk after the last node of path, the nodes from
+    the start of the walk to that node, reading only the siblings of the
+    nodes in the path."""
+    for rel in path[-1].SUBCATEGORY.outgoing:
+        for sub in _preorder(rel.end):
+            yield sub
+    for i in range(len(path) - 1, 0, -1):
+        parent, child = path[i-1], path[i]
+        rels = iter(parent.SUBCATEGORY.outgoing)
+        for rel in rels:
+            if rel.end == child: break
+        for rel in rels:
+            for sub in _preorder(rel.end):
+                yield sub
+
+
+def _attribute(graphdb, attr):
+    """Instantiate the Attribute defined by an ATTRIBUTE relationship."""
+    # Get the Attribute type (instance of AttributeType)
+    Attribute = AttributeType( graphdb, attr.end )
+    return Attribute( graphdb, attr['Name'],
+                      attr.get('DefaultValue'), attr.get('Required') )
+
+
+class SubCategories(backend.Traversal):
     "Traverser that yields all subcategories of a category."
-    types = [neo4j.Outgoing.SUBCATEGORY]
+    types = [backend.Outgoing.SUBCATEGORY]
     
 
 
 class AttributeType(type): # type of Attribute
-    __attribute_types = {}
-    __create_lock = threading.RLock() # reentrant lock
+
+    def __init__(self, *args): pass # do nothing
 
     def __new__(AttributeType, graphdb, node):
         """Lookup or create a AttributeType representation for a Node."""
+        types = identity_map(graphdb, 'attribute types')
         # If the AttributeType instance already exists
-        self = AttributeType.__attribute_types.get(node.id)
+        self = types.get(node.id)
         if self is None: # Otherwise create it
-            with AttributeType.__create_lock: # Unless created concurrently
-                self = AttributeType.__attribute_types.get(node.id)
+            with node_lock(graphdb, node.id): # Unless created concurrently
+                self = types.peek(node.id)
                 if self is not None: return self
 
                 with graphdb.transaction:
+                    self = _define_attribute_type(graphdb, node, node['Name'])
 
-                    body = dict(__new__=object.__new__)
-                    self = type.__new__(AttributeType, node['Name'],
-                                        (Attribute,), body)
-
-                    self.__node = node
+        return self
 
+    global _define_attribute_type # define here to get the name mangling right
+    def _define_attribute_type(graphdb, node, name):
+        """Create the AttributeType of node and add it to the identity map."""
+        body = dict(__new__=object.__new__)
+        self = type.__new__(AttributeType, name, (Attribute,), body)
+        self.__node = node
+        identity_map(graphdb, 'attribute types').add(node.id, self)
         return self
 
     def __str__(self):
@@ -212,21 +852,60 @@ class AttributeType(type): # type of Attribute
 
     @classmethod
     def create(AttributeType, graphdb, root, name, **attributes):
-        unit = attributes.pop('Unit', "")
-        if attributes: raise TypeError(
-            "Unsupported keyword arguments: "+", ".join(
-                "'%s'" % (key,) for key in attributes))
+        return AttributeType.define_types(graphdb, root,
+                                          [(name, attributes)])[0]
 
+    @classmethod
+    def define_types(AttributeType, graphdb, root, types):
+        """Create attribute types, given as (name, attributes) pairs or a
+        dict, in one transaction. Raises KeyError before anything is written
+        if a name is already defined or given twice."""
+        if hasattr(types, 'items'): types = types.items()
+        definitions = []
+        for name, attributes in types:
+            attributes = dict(attributes)
+            unit = attributes.pop('Unit', "")
+            if attributes: raise TypeError(
+                "Unsupported keyword arguments: "+", ".join(
+                    "'%s'" % (key,) for key in attributes))
+            definitions.append((name, unit))
+
+        # Reserve the names before the transaction, so that a duplicate
+        # fails before anything is written and does not make the transaction
+        # of a caller roll back
+        index = AttributeType.by_name(graphdb, root)
+        names = [name for name, unit in definitions]
+        try:
+            index.reserve(names)
+        except KeyError:
+            raise KeyError("AttributeType %r already exists" %
+                           (sys.exc_info()[1].args[0],))
+        created = []
+        def rolled_back():
+            index.release(names)
+            index.discard(created)
+            types = identity_map(graphdb, 'attribute types')
+            for name, node in created:
+                types.discard(node.id)
         with graphdb.transaction:
-            node = graphdb.node(Name=name, Unit=unit)
-            root.ATTRIBUTE_TYPE(node)
-            
-            for rel in root.ATTRIBUTE_TYPE:
-                if rel.end == node: continue
-                if rel.end['Name'] == name:
-                    raise KeyError("AttributeType %r already exists" % (name,))
+            backend.after_rollback(graphdb, rolled_back)
+            for name, unit in definitions:
+                node = graphdb.node(Name=name, Unit=unit)
+                root.ATTRIBUTE_TYPE(node)
+                created.append((name, node))
+            _schema_changed(graphdb)
+            index.extend(created)
+            changed(graphdb)
+        return [AttributeType(graphdb, node) for name, node in created]
 
-            return AttributeType(graphdb, node)
+    @classmethod
+    def by_name(AttributeType, graphdb, root):
+        """The NameIndex of the attribute types under the root node."""
+        def load():
+            with graphdb.transaction:
+                for rel in root.ATTRIBUTE_TYPE:
+                    yield rel.end['Name'], rel.end
+        return name_index(graphdb, 'attribute types', load)
 
     @property
     def unit(self):
@@ -261,6 +940,7 @@ class Attribute(object): # instance of AttributeType
             attr=node.ATTRIBUTE( type_node(type), Name=name, Required=required)
             if default is not None:
                 attr['DefaultValue'] = type.to_primitive_neo_value(default)
+            return attr
         return AttributeFactory
 
     def __init__(self, graphdb, key, default, required):
@@ -279,14 +959,45 @@ class Attribute(object): # instance of AttributeType
     def __get__(self, obj, cls=None):
         if obj is None:
             return self
-        else:
-            return self.from_neo(product_node(obj).get(self.key, self.default))
+        values = product_values(obj)
+        if values is None:
+            values = product_node(obj)
+        return self.from_neo(values.get(self.key, self.default))
 
     def __set__(self, obj, value):
-        product_node(obj)[self.key] = self.to_neo(value)
+        node = product_node(obj)
+        value = self.to_neo(value)
+        values = product_values(obj)
+        if values is not None:
+            values[self.key] = value
+        graphdb = type(obj).graphdb
+        _drop_value_indexes_on_rollback(graphdb, category_node(type(obj)).id)
+        index = (value_indexes(type(obj)) or {}).get(self.key)
+        if index is None:
+            node[self.key] = value
+        else:
+            old = node.get(self.key, self.default)
+            node[self.key] = value
+            _after_commit(graphdb, [(index.remove, node, old),
+                                    (index.add, node, value)])
+        _index_text(obj, node)
+        changed(graphdb)
 
     def __delete__(self, obj):
-        del product_node(obj)[self.key]
+        node = product_node(obj)
+        old = node[self.key]
+        del node[self.key]
+        values = product_values(obj)
+        if values is not None:
+            values.pop(self.key, None)
+        graphdb = type(obj).graphdb
+        _drop_value_indexes_on_rollback(graphdb, category_node(type(obj)).id)
+        index = (value_indexes(type(obj)) or {}).get(self.key)
+        if index is not None:
+            _after_commit(graphdb, [(index.remove, node, old),
+                                    (index.add, node, self.default)])
+        _index_text(obj, node)
+        changed(graphdb)
 
     def __call__(self, obj):
         return "%s: %s%s" % (self.key, self.__get__(obj), self.get_unit())
@@ -308,3 +1019,382 @@ class Attribute(object): # instance of AttributeType
     def get_unit(Attribute):
         return Attribute.unit
 
+
+class NameIndex(object):
+    """Maps names to the nodes of one kind of object in a graph database.
+
+    The index is loaded completely on the first lookup, from an iterable of
+    (name, node) pairs that load() returns, and the model adds the nodes it
+    creates to it, and drops them again if their transaction rolls back.
+    After loading, a lookup of a missing name fails without searching the
+    graph. The hits, misses and loads attributes count lookups that found a
+    node, lookups that did not and loads of the index."""
+
+    def __init__(self, load):
+        self.__load = load
+        self.__names = None
+        self.__reserved = set()
+        self.__lock = threading.Lock()
+        self.hits = self.misses = self.loads = 0
+
+    def __names_loaded(self):
+        names = self.__names
+        if names is None:
+            with self.__lock:
+                names = self.__names
+                if names is None:
+                    names = {}
+                    for name, value in self.__load():
+                        names.setdefault(name, value)
+                    self.__names = names
+                    self.loads += 1
+        return names
+
+    def __getitem__(self, name):
+        try:
+            value = self.__names_loaded()[name]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.__names_loaded())
+
+    def add(self, name, value):
+        self.extend([(name, value)])
+
+    def extend(self, pairs):
+        """Add (name, node) pairs, ending the reservation of the names."""
+        with self.__lock:
+            for name, value in pairs:
+                self.__reserved.discard(name)
+                if self.__names is not None:
+                    self.__names.setdefault(name, value)
+
+    def reserve(self, names):
+        """Reserve names for nodes that are about to be created, until they
+        are added or released. Raises KeyError with the name if a name is in
+        the index, reserved already or given twice."""
+        indexed = self.__names_loaded()
+        with self.__lock:
+            reserved = set()
+            for name in names:
+                if name in indexed or name in self.__reserved or \
+                        name in reserved:
+                    raise KeyError(name)
+                reserved.add(name)
+            self.__reserved.update(reserved)
+
+    def release(self, names):
+        """End the reservation of names whose nodes were not created."""
+        with self.__lock:
+            self.__reserved.difference_update(names)
+
+    def discard(self, pairs):
+        """Drop (name, node) pairs whose nodes were rolled back."""
+        with self.__lock:
+            if self.__names is not None:
+                for name, value in pairs:
+                    if self.__names.get(name) is value:
+                        del self.__names[name]
+
+    def invalidate(self):
+        """Drop the index, the next lookup loads it again."""
+        with self.__lock:
+            self.__names = None
+
+
+class IdentityMap(object):
+    """Maps node ids to the objects that represent the nodes, for one kind of
+    object in one graph database.
+
+    The objects are held by weak references, so that a node is never
+    represented by two live objects. The size most recently used objects are
+    also held by strong references, in two generations of at most size/2
+    objects each; when the newest generation is full the older one is
+    evicted. The hits, misses and evictions attributes count lookups that
+    found an object, lookups that did not and objects evicted from the
+    recently used ones. Pinned objects are held apart from those, until
+    they are discarded. len() gives the number of live objects."""
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.__objects = weakref.WeakValueDictionary()
+        self.__recent = {}
+        self.__older = {}
+        self.__pinned = {}
+        self.__lock = threading.Lock()
+        self.size = size
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.__objects)
+
+    def get(self, id):
+        obj = self.__objects.get(id)
+        if obj is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.__use(id, obj)
+        return obj
+
+    def peek(self, id):
+        """Get an object without counting the lookup as a hit or miss."""
+        return self.__objects.get(id)
+
+    def add(self, id, obj):
+        self.__objects[id] = obj
+        self.__use(id, obj)
+
+    def pin(self, id, obj):
+        """Add an object and hold it whether it is used or not, such as the
+        schema loaded from a snapshot."""
+        with self.__lock:
+            self.__objects[id] = self.__pinned[id] = obj
+
+    def discard(self, id):
+        """Drop the object of a node that is gone."""
+        with self.__lock:
+            self.__objects.pop(id, None)
+            self.__pinned.pop(id, None)
+            self.__recent.pop(id, None)
+            self.__older.pop(id, None)
+
+    def resize(self, size):
+        """Set the number of objects to hold, shrinking evicts them all."""
+        with self.__lock:
+            if size < self.size:
+                self.evictions += len(set(self.__older) | set(self.__recent))
+                self.__older, self.__recent = {}, {}
+            self.size = size
+
+    def __use(self, id, obj):
+        if id not in self.__recent:
+            with self.__lock:
+                self.__recent[id] = obj
+                if len(self.__recent) > self.size // 2:
+                    self.evictions += len([old for old in self.__older
+                                           if old not in self.__recent])
+                    self.__older, self.__recent = self.__recent, {}
+                    if self.size < 2: # too small to hold any objects
+                        self.evictions += len(self.__older)
+                        self.__older = {}
+
+
+class _GraphState(object):
+    """The identity maps, name, value and text indexes, node locks and
+    generation of one graph database."""
+    def __init__(self):
+        self.identity_maps = {}
+        self.name_indexes = {}
+        self.value_indexes = {} # category node id -> {key: ValueIndex}
+        self.text_index = None
+        self.node_locks = {}
+        self.local = threading.local() # per thread, see _pending_counts
+        self.generation = 0
+
+class ValueIndex(object):
+    """Index of the values of one attribute of the products directly in one
+    category, kept up to date by new_product and the Attribute descriptors
+    when their transactions commit.
+
+    Equality lookups use a hash of the values. Range lookups bisect a sorted
+    list of the distinct values, kept per kind of value (numbers, strings and
+    so on) since values of different kinds do not compare meaningfully.
+    Lookups return the matching product nodes by node id."""
+
+    operators = '', 'eq', 'lt', 'lte', 'gt', 'gte', 'between', 'in'
+
+    def __init__(self, default):
+        self.default = default
+        self.__nodes = {}  # value -> {node id: node}
+        self.__sorted = {} # kind -> sorted distinct values
+        self.__lock = threading.Lock()
+
+    def add(self, node, value):
+        if value is None: return
+        value = _hashable(value)
+        with self.__lock:
+            nodes = self.__nodes.get(value)
+            if nodes is None:
+                nodes = self.__nodes[value] = {}
+                bisect.insort(self.__sorted.setdefault(_kind(value), []),
+                              value)
+            nodes[node.id] = node
+
+    def extend(self, pairs):
+        """Add (node, value) pairs, sorting the distinct values once."""
+        with self.__lock:
+            for node, value in pairs:
+                if value is not None:
+                    nodes = self.__nodes.setdefault(_hashable(value), {})
+                    nodes[node.id] = node
+            self.__sorted = {}
+            for value in self.__nodes:
+                self.__sorted.setdefault(_kind(value), []).append(value)
+            for values in self.__sorted.values():
+                values.sort()
+
+    def remove(self, node, value):
+        if value is None: return
+        value = _hashable(value)
+        with self.__lock:
+            nodes = self.__nodes.get(value)
+            if nodes is None: return
+            nodes.pop(node.id, None)
+            if not nodes:
+                del self.__nodes[value]
+                values = self.__sorted[_kind(value)]
+                del values[bisect.bisect_left(values, value)]
+
+    def find(self, op, operand):
+        if op in ('', 'eq'):
+            return dict(self.__nodes.get(_hashable(operand), {}))
+        if op == 'in':
+            return self.__union(_hashable(value) for value in operand)
+        if op == 'between':
+            low, high = operand
+        elif op in ('lt', 'lte'):
+            low, high = None, operand
+        elif op in ('gt', 'gte'):
+            low, high = operand, None
+        else:
+            raise ValueError("Unknown operator %r" % (op,))
+        values = self.__sorted.get(_kind(high if low is None else low), [])
+        start, stop = 0, len(values)
+        if low is not None:
+            if op == 'gt':
+                start = bisect.bisect_right(values, low)
+            else:
+                start = bisect.bisect_left(values, low)
+        if high is not None:
+            if op == 'lt':
+                stop = bisect.bisect_left(values, high)
+            else:
+                stop = bisect.bisect_right(values, high)
+        return self.__union(values[start:stop])
+
+    def __union(self, values):
+        found = {}
+        for value in values:
+            found.update(self.__nodes.get(value, ()))
+        return found
+
+
+def _kind(value):
+    if isinstance(value, (int, long, float)):
+        return float
+    if isinstance(value, basestring):
+        return basestring
+    return type(value)
+
+
+def _hashable(value):
+    if isinstance(value, list): # array properties
+        return tuple(value)
+    return value
+
+
+__graph_states_lock = threading.Lock()
+
+def _graph_state(graphdb):
+    """The _GraphState of graphdb. It is kept in an attribute of the graph
+    database, rather than in a map from graph databases, since the objects
+    in it refer to the graph database through their nodes; it goes away
+    with a graph database that is no longer used, even if it is not shut
+    down."""
+    state = getattr(graphdb, '_model_state', None)
+    if state is None:
+        with __graph_states_lock:
+            state = getattr(graphdb, '_model_state', None)
+            if state is None:
+                state = graphdb._model_state = _GraphState()
+    return state
+
+
+def forget(graphdb):
+    """Drop the identity maps, name indexes and locks of graphdb, when the
+    graph database is shut down."""
+    with __graph_states_lock:
+        if getattr(graphdb, '_model_state', None) is not None:
+            del graphdb._model_state
+
+
+def identity_map(graphdb, kind):
+    """Get the IdentityMap of the given kind for graphdb."""
+    maps = _graph_state(graphdb).identity_maps
+    identities = maps.get(kind)
+    if identities is None:
+        with __graph_states_lock:
+            identities = maps.setdefault(kind, IdentityMap())
+    return identities
+
+
+def text_index(graphdb, load=None):
+    """Get the TextIndex of graphdb, see shop.search. If there is none it is
+    created with load, or None is returned when load is not given."""
+    state = _graph_state(graphdb)
+    index = state.text_index
+    if index is None and load is not None:
+        from shop.search import TextIndex
+        with __graph_states_lock:
+            index = state.text_index
+            if index is None:
+                index = state.text_index = TextIndex(load)
+    return index
+
+
+def generation(graphdb):
+    """The generation of the data in graphdb. Every write through the model
+    starts a new generation when its outermost transaction commits or rolls
+    back, so data read in one generation can be reused until the generation
+    changes."""
+    return _graph_state(graphdb).generation
+
+
+def changed(graphdb):
+    """Start a new generation of the data in graphdb when the transaction of
+    this thread ends, or now if there is none. A rollback starts one too,
+    since the data of the transaction may have been read before it."""
+    state = _graph_state(graphdb)
+    def end():
+        with __graph_states_lock:
+            state.generation += 1
+    backend.after_commit(graphdb, end)
+    backend.after_rollback(graphdb, end)
+
+
+def node_lock(graphdb, id):
+    """Get the lock of the node with the given id in graphdb. It is held
+    while the object that represents the node is created, and while the
+    indexes of a category node in memory are built or changed. No node is
+    written while a node lock is held: the write locks of Neo4j last until
+    the outermost transaction ends, so a thread waiting for one with a node
+    lock held could deadlock with the thread that has it. Counts on nodes
+    are updated with backend.increment instead."""
+    locks = _graph_state(graphdb).node_locks
+    lock = locks.get(id)
+    if lock is None:
+        with __graph_states_lock:
+            lock = locks.setdefault(id, threading.RLock())
+    return lock
+
+
+def name_index(graphdb, kind, load=None):
+    """Get the NameIndex of the given kind for graphdb. If there is none it is
+    created with load, or None is returned when load is not given."""
+    indexes = _graph_state(graphdb).name_indexes
+    index = indexes.get(kind)
+    if index is None and load is not None:
+        with __graph_states_lock:
+            index = indexes.setdefault(kind, NameIndex(load))
+    return index
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Scan the products of a category tree with a pool of threads.
+
+The tree is split into parts, whole subtrees or the products directly in one
+category, that are scanned independently, each in a read transaction of its
+own. Splitting uses the product counts of the categories, so that the parts
+are of similar size. The results are merged in catalogue order, the
+pre-order of the category tree, or grouped by key.
+
+Threads share the store, processes cannot: a Neo4j store directory is locked
+by the process that opens it and the in-memory graph lives in one process.
+Scans gain the most where a thread pool runs in parallel, such as on Jython
+or when func waits for I/O.
+"""
+
+from __future__ import with_statement
+
+import sys
+import Queue
+import threading
+
+from shop import model
+
+__all__ = 'scan', 'split',
+
+PARTS_PER_WORKER = 4 # parts to split the tree into, for each worker
+WINDOW = 2 # parts per worker that may be scanned ahead of the results
+
+
+def split(category, parts):
+    """Split category and its subcategories into about parts parts, in
+    pre-order. Returns a list of (node, subtree) pairs, that stand for all
+    products in the subtree of node, or, if subtree is false, the products
+    directly in node. The part with the most products is split first."""
+    graphdb = category.graphdb
+    sizes, children = {}, {}
+    def size(node):
+        if node.id not in sizes:
+            sizes[node.id] = model.Category(graphdb, node).count_products()
+        return sizes[node.id]
+    def subcategories(node):
+        if node.id not in children:
+            children[node.id] = [rel.end for rel in node.SUBCATEGORY.outgoing]
+        return children[node.id]
+    with graphdb.transaction:
+        found = [(model.category_node(category), True)]
+        while len(found) < parts:
+            splittable = [(size(node), -i) for i, (node, subtree)
+                          in enumerate(found)
+                          if subtree and subcategories(node)]
+            if not splittable: break
+            i = -max(splittable)[1]
+            node = found[i][0]
+            found[i:i+1] = [(node, False)] + [
+                (child, True) for child in subcategories(node)]
+    return found
+
+
+def scan(category, func, workers=4, key=None, errors=None):
+    """Call func(product) for every product in category and its
+    subcategories, from workers threads, and yield the results.
+
+    Without key the results are yielded in catalogue order. With key, the
+    results are grouped by key(result), and (key, results) pairs are yielded
+    in key order after the scan. Workers scan at most WINDOW parts each ahead
+    of the part whose results are yielded next, so a slow consumer holds
+    them back instead of collecting the results in memory.
+
+    If func fails and errors is given, errors(product, exception) is called,
+    in the worker thread, and the scan goes on. Otherwise the scan stops and
+    the exception is raised where the results are read."""
+    graphdb = category.graphdb
+    parts = split(category, workers * PARTS_PER_WORKER)
+    tasks = Queue.Queue()
+    for index, part in enumerate(parts):
+        tasks.put((index, part))
+    results = Queue.Queue()
+    window = threading.Semaphore(workers * WINDOW)
+    stop = threading.Event()
+
+    def work():
+        while True:
+            window.acquire()
+            if stop.isSet(): return
+            try:
+                index, (node, subtree) = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                found = _scan_part(graphdb, node, subtree, func, errors)
+            except Exception:
+                results.put((index, None, sys.exc_info()[1]))
+                return
+            results.put((index, found, None))
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    groups = {}
+    try:
+        pending = {}
+        expected = 0
+        while expected < len(parts):
+            index, found, error = results.get()
+            if error is not None:
+                raise error
+            pending[index] = found
+            while expected in pending:
+                found = pending.pop(expected)
+                expected += 1
+                window.release()
+                if key is None:
+                    for result in found:
+                        yield result
+                else:
+                    for result in found:
+                        groups.setdefault(key(result), []).append(result)
+    finally:
+        stop.set()
+        for thread in threads: # wake the waiting workers
+            window.release()
+    for item in sorted(groups.items()):
+        yield item
+
+
+def _scan_part(graphdb, node, subtree, func, errors):
+    found = []
+    with graphdb.transaction:
+        if subtree:
+            nodes = model._preorder(node)
+        else:
+            nodes = [node]
+        for node in nodes:
+            category = model.Category(graphdb, node)
+            for rel in node.PRODUCT.outgoing:
+                product = category(graphdb, rel.end)
+                try:
+                    found.append(func(product))
+                except Exception:
+                    if errors is None: raise
+                    errors(product, sys.exc_info()[1])
+    return found
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshots of the schema of a store, for a fast start.
+
+Building the Category of a node reads its name, its attributes, their types
+and the categories above it from the graph. A snapshot holds all of that
+for a store in one JSON file next to the store directory, and loading it
+builds every Category and AttributeType at once, with no reads from the
+graph except the schema version.
+
+The snapshot records model.schema_version, which every change of the schema
+increments. A snapshot of another version, another store or another format
+is stale and is not loaded; the model then reads the schema from the graph
+as usual. The loaded objects are pinned in the identity maps of the model,
+so the whole schema stays in memory however many categories there are,
+rather than only the recently used ones.
+"""
+
+from __future__ import with_statement
+
+import os
+
+try:
+    import json
+except ImportError: # Python < 2.6
+    import simplejson as json
+
+from shop import model
+
+__all__ = 'snapshot_path', 'write_snapshot', 'load_snapshot',
+
+FORMAT = 1 # version of the layout of the snapshot file
+
+
+def snapshot_path(storedir):
+    """The path of the schema snapshot of the store in storedir."""
+    return os.path.normpath(storedir) + '.schema.json'
+
+
+def write_snapshot(store, path):
+    """Write a snapshot of the schema of store to path. Returns the schema
+    version of the snapshot."""
+    graphdb = store.graphdb
+    with graphdb.transaction:
+        root = model.category_node(store.root)
+        types, categories = {}, []
+        for node in model._preorder(root):
+            parent = node.SUBCATEGORY.incoming.single
+            if parent is not None:
+                parent = parent.start.id
+            attributes = []
+            for attr in node.ATTRIBUTE:
+                type = attr.end
+                types.setdefault(type.id, dict(
+                        id=type.id, name=type['Name'], unit=type['Unit']))
+                attributes.append(dict(name=attr['Name'], type=type.id,
+                                       default=attr.get('DefaultValue'),
+                                       required=attr.get('Required')))
+            categories.append(dict(id=node.id, name=node['Name'],
+                                   parent=parent, attributes=attributes))
+        snapshot = dict(format=FORMAT, store=store.name,
+                        version=model.schema_version(graphdb),
+                        types=[types[id] for id in sorted(types)],
+                        categories=categories)
+    temporary = path + '.tmp'
+    out = open(temporary, 'w')
+    try:
+        json.dump(snapshot, out)
+    finally:
+        out.close()
+    os.rename(temporary, path) # replace the old snapshot in one step
+    return snapshot['version']
+
+
+def load_snapshot(store, path):
+    """Build the categories and attribute types of store from the snapshot in
+    path. Returns the schema version of the snapshot, or None if there is no
+    snapshot or it is stale."""
+    try:
+        saved = open(path)
+    except IOError:
+        return None
+    try:
+        try:
+            snapshot = json.load(saved)
+        except ValueError:
+            return None
+    finally:
+        saved.close()
+    graphdb = store.graphdb
+    known_types = model.identity_map(graphdb, 'attribute types')
+    known_categories = model.identity_map(graphdb, 'categories')
+    types, categories = {}, {}
+    try:
+        with graphdb.transaction:
+            if snapshot.get('format') != FORMAT or \
+                    snapshot.get('store') != store.name or \
+                    snapshot.get('version') != model.schema_version(graphdb):
+                return None
+            for type in snapshot['types']:
+                id = type['id']
+                types[id] = known_types.peek(id) or \
+                    model._define_attribute_type(graphdb, graphdb.node[id],
+                                                 str(type['name']))
+                known_types.pin(id, types[id])
+            for category in snapshot['categories']:
+                id = category['id']
+                if category['parent'] is None:
+                    parent = model.Product
+                else:
+                    parent = categories[category['parent']]
+                attributes = {}
+                for attr in category['attributes']:
+                    key = str(attr['name'])
+                    attributes[key] = types[attr['type']](
+                        graphdb, key, attr['default'], attr['required'])
+                categories[id] = known_categories.peek(id) or \
+                    model._define_category(graphdb, graphdb.node[id],
+                                           str(category['name']), parent,
+                                           attributes)
+                known_categories.pin(id, categories[id])
+    except KeyError: # a node of the snapshot is gone
+        return None
+    return snapshot['version']
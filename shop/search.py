@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Prefix and full-text search over the names of categories and the text values
+of products.
+
+A TextIndex maps each word of the indexed texts to the ids of the nodes whose
+texts contain it. The distinct words are kept in a sorted list, where the
+words that start with a prefix are next to each other, like the leaves below
+a node of a trie, and are found by bisection. Every word of a query matches
+the words it is a prefix of, so the last, possibly incomplete, word of a
+query typed so far finds its completions.
+
+The model keeps the index of a graph database up to date as categories and
+products are created, changed and deleted, once it is loaded; see
+shop.model.text_index and Store.search.
+"""
+
+from __future__ import with_statement
+
+import re
+import bisect
+import heapq
+import threading
+
+__all__ = 'TextIndex', 'words',
+
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+def words(text):
+    """The words in text, in lower case."""
+    return _word.findall(text.lower())
+
+
+class TextIndex(object):
+    """Index of the words in the texts of categories and products.
+
+    The index is loaded completely on the first search, from an iterable of
+    (id, category id, texts) triples that load() returns, where texts maps
+    keys to values and only the string values are indexed. The entry of a
+    category has its own id as category id. The model adds, replaces and
+    removes the entries of the nodes it changes after loading, when their
+    transactions commit."""
+
+    def __init__(self, load):
+        self.__load = load
+        self.__entries = None # id -> (category id, name, words)
+        self.__postings = {}  # word -> set of ids
+        self.__words = []     # sorted distinct words
+        self.__lock = threading.Lock()
+        self.loads = 0
+
+    def __loaded(self):
+        entries = self.__entries
+        if entries is None:
+            with self.__lock:
+                entries = self.__entries
+                if entries is None:
+                    self.__entries = entries = {}
+                    try:
+                        for id, category, texts in self.__load():
+                            self.__add(id, category, texts)
+                    except:
+                        self.__entries, self.__postings = None, {}
+                        self.__words = []
+                        raise
+                    self.loads += 1
+        return entries
+
+    def __len__(self):
+        return len(self.__loaded())
+
+    def add(self, id, category, texts):
+        """Index the texts of the node with the given id, replacing what was
+        indexed for it before."""
+        with self.__lock:
+            if self.__entries is not None:
+                self.__add(id, category, texts)
+
+    def remove(self, id):
+        with self.__lock:
+            if self.__entries is not None:
+                self.__remove(id)
+
+    def __add(self, id, category, texts):
+        self.__remove(id)
+        found = set()
+        for text in texts.values():
+            if isinstance(text, basestring):
+                found.update(words(text))
+        name = texts.get('Name')
+        if not isinstance(name, basestring):
+            name = u''
+        postings = self.__postings
+        for word in found:
+            ids = postings.get(word)
+            if ids is None:
+                ids = postings[word] = set()
+                bisect.insort(self.__words, word)
+            ids.add(id)
+        self.__entries[id] = (category, name.lower(), frozenset(found))
+
+    def __remove(self, id):
+        entry = self.__entries.pop(id, None)
+        if entry is None: return
+        postings = self.__postings
+        for word in entry[2]:
+            ids = postings[word]
+            ids.discard(id)
+            if not ids:
+                del postings[word]
+                del self.__words[bisect.bisect_left(self.__words, word)]
+
+    def __completions(self, prefix):
+        """The indexed words that start with prefix."""
+        words = self.__words
+        found = []
+        for i in xrange(bisect.bisect_left(words, prefix), len(words)):
+            if not words[i].startswith(prefix): break
+            found.append(words[i])
+        return found
+
+    def search(self, text, categories=None, limit=20):
+        """Find the entries with a word starting with each word of text, in
+        the given set of category ids if categories is given. Returns the
+        best limit matches as (id, category id) pairs, best first.
+
+        Each query word counts 2 if it is a word of the entry and 1 if it
+        only starts one. Entries whose name starts with the query count 3
+        more, categories 1 more. Of equal matches the shorter names come
+        first."""
+        query = words(text)
+        if not query: return []
+        phrase = " ".join(query)
+        entries = self.__loaded()
+        with self.__lock:
+            postings = self.__postings
+            smallest = None
+            for position, word in enumerate(query):
+                completions = self.__completions(word)
+                size = sum(len(postings[completion])
+                           for completion in completions)
+                if not size: return []
+                if smallest is None or size < smallest[0]:
+                    smallest = size, position, completions
+            size, position, completions = smallest
+            candidates = set()
+            for word in completions:
+                candidates.update(postings[word])
+            # The candidates start a word with query[position], the other
+            # query words are checked against the words of each candidate
+            others = query[:position] + query[position+1:]
+            exact = postings.get(query[position], ())
+            ranked = []
+            for id in candidates:
+                category, name, found = entries[id]
+                if categories is not None and category not in categories:
+                    continue
+                score = id in exact and 2 or 1
+                for word in others:
+                    if word in found:
+                        score += 2
+                    elif [other for other in found if other.startswith(word)]:
+                        score += 1
+                    else:
+                        break
+                else:
+                    if name.startswith(phrase):
+                        score += 3
+                    if category == id:
+                        score += 1
+                    ranked.append((-score, len(name), name, id, category))
+        return [(id, category) for score, length, name, id, category
+                in heapq.nsmallest(limit, ranked)]
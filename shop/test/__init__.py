@@ -1,55 +1,191 @@
 # -*- coding: utf-8 -*-
+"""
+The tests of the shop.
+
+Each module in this package defines test cases, the functions in it whose
+names do not start with an underscore. A case is called with a new store of
+its own, which is removed after the case. The cases run on a pool of
+processes, --jobs of them, and the time of each case is reported.
+
+A case can be given a time budget with the budget decorator, the case fails
+if it runs longer. A test module that cannot be imported counts as an error,
+a name that selects no module or case as a failure. A case that needs more
+stores opens them with scratch_store.
+"""
+
+from __future__ import with_statement
 
 import sys
 import os
+import shutil
+import tempfile
 import traceback
 
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+
+try:
+    import multiprocessing
+except ImportError: # Python < 2.6, Jython
+    multiprocessing = None
+
 from shop import Store
+from shop.schema import snapshot_path
+from shop.backend import BACKENDS, backend_of
+
+
+def budget(milliseconds, operation=None, **backends):
+    """Fail the decorated case if it takes more than milliseconds, or if the
+    calls of the given model operation in it do, such as
+    'Category.__iter__' (see shop.instrument). Keyword arguments give the
+    budget on other backends, by backend name, such as neo4j=5000."""
+    def decorator(case):
+        @wraps(case)
+        def budgeted(store):
+            limit = backends.get(backend_name(store), milliseconds)
+            if operation is None:
+                start = default_timer()
+                case(store)
+                elapsed = default_timer() - start
+            else:
+                from shop.instrument import Profile
+                with Profile() as stats:
+                    case(store)
+                assert operation in stats, "%s was not called" % (operation,)
+                elapsed = stats[operation].time
+            assert elapsed * 1000 <= limit, \
+                "%s took %.1f ms, over the budget of %d ms" % (
+                    operation or "the case", elapsed * 1000, limit)
+        budgeted.budget = milliseconds, operation, backends
+        return budgeted
+    return decorator
+
+
+def backend_name(store):
+    """The name of the backend that store runs on."""
+    module = backend_of(store.graphdb).__name__
+    return [name for name in BACKENDS if BACKENDS[name] == module][0]
+
+
+@contextmanager
+def scratch_store(store, **options):
+    """Open a new, empty Store on the backend of store, in a temporary
+    directory. The store is closed and removed at the end of the block."""
+    directory = tempfile.mkdtemp()
+    try:
+        other = Store(os.path.join(directory, 'store'),
+                      backend=backend_name(store), **options)
+        try:
+            yield other
+        finally:
+            other.close()
+    finally:
+        shutil.rmtree(directory)
 
 
 def start(*args, **params):
-    storedir = os.path.join(params['store'],'test')
-
-    paths = []
-    for path, dirs, files in os.walk(storedir):
-        paths.append(path)
-        for f in files:
-            os.remove(os.path.join(path,f))
-    paths.reverse()
-    for path in paths:
-        os.rmdir(path)
-
-    store = Store(storedir)
-
-    if args:
-        for arg in args:
-            try:
-                run(store, arg)
-            except:
-                print('no such test case: "%s"' % (arg,))
+    storedir = os.path.join(params['store'], 'test')
+    if os.path.exists(storedir):
+        shutil.rmtree(storedir)
+    jobs = params.get('jobs')
+    if jobs is None and multiprocessing is not None:
+        jobs = multiprocessing.cpu_count()
+
+    names = list(args)
+    if not names:
+        names = sorted(filename[:-3] for filename in
+                       os.listdir(os.path.dirname(__file__))
+                       if filename.endswith('.py')
+                       and not filename.startswith('_'))
+    tests, results = [], []
+    for name in names:
+        try:
+            tests.extend(cases(name))
+        except LookupError:
+            print('no such test case: "%s"' % (name,))
+            results.append((name, 'MISSING', 0.0))
+        except:
+            print('%s: ERROR! %8.3fs\n%s' % (name, 0.0,
+                                            traceback.format_exc().rstrip()))
+            results.append((name, 'ERROR!', 0.0))
+    tests = [(test, storedir, params['backend']) for test in tests]
+
+    start = default_timer()
+    if jobs > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results.extend(pool.imap(_run, tests))
+        finally:
+            pool.close()
+            pool.join()
     else:
-        for filename in os.listdir(os.path.dirname(__file__)):
-            if filename.endswith('.py') and not filename.startswith('_'):
-                run(store, filename[:-3])
+        results.extend(map(_run, tests))
+    elapsed = default_timer() - start
+
+    failed = [result for result in results if result[1] != 'PASSED']
+    print('%d passed, %d failed in %.2fs' % (len(results) - len(failed),
+                                            len(failed), elapsed))
+    if failed:
+        sys.exit(1)
 
 
-def run(store, test):
+def cases(name):
+    """The names of the test cases selected by name, a test module or
+    module.case. Raises LookupError if there is no such module or case, the
+    errors of importing the module pass through."""
+    test, _, case = name.partition('.')
+    if test.startswith('_') or not os.path.exists(
+            os.path.join(os.path.dirname(__file__), test + '.py')):
+        raise LookupError("No test module %s" % (test,))
     environ = {}
-    exec("from shop.test.%s import *" % (test,), environ)
-    for name, case in environ.items():
-        if not name.startswith('_'):
-            runtest(store, '%s.%s' % (test, name), case)
+    exec("from shop.test import %s as module" % (test,), environ)
+    module = environ['module']
+    if case:
+        if not callable(getattr(module, case, None)):
+            raise LookupError("No test case %s" % (name,))
+        return [name]
+    found = []
+    for case, value in sorted(vars(module).items()):
+        if getattr(value, '__module__', None) != module.__name__:
+            continue # imported names, such as __future__ features
+        if callable(value) and not case.startswith('_'):
+            found.append('%s.%s' % (test, case))
+    return found
 
 
 def runtest(store, name, case):
+    """Run a case with store, print and return (name, result, seconds)."""
+    start = default_timer()
     try:
         case(store)
     except AssertionError:
-        _,val,tb = sys.exc_info()
-        message = val.message
-        print('%s: FAILED   %s' % (name, message))
+        result = 'FAILED'
+        message = '  %s' % (sys.exc_info()[1],)
     except:
-        print('%s: ERROR!' % (name,))
-        traceback.print_exc()
+        result = 'ERROR!'
+        message = '\n' + traceback.format_exc().rstrip()
     else:
-        print('%s: PASSED' % (name,))
+        result = 'PASSED'
+        message = ''
+    elapsed = default_timer() - start
+    print('%s: %s %8.3fs%s' % (name, result, elapsed, message))
+    sys.stdout.flush()
+    return name, result, elapsed
+
+
+def _run(task):
+    name, storedir, backend = task
+    test, case = name.split('.')
+    environ = {}
+    exec("from shop.test.%s import %s as case" % (test, case), environ)
+    storedir = os.path.join(storedir, name)
+    store = Store(storedir, backend=backend)
+    try:
+        return runtest(store, name, environ['case'])
+    finally:
+        store.close()
+        if os.path.exists(storedir):
+            shutil.rmtree(storedir)
+        if os.path.exists(snapshot_path(storedir)):
+            os.remove(snapshot_path(storedir))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+def attribute_type_names_are_unique(store):
+    first = store.attribute.type('Unique', Unit='m')
+    size = len(store.attribute.type.index)
+    try:
+        store.attribute.type('Unique')
+    except KeyError:
+        pass
+    else:
+        assert False, "created a duplicate attribute type"
+    assert len(list(store.attribute.type)) == size
+    assert store.attribute.type['Unique'] is first
+    assert first.unit == 'm'
+
+def define_types_is_all_or_nothing(store):
+    size = len(list(store.attribute.type))
+    try:
+        store.attribute.type.define_types([('Batch a', {}), ('Batch b', {}),
+                                           ('Batch a', {'Unit': 'kg'})])
+    except KeyError:
+        pass
+    else:
+        assert False, "defined the same attribute type twice"
+    assert len(list(store.attribute.type)) == size
+    a, b = store.attribute.type.define_types([('Batch a', {'Unit': 'kg'}),
+                                              ('Batch b', {})])
+    assert (a.name, a.unit, b.name) == ('Batch a', 'kg', 'Batch b')
+    assert store.attribute.type['Batch b'] is b
+
+def duplicate_type_keeps_enclosing_transaction(store):
+    with store.graphdb.transaction:
+        first = store.attribute.type('Enclosed')
+        try:
+            store.attribute.type('Enclosed')
+        except KeyError:
+            pass
+        else:
+            assert False, "created a duplicate attribute type"
+        second = store.attribute.type('Enclosed too')
+    assert store.attribute.type['Enclosed'] is first
+    assert store.attribute.type['Enclosed too'] is second
+
+def rolled_back_type_frees_its_name(store):
+    try:
+        with store.graphdb.transaction:
+            store.attribute.type('Rolled back type')
+            raise ValueError("roll back")
+    except ValueError:
+        pass
+    try:
+        store.attribute.type['Rolled back type']
+    except KeyError:
+        pass
+    else:
+        assert False, "found an attribute type that was rolled back"
+    type = store.attribute.type('Rolled back type', Unit='g')
+    assert store.attribute.type['Rolled back type'] is type
+
+def rolled_back_attribute_is_taken_back(store):
+    name = store.attribute.type.get_or_create('name')
+    size = store.attribute.type('Size', Unit='cm')
+    cat = store.categories('Unsized', Name=store.attribute(name))
+    sub = cat.new_subcategory('Unsized sub')
+    try:
+        with store.graphdb.transaction:
+            cat.new_attribute('Size', store.attribute(size))
+            assert [attr.key for attr in sub.get_all_attributes()] == \
+                ['Name', 'Size']
+            raise ValueError("roll back")
+    except ValueError:
+        pass
+    assert [attr.key for attr in cat.get_all_attributes()] == ['Name']
+    assert [attr.key for attr in sub.get_all_attributes()] == ['Name']
+    assert not hasattr(cat, 'Size')
+    assert sub.new_product(Name='x').Name == 'x'
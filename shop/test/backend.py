@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import gc as _gc
+
+from shop import aio as _aio
+from shop import model as _model
+from shop.backend import memory as _memory
+
+def memory_transaction_rollback(store):
+    graphdb = _memory.GraphDatabase()
+    with graphdb.transaction:
+        node = graphdb.node(Name='kept')
+    try:
+        with graphdb.transaction:
+            node['Name'] = 'changed'
+            graphdb.reference_node.THING(graphdb.node(Name='dropped'))
+            raise KeyError
+    except KeyError:
+        pass
+    assert node['Name'] == 'kept'
+    assert graphdb.reference_node.THING.single is None
+    assert graphdb.node[node.id] is node
+
+def memory_write_requires_transaction(store):
+    graphdb = _memory.GraphDatabase()
+    try:
+        graphdb.node()
+    except _memory.NotInTransaction:
+        pass
+    else:
+        assert False, "node created outside of a transaction"
+
+def store_runs_on_memory_backend(store):
+    from shop import Store
+    store = Store(None, backend='memory')
+    cat = store.categories('Memory')
+    assert cat is store.categories['Memory']
+    assert cat.parent is store.root
+
+def stores_have_separate_identity_maps(store):
+    from shop import Store
+    first = Store(None, backend='memory')
+    second = Store(None, backend='memory')
+    one, two = first.categories('Same'), second.categories('Same')
+    assert _model.category_node(one).id == _model.category_node(two).id
+    assert one is not two
+    assert first.categories['Same'] is one
+    assert second.categories['Same'] is two
+    assert two.graphdb is second.graphdb
+
+def unclosed_stores_are_collected(store):
+    import weakref
+    from shop import Store
+    unclosed = Store(None, backend='memory')
+    unclosed.categories('Unclosed').new_product()
+    list(unclosed.root)
+    graphdb = weakref.ref(unclosed.graphdb)
+    del unclosed
+    _gc.collect()
+    assert graphdb() is None, "the graph database of the store was kept"
+
+class _Thing(object):
+    pass
+
+def identity_map_is_bounded(store):
+    cache = _model.IdentityMap(4)
+    for id in range(10):
+        cache.add(id, _Thing())
+    _gc.collect()
+    assert len(cache) <= 4, len(cache)
+    assert cache.evictions >= 6, cache.evictions
+    kept = _Thing()
+    cache.add(99, kept)
+    cache.resize(0)
+    _gc.collect()
+    assert len(cache) == 1 and cache.get(99) is kept
+
+def async_store_calls(store):
+    aio = _aio.AsyncStore(store, workers=2, chunk_size=2)
+    try:
+        cat = aio.new_category('Async').result(5)
+        assert aio.category('Async').result(5) is cat
+        for i in range(5):
+            aio.new_product(cat).result(5)
+        listing = aio.products(cat)
+        products = []
+        while True:
+            try:
+                products.append(listing.next_item().result(5))
+            except StopIteration:
+                break
+        assert len(products) == 5, products
+        transaction = aio.transaction()
+        transaction.begin().result(5)
+        transaction.run(cat.new_subcategory, 'Async sub').result(5)
+        transaction.rollback().result(5)
+        try:
+            aio.subcategory(cat, 'Async sub').result(5)
+        except KeyError:
+            pass
+        else:
+            assert False, "the transaction was not rolled back"
+        names = [sub.name for sub in aio.categories().next_chunk().result(5)]
+        assert 'Async' in names, names
+    finally:
+        aio.close()
@@ -11,3 +11,79 @@ def create_category_with_attributes(store):
     assert cat is not None
     assert 'Name' in dir(cat)
     print cat.Name
+
+def new_attribute_updates_subcategories(store):
+    type = store.attribute.type.get_or_create('name')
+    cat = store.categories('Schema', Name=store.attribute(type))
+    sub = cat.new_subcategory('Subschema')
+    assert [attr.key for attr in sub.get_all_attributes()] == ['Name']
+    cat.new_attribute('Label', store.attribute(type, default='none'))
+    keys = [attr.key for attr in sub.get_all_attributes()]
+    assert keys == ['Label', 'Name'], keys
+    assert sub.new_product(Name='thing').Label == 'none'
+
+def subcategory_lookup_by_name(store):
+    cat = store.categories('Lookup')
+    first = cat.new_subcategory('First')
+    assert cat['First'] is first
+    second = cat.new_subcategory('Second')
+    assert cat['Second'] is second
+    try:
+        cat['Third']
+    except KeyError:
+        pass
+    else:
+        assert False, "found a category that does not exist"
+
+def category_lookup_uses_name_index(store):
+    index = store.categories.index
+    cat = store.categories('Indexed')
+    len(index) # load the index
+    hits, misses, loads = index.hits, index.misses, index.loads
+    assert store.categories['Indexed'] is cat
+    try:
+        store.categories['Not indexed']
+    except KeyError:
+        pass
+    sub = cat.new_subcategory('Indexed child')
+    assert store.categories['Indexed child'] is sub
+    assert (index.hits, index.misses) == (hits + 2, misses + 1)
+    assert index.loads == loads
+
+def rolled_back_category_is_not_indexed(store):
+    len(store.categories.index) # load the index
+    try:
+        with store.graphdb.transaction:
+            store.categories('Rolled back')
+            raise ValueError("roll back")
+    except ValueError:
+        pass
+    try:
+        store.categories['Rolled back']
+    except KeyError:
+        pass
+    else:
+        assert False, "found a category that was rolled back"
+    cat = store.categories('Rolled back')
+    assert store.categories['Rolled back'] is cat
+
+def rolled_back_subcategory_is_not_a_child(store):
+    cat = store.categories('Parent')
+    try:
+        cat['Child']
+    except KeyError: # builds the index of the children
+        pass
+    try:
+        with store.graphdb.transaction:
+            cat.new_subcategory('Child')
+            raise ValueError("roll back")
+    except ValueError:
+        pass
+    try:
+        cat['Child']
+    except KeyError:
+        pass
+    else:
+        assert False, "found a subcategory that was rolled back"
+    child = cat.new_subcategory('Child')
+    assert cat['Child'] is child
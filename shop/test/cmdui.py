@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import sys as _sys
+
+from StringIO import StringIO as _StringIO
+
+from shop.cmdui import CommandLineUi as _CommandLineUi
+
+def script_runs_commands_in_groups(store):
+    script = ['make type name:Label',
+              'make category name:Scripted Label:Label',
+              '# a comment']
+    script += ['make product Label:"Item %d"' % (i,) for i in range(25)]
+    script += ['make product Size:3', 'exit', 'make product Label:never']
+    output, progress = _StringIO(), _StringIO()
+    streams = _sys.stdout, _sys.stderr
+    _sys.stdout = _sys.stderr = output
+    try:
+        ui = _CommandLineUi(store)
+        lines = ui.run_script(script, group_size=10, progress=progress)
+    finally:
+        _sys.stdout, _sys.stderr = streams
+    assert lines == 30, lines
+    assert progress.getvalue().startswith('30 lines'), progress.getvalue()
+    cat = store.categories['Scripted']
+    assert ui.category is cat
+    labels = sorted(product.Label for product in cat)
+    assert labels == sorted('Item %d' % (i,) for i in range(25)), labels
+    assert "No attribute 'Size'" in output.getvalue(), output.getvalue()
+
+def script_commits_around_failed_commands(store):
+    script = ['make type name:Label',
+              'make category name:Kept Label:Label',
+              'make product Label:before',
+              'make product Size:3',
+              'make product Label:after',
+              'cat ..']
+    output = _StringIO()
+    stdout, _sys.stdout = _sys.stdout, output
+    try:
+        ui = _CommandLineUi(store)
+        lines = ui.run_script(script, group_size=100)
+    finally:
+        _sys.stdout = stdout
+    assert lines == 6, lines
+    assert ui.category is store.root
+    cat = store.categories['Kept']
+    assert sorted(product.Label for product in cat) == ['after', 'before']
+    output = output.getvalue()
+    assert "line 4: AttributeError: No attribute 'Size'" in output, output
+    # the output of the commands run again is not repeated
+    assert output.count('Current category: Kept') == 1, output
+
+def make_attributes_parses_quoted_values(store):
+    parse = _CommandLineUi(store)._make_attributes
+    assert parse('a:1  b:"x y" c:z ') == dict(a='1', b='x y', c='z')
+    assert parse('') == {}
+    try:
+        parse('a:1 b')
+    except ValueError:
+        pass
+    else:
+        assert False, "parsed a key without a value"
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+from StringIO import StringIO as _StringIO
+
+from shop.test import scratch_store as _scratch_store
+
+def dump_and_restore_store(store):
+    name = store.attribute.type('Label', Unit='')
+    weight = store.attribute.type('Mass', Unit='Kg')
+    cat = store.categories('Dumped', Label=store.attribute(name),
+                           Mass=store.attribute(weight, default=1.5))
+    sub = cat.new_subcategory('Dumped sub')
+    cat.bulk_new_products(dict(Label='p%d' % (i,)) for i in range(25))
+    sub.new_product(Label='heavy', Mass=20.0)
+    for compress in (False, True):
+        dumped = _StringIO()
+        assert store.dump(dumped, compress, chunk_size=10) == 26
+        if not compress:
+            assert len(dumped.getvalue().splitlines()) == 1 + 2 + 3 + 3 + 1
+        dumped.seek(0)
+        with _scratch_store(store) as target:
+            assert target.restore(dumped, batch_size=7) == (26, 0)
+            restored = target.categories['Dumped sub']
+            assert restored.parent is target.categories['Dumped']
+            assert [(attr.key, attr.default, attr.get_unit()) for attr
+                    in restored.get_all_attributes()] == \
+                [('Label', None, ''), ('Mass', 1.5, 'Kg')]
+            assert [(p.Label, p.Mass) for p in restored] == [('heavy', 20.0)]
+            assert target.root.count_products() == 26
+            labels = sorted(p.Label for p in target.categories['Dumped'])
+            assert labels == sorted(['heavy'] +
+                                    ['p%d' % (i,) for i in range(25)])
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+try:
+    import json as _json
+except ImportError: # Python < 2.6
+    import simplejson as _json
+
+from shop.httpui import Catalogue as _Catalogue
+
+def catalogue_serves_json(store):
+    name = store.attribute.type.get_or_create('name')
+    cat = store.categories('Served', Name=store.attribute(name))
+    cat.new_subcategory('Served sub').new_product(Name='thing')
+    catalogue = _Catalogue(store)
+    status, headers, body = catalogue.respond('/categories/Served')
+    assert status == 200, (status, body)
+    served = _json.loads(body)
+    assert served['subcategories'] == ['Served sub'] and served['total'] == 1
+    assert [attr['key'] for attr in served['attributes']] == ['Name']
+    status, headers, body = catalogue.respond(
+        '/categories/Served/products?limit=1')
+    page = _json.loads(body)
+    assert [product['Name'] for product in page['products']] == ['thing']
+    assert page['next'] is None
+    tree = _json.loads(catalogue.respond('/categories')[2])
+    assert 'Served' in [sub['name'] for sub in tree['subcategories']]
+    assert catalogue.respond('/categories/Nothing')[0] == 404
+    assert catalogue.respond('/categories/Served/products?after=x')[0] == 400
+
+def catalogue_caches_by_generation(store):
+    cat = store.categories('Cached')
+    catalogue = _Catalogue(store)
+    status, headers, body = catalogue.respond('/categories/Cached')
+    hits = catalogue.cache.hits
+    assert catalogue.respond('/categories/Cached') == (status, headers, body)
+    assert catalogue.cache.hits == hits + 1
+    assert catalogue.respond('/categories/Cached', headers['ETag'])[0] == 304
+    cat.new_subcategory('Cached sub')
+    status, changed, body = catalogue.respond('/categories/Cached',
+                                              headers['ETag'])
+    assert status == 200 and changed['ETag'] != headers['ETag']
+    assert _json.loads(body)['subcategories'] == ['Cached sub']
+
+def catalogue_generation_changes_at_commit(store):
+    cat = store.categories('Pending')
+    catalogue = _Catalogue(store)
+    etag = catalogue.respond('/categories/Pending')[1]['ETag']
+    assert catalogue.respond('/categories/Missing', etag)[0] == 404
+    try:
+        with store.graphdb.transaction:
+            cat.new_subcategory('Pending sub')
+            status, headers, body = catalogue.respond('/categories/Pending')
+            assert headers['ETag'] == etag # not committed yet
+            raise ValueError("roll back")
+    except ValueError:
+        pass
+    status, headers, body = catalogue.respond('/categories/Pending', etag)
+    assert status == 200 and headers['ETag'] != etag, (status, headers)
+    assert _json.loads(body)['subcategories'] == []
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+from shop import instrument as _instrument
+
+def profile_counts_graph_operations(store):
+    cat = store.categories('Profiled')
+    node_class = type(store.graphdb.reference_node)
+    original = node_class.__setitem__
+    with _instrument.Profile() as stats:
+        assert node_class.__setitem__ != original, "the graph is not hooked"
+        cat.new_product()
+        products = list(cat)
+    assert node_class.__setitem__ == original, "the hooks were not removed"
+    assert _instrument.current() is None
+    new_product = stats['Category.new_product']
+    assert new_product.calls == 1, new_product.calls
+    assert new_product.time > 0
+    counts = new_product.counts
+    assert counts['nodes created'] == 1, counts
+    assert counts['relationships created'] == 1, counts
+    assert counts['transactions'] >= 1, counts
+    assert counts['property writes'] >= 2, counts # the product counts
+    listing = stats['Category.__iter__']
+    assert listing.calls == 1, listing.calls
+    assert listing.counts['relationship hops'] >= len(products), listing.counts
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import gc as _gc
+import threading as _threading
+
+from StringIO import StringIO as _StringIO
+
+from shop import model as _model
+from shop.importer import import_products as _import_products
+from shop.test import budget as _budget
+
+def _category(store, name):
+    name_type = store.attribute.type.get_or_create('name')
+    count_type = store.attribute.type.get_or_create('count', Unit='pcs.')
+    return store.categories(name, Name=store.attribute(name_type),
+                            Count=store.attribute(count_type, default=1))
+
+def bulk_new_products_rejects_rows(store):
+    cat = _category(store, 'Bulk')
+    errors = []
+    created, rejected = cat.bulk_new_products(
+        [dict(Name='a'), dict(Count=2), dict(Name='b', Size=3),
+         dict(Name='c', Count=5)],
+        batch_size=2, errors=lambda *error: errors.append(error))
+    assert (created, rejected) == (2, 2), (created, rejected)
+    assert [index for index, values, error in errors] == [1, 2]
+    assert isinstance(errors[0][2], KeyError)
+    assert isinstance(errors[1][2], AttributeError)
+    names = sorted(product.Name for product in cat)
+    assert names == ['a', 'c'], names
+
+def bulk_new_products_needs_a_positive_batch_size(store):
+    cat = _category(store, 'Unbatched')
+    for batch_size in (0, -1):
+        try:
+            cat.bulk_new_products([dict(Name='never')], batch_size=batch_size)
+        except ValueError:
+            pass
+        else:
+            assert False, "created products in batches of %d" % (batch_size,)
+    assert cat.count_products() == 0
+
+def import_products_from_feeds(store):
+    cat = _category(store, 'Feed')
+    errors = []
+    created, rejected = _import_products(
+        store, _StringIO('Name,Count\nx,3\n,4\ny,\n'), 'csv', cat,
+        errors=lambda *error: errors.append(error))
+    assert (created, rejected) == (2, 1), (created, rejected)
+    assert errors[0][0] == 3
+    created, rejected = _import_products(
+        store, _StringIO('{"Name": "z"}\nnot json\n'), 'jsonl', cat,
+        errors=lambda *error: errors.append(error))
+    assert (created, rejected) == (1, 1), (created, rejected)
+    assert errors[1][0] == 2
+    counts = sorted((product.Name, product.Count) for product in cat)
+    assert counts == [('x', '3'), ('y', 1), ('z', 1)], counts
+
+def products_are_paged_by_cursor(store):
+    cat = _category(store, 'Paged')
+    for i, sub in enumerate(['Paged a', 'Paged b', 'Paged c']):
+        sub = cat.new_subcategory(sub)
+        if i != 1:
+            sub.new_subcategory(sub.name + '1').bulk_new_products(
+                [dict(Name='%s %d' % (sub, n)) for n in range(3)])
+        sub.bulk_new_products([dict(Name='%s %d' % (sub, n + 3))
+                               for n in range(2)])
+    expected = sorted(product.Name for product in cat)
+    names, cursor, pages = [], None, 0
+    while True:
+        page, cursor = cat.products(4, after=cursor)
+        pages += 1
+        names.extend(product.Name for product in page)
+        if cursor is None: break
+    assert sorted(names) == expected and len(names) == 12, names
+    assert pages == 3, pages
+    try:
+        cat['Paged a'].products(after=cursor or '0:0')
+    except ValueError:
+        pass
+    else:
+        assert False, "accepted an invalid cursor"
+
+def filter_products_by_attribute_values(store):
+    cat = _category(store, 'Filtered')
+    sub = cat.new_subcategory('Filtered sub')
+    cat.bulk_new_products([dict(Name='one', Count=1), dict(Name='two')])
+    assert sorted(p.Name for p in cat.filter(Count=1)) == ['one', 'two']
+    sub.new_product(Name='five', Count=5)
+    sub.new_product(Name='nine', Count=9)
+    names = lambda **conditions: sorted(product.Name for product
+                                        in cat.filter(**conditions))
+    assert names(Count__gt=1) == ['five', 'nine'], names(Count__gt=1)
+    assert names(Count__between=(2, 9)) == ['five', 'nine']
+    assert names(Count__lt=9, Name__in=('one', 'nine', 'five')) == \
+        ['five', 'one']
+    assert names(Count__gte=9) == ['nine']
+    for product in sub.filter(Name='five'):
+        product.Count = 10
+    assert names(Count__gte=9) == ['five', 'nine']
+    assert names(Count__lt=9) == ['one', 'two']
+    assert names(Count='5') == []
+
+def rolled_back_values_are_not_indexed(store):
+    cat = _category(store, 'Unfiltered')
+    cat.new_product(Name='kept', Count=2)
+    assert [p.Name for p in cat.filter(Count=2)] == ['kept'] # builds the index
+    try:
+        with store.graphdb.transaction:
+            cat.new_product(Name='added', Count=2)
+            for product in cat.filter(Name='kept'):
+                product.Count = 3
+            raise ValueError("roll back")
+    except ValueError:
+        pass
+    assert [p.Name for p in cat.filter(Count=2)] == ['kept']
+    assert [p.Name for p in cat.filter(Count=3)] == []
+
+def index_built_in_rolled_back_transaction_is_dropped(store):
+    cat = _category(store, 'Ghostly')
+    try:
+        with store.graphdb.transaction:
+            cat.new_product(Name='ghost')
+            assert [p.Name for p in cat.filter(Name='ghost')] == ['ghost']
+            raise ValueError("roll back")
+    except ValueError:
+        pass
+    assert list(cat.filter(Name='ghost')) == []
+
+def value_indexes_outlive_the_category_object(store):
+    cat = _category(store, 'Indexed')
+    cat.new_product(Name='kept')
+    assert len(list(cat.filter(Name='kept'))) == 1
+    indexes = _model.value_indexes(cat)
+    _model.identity_map(store.graphdb, 'categories').resize(0)
+    del cat
+    _gc.collect()
+    cat = store.categories['Indexed']
+    assert _model.value_indexes(cat) is indexes
+
+def products_to_columns(store):
+    cat = _category(store, 'Columns')
+    sub = cat.new_subcategory('Columns sub')
+    cat.bulk_new_products([dict(Name='one', Count=1), dict(Name='two')])
+    sub.bulk_new_products([dict(Name='three', Count=3)])
+    columns = cat.to_columns(use_numpy=False)
+    assert len(columns) == 3 and sorted(columns.keys()) == ['Count', 'Name']
+    assert list(columns['Count']) == [1.0, 1.0, 3.0], columns['Count']
+    assert columns['Name'] == ['one', 'two', 'three'], columns['Name']
+    ids = [_model.category_node(c).id for c in (cat, cat, sub)]
+    assert list(columns.categories) == ids, columns.categories
+    columns = cat.to_columns(['Count', 'Size'], use_numpy=False)
+    assert list(columns.missing['Size']) == [1, 1, 1]
+    assert list(columns.missing['Count']) == [0, 0, 0]
+
+def product_counts_are_maintained(store):
+    cat = _category(store, 'Counted')
+    sub = cat.new_subcategory('Counted sub')
+    root_count = store.root.count_products()
+    cat.new_product(Name='one')
+    sub.bulk_new_products([dict(Name='two'), dict(Name='three'), dict()])
+    counts = lambda: (cat.count_products(False), cat.count_products(),
+                      sub.count_products(False), sub.count_products())
+    assert counts() == (1, 3, 2, 2), counts()
+    assert store.root.count_products() == root_count + 3
+    for product in sub.filter(Name='two'):
+        cat.delete_product(product)
+    assert counts() == (1, 2, 1, 1), counts()
+    assert [p.Name for p in sub.filter(Name='two')] == []
+    try:
+        sub.delete_product(iter(cat).next())
+    except ValueError:
+        pass
+    else:
+        assert False, "deleted a product of another category"
+    assert cat.verify_product_counts() == []
+    with store.graphdb.transaction:
+        _model.category_node(sub)[_model.SUBTREE_PRODUCT_COUNT] = 5
+    assert len(cat.verify_product_counts(repair=True)) == 1
+    assert cat.verify_product_counts() == [] and counts() == (1, 2, 1, 1)
+
+def prefetched_products_are_snapshots(store):
+    cat = _category(store, 'Prefetched')
+    cat.bulk_new_products([dict(Name='one', Count=1), dict(Name='two')])
+    page, cursor = cat.products(10)
+    one, two = _model.prefetch(page)
+    assert (one.Name, one.Count, two.Count) == ('one', 1, 1)
+    with store.graphdb.transaction:
+        _model.product_node(one)['Count'] = 7
+    assert one.Count == 1
+    with store.graphdb.transaction:
+        two.Count = 3
+    assert two.Count == 3 and str(two) == str(cat.products(10)[0][1])
+    _model.prefetch([one])
+    assert one.Count == 7
+    names = [product.Name for product in cat.prefetched(batch_size=1)]
+    assert names == ['one', 'two'], names
+
+def products_iterate_in_category_preorder(store):
+    top = _category(store, 'Top')
+    left = top.new_subcategory('Left')
+    deep = left.new_subcategory('Deep')
+    right = top.new_subcategory('Right')
+    for cat, names in [(top, 'ab'), (left, 'c'), (deep, 'd'), (right, 'e')]:
+        for name in names:
+            cat.new_product(Name=name)
+    with store.graphdb.transaction:
+        nodes = [(category, node['Name'])
+                 for category, node in top.product_nodes()]
+        products = [(type(product), product.Name) for product in top]
+    assert products == nodes, (products, nodes)
+    assert sorted((category.name, name) for category, name in nodes) == \
+        [('Deep', 'd'), ('Left', 'c'), ('Right', 'e'), ('Top', 'a'),
+         ('Top', 'b')], nodes
+    # each category before its subcategories, the order of sibling
+    # categories is up to the backend
+    categories = [category for category, name in nodes]
+    assert categories in ([top, top, left, deep, right],
+                          [top, top, right, left, deep]), categories
+
+def new_product_errors(store):
+    cat = _category(store, 'Checked')
+    for values, error in [(dict(Count=2), KeyError),
+                          (dict(Name='a', Size=3), AttributeError)]:
+        try:
+            cat.new_product(**values)
+        except error:
+            pass
+        else:
+            assert False, "created a product from %r" % (values,)
+    assert cat.count_products() == 0 and list(cat) == []
+    type = store.attribute.type.get_or_create('name')
+    cat.new_attribute('Size', store.attribute(type))
+    try:
+        cat.new_product(Name='a')
+    except KeyError:
+        pass
+    else:
+        assert False, "created a product without a required value"
+    assert cat.new_product(Name='a', Size='big').Size == 'big'
+
+def concurrent_ingestion_keeps_counts(store):
+    cat = _category(store, 'Concurrent')
+    failures = []
+    def work(number):
+        try:
+            sub = cat.new_subcategory('Concurrent %d' % (number,))
+            for i in range(50):
+                with store.graphdb.transaction:
+                    sub.new_product(Name='%d.%d' % (number, i))
+            assert cat['Concurrent %d' % (number,)] is sub
+        except Exception:
+            failures.append(number)
+    threads = [_threading.Thread(target=work, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failures, failures
+    assert cat.count_products() == 400, cat.count_products()
+    assert len(list(cat)) == 400 and cat.verify_product_counts() == []
+
+def subtree_counts_are_added_after_commit(store):
+    cat = _category(store, 'Deferred')
+    sub = cat.new_subcategory('Deferred sub')
+    node = _model.category_node(cat)
+    with store.graphdb.transaction:
+        sub.new_product(Name='a')
+        sub.new_product(Name='b')
+        # the ancestors are not locked by the transaction
+        assert node[_model.SUBTREE_PRODUCT_COUNT] == 0
+        assert (cat.count_products(), sub.count_products(False)) == (2, 2)
+        assert cat.verify_product_counts() == []
+    assert node[_model.SUBTREE_PRODUCT_COUNT] == 2
+    assert cat.verify_product_counts() == []
+
+def rollback_keeps_concurrent_increments(store):
+    cat = _category(store, 'Interleaved')
+    written, committed = _threading.Event(), _threading.Event()
+    def roll_back():
+        try:
+            with store.graphdb.transaction:
+                cat.new_product(Name='dropped')
+                written.set()
+                # On Neo4j the other thread waits for the lock on the counts
+                committed.wait(1.0)
+                raise KeyError
+        except KeyError:
+            pass
+    thread = _threading.Thread(target=roll_back)
+    thread.start()
+    written.wait()
+    cat.new_product(Name='kept')
+    committed.set()
+    thread.join()
+    assert cat.count_products() == 1, cat.count_products()
+    assert cat.verify_product_counts() == []
+
+def scan_products_in_parallel(store):
+    cat = _category(store, 'Scanned')
+    for i in range(3):
+        sub = cat.new_subcategory('Scanned %d' % (i,))
+        sub.new_subcategory('Scanned %d.0' % (i,)).bulk_new_products(
+            [dict(Name='%d.0 %d' % (i, n), Count=n) for n in range(i * 4)])
+        sub.bulk_new_products([dict(Name='%d %d' % (i, n)) for n in range(3)])
+    expected = [product.Name for product in cat.products(100)[0]]
+    name = lambda product: product.Name
+    for workers in (1, 3):
+        names = list(store.scan(name, workers, category=cat))
+        assert names == expected, (workers, names)
+    counts = list(store.scan(lambda product: product.Count, 2, key=str,
+                             category=cat))
+    assert [(count, len(found)) for count, found in counts][:3] == \
+        [('0', 2), ('1', 11), ('2', 2)], counts
+    def fail(product):
+        if product.Count > 4: raise ValueError(product.Name)
+        return product.Name
+    errors = []
+    found = list(store.scan(fail, 2, category=cat,
+                            errors=lambda *error: errors.append(error)))
+    assert len(found) + len(errors) == len(expected) and len(errors) == 3
+    try:
+        list(store.scan(fail, 2, category=cat))
+    except ValueError:
+        pass
+    else:
+        assert False, "the scan did not fail"
+
+@_budget(1000, 'Category.__iter__', neo4j=10000)
+def iterate_10k_products_within_budget(store):
+    cat = _category(store, 'Budget')
+    cat.bulk_new_products(dict(Name='p%d' % (i,)) for i in xrange(10000))
+    with store.graphdb.transaction:
+        assert len(list(cat)) == 10000
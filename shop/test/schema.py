@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import gc as _gc
+import os as _os
+import shutil as _shutil
+import tempfile as _tempfile
+
+try:
+    import json as _json
+except ImportError: # Python < 2.6
+    import simplejson as _json
+
+from shop import Store as _Store
+from shop import model as _model
+from shop import schema as _schema
+from shop.test import backend_name as _backend_name
+
+def snapshot_warm_start(store):
+    directory = _tempfile.mkdtemp()
+    try:
+        path = _os.path.join(directory, 'snapshot.json')
+        name = store.attribute.type('Label', Unit='')
+        cat = store.categories('Snapshot',
+                               Label=store.attribute(name, default='x'))
+        cat.new_subcategory('Snapshot sub').new_product()
+        version = _schema.write_snapshot(store, path)
+        assert _schema.load_snapshot(store, path) == version
+        graphdb = store.graphdb
+        _model.forget(graphdb)
+        assert _schema.load_snapshot(store, path) == version
+        categories = _model.identity_map(graphdb, 'categories')
+        assert len(categories) == 3, len(categories) # with the root
+        misses = categories.misses
+        sub = store.categories['Snapshot sub']
+        assert categories.misses == misses
+        assert [attr.key for attr in sub.get_all_attributes()] == ['Label']
+        assert iter(sub).next().Label == 'x'
+        cat.new_subcategory('Snapshot newer')
+        assert _schema.load_snapshot(store, path) is None
+    finally:
+        _shutil.rmtree(directory)
+
+def snapshot_pins_the_schema(store):
+    directory = _tempfile.mkdtemp()
+    try:
+        path = _os.path.join(directory, 'snapshot.json')
+        for i in range(20):
+            store.categories('Pinned %d' % (i,))
+        _schema.write_snapshot(store, path)
+        graphdb = store.graphdb
+        _model.forget(graphdb)
+        categories = _model.identity_map(graphdb, 'categories')
+        categories.resize(4)
+        assert _schema.load_snapshot(store, path) is not None
+        _gc.collect()
+        assert len(categories) == 21, len(categories) # with the root
+        misses = categories.misses
+        for i in range(20):
+            store.categories['Pinned %d' % (i,)]
+        assert categories.misses == misses
+    finally:
+        _shutil.rmtree(directory)
+
+def stale_snapshot_is_rewritten_at_open(store):
+    directory = _tempfile.mkdtemp()
+    try:
+        storedir = _os.path.join(directory, 'store')
+        path = _schema.snapshot_path(storedir)
+        stale = open(path, 'w')
+        try:
+            _json.dump(dict(format=_schema.FORMAT, store='Products',
+                            version=-1), stale)
+        finally:
+            stale.close()
+        opened = _Store(storedir, backend=_backend_name(store), snapshot=True)
+        try:
+            with opened.graphdb.transaction:
+                version = _model.schema_version(opened.graphdb)
+            assert _schema.load_snapshot(opened, path) == version
+        finally:
+            opened.close()
+    finally:
+        _shutil.rmtree(directory)
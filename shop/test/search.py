@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+from shop.search import TextIndex as _TextIndex
+
+def text_index_ranks_matches(store):
+    index = _TextIndex(lambda: [
+            (1, 1, dict(Name='Laptops')),
+            (2, 1, dict(Name='HP Laptop', Color='silver')),
+            (3, 1, dict(Name='Laptop bag for the HP Laptop')),
+            (4, 4, dict(Name='Bags')),
+            (5, 4, dict(Name='Lapis lazuli pouch', Weight=0.2))])
+    # The category, the names that start with 'lap', shorter first
+    assert index.search('lap') == [(1, 1), (5, 4), (3, 1), (2, 1)], \
+        index.search('lap')
+    assert index.search('hp lap') == [(2, 1), (3, 1)], index.search('hp lap')
+    assert index.search('lap', categories=set([4])) == [(5, 4)]
+    assert index.search('silver') == [(2, 1)]
+    assert index.search('lap', limit=1) == [(1, 1)]
+    assert index.search('0') == [] # numbers are not indexed
+    assert index.search('laptops bag') == []
+    index.remove(2)
+    index.add(6, 4, dict(Name='Laptop sleeve'))
+    assert index.search('hp') == [(3, 1)], index.search('hp')
+    assert index.search('sle') == [(6, 4)]
+
+def _names(results):
+    return [result.Name for result in results]
+
+def store_search_follows_changes(store):
+    name = store.attribute.type.get_or_create('name')
+    cat = store.categories('Searchable', Name=store.attribute(name))
+    phones = cat.new_subcategory('Phones')
+    phone = phones.new_product(Name='Pocket phone')
+    assert _names(store.search('pock')) == ['Pocket phone']
+    phones.new_product(Name='Pocket watch')
+    cases = cat.new_subcategory('Pocket cases')
+    results = store.search('pocket')
+    assert results[0] is cases, results
+    assert _names(results[1:]) == ['Pocket phone', 'Pocket watch'], results
+    with store.graphdb.transaction:
+        phone.Name = 'Desk phone'
+    assert _names(store.search('desk')) == ['Desk phone']
+    assert store.search('pocket phone') == []
+    phones.delete_product(phone)
+    assert store.search('desk') == []
+    assert store.search('pocket', category=cases) == [cases]
+
+def rolled_back_changes_are_not_found(store):
+    name = store.attribute.type.get_or_create('name')
+    cat = store.categories('Unsearched', Name=store.attribute(name))
+    kept = cat.new_product(Name='Kept kettle')
+    assert _names(store.search('kettle')) == ['Kept kettle'] # loads the index
+    try:
+        with store.graphdb.transaction:
+            cat.new_product(Name='Rolled back kettle')
+            cat.new_subcategory('Kettle racks')
+            kept.Name = 'Kept teapot'
+            raise ValueError("roll back")
+    except ValueError:
+        pass
+    assert _names(store.search('kettle')) == ['Kept kettle']
+    assert store.search('teapot') == []